@@ -3,8 +3,24 @@
     usage:
     python outgrab.py -v (verbosity)  -i (input.txt...) -p program.grab 
     -v (optional) 0 = silent (default), 4 = debug, 1,2,3 = intermediate levels of output
-    -p the outgrab program to read in
+    -p the outgrab program to read in; with several programs, each is run over the same input,
+       read once, and their outputs go to stdout in order, or with -o SUFFIX to name+SUFFIX
     -i (optional) additional input files to read in; named $file2, $file3, etc.
+    -e (optional) search engine for forward matches: lines (default), buffer or trigram
+    -s (optional) stream stdin: read it lazily and write output as it is produced;
+       only for programs that never move backwards. -w sets the look-behind window (lines)
+    -m (optional) memory-map input files (-i, readinput, and stdin redirected from a file)
+       and decode their lines only when they are used
+    -c (optional) keep input files as one block of text plus an array of line positions
+    -x (optional) with -m (implied), save the line indexes of input files in a cache
+       directory (default ~/.cache/outgrab) and reuse them while the files are unchanged
+    --each (optional) run the program separately over each of the files given instead of stdin,
+       in -j worker processes; outputs go to stdout in the order of the files, or with -o SUFFIX
+       to each file's name plus SUFFIX
+    -f (optional) write output lines while the program runs, --writebatch lines at a time
+    --spill MB (optional) move output and scratch lines beyond about MB megabytes to temporary files
+    --scanjobs (optional) number of processes searching large input files for matchnextdump ... nfind all
+    --profile (optional) report the count, time, lines searched and output of each program line on stderr
     reads from stdin and internally calls that file $file1
     writes to stdout
     python outgrab.py -p program.grab < a.txt > myoutput.txt
@@ -13,28 +29,44 @@
 
 from outgrab_tools import *
 
-# Perform startup stuff: parse command line and set logging levels
-startup()
+def main():
+#   Perform startup stuff: parse command line and set logging levels
+    startup()
 
-# Create internal input files from the command line:
-#      one from stdin and optionally others from -i or --inputfiles
-#      Also create the outgrab program file from -p or --program on the command line
-createInputFiles()
+#   With --each, run the program over each of the files given (in parallel) instead of stdin
+    if runbatchfromargs():
+        return
 
-# Create a file for output
-y = OutputFile()
+#   Create internal input files from the command line:
+#        one from stdin and optionally others from -i or --inputfiles
+#        Also create the outgrab program file from -p or --program on the command line
+    createInputFiles()
 
-# Assign input and output files to the outgrab program so it processes the former and writes to the latter
-# Initial focus is on the input file coming from stdin
-x = getfilefromname("$file1")
-z = getfilefromname("program")
-z.setinputfile(x)
-z.setoutputfile(y)
+#   With several programs (-p a.grab b.grab ...), run each of them over the input files just read
+    if runfanoutfromargs():
+        return
 
-# Process the outgrab program file
-z.processcommands()
+#   Create a file for output
+    y = OutputFile()
 
-# Write the results to stdout
-y.writefile()
+#   Assign input and output files to the outgrab program so it processes the former and writes to the latter
+#   Initial focus is on the input file coming from stdin
+    x = getfilefromname("$file1")
+    z = getfilefromname("program")
+    z.setinputfile(x)
+    z.setoutputfile(y)
 
+#   When streaming stdin (-s) or flushing output (-f), send output lines to stdout
+#   as soon as they are final, unless the program needs them all (writefile)
+    setoutputstreaming(y,z)
 
+#   Process the outgrab program file
+    z.processcommands()
+
+#   Write the results to stdout
+    y.writefile()
+
+# the worker processes of --each import this script too (where they are started by spawn
+# rather than fork, e.g. on macOS and Windows), so it only runs when executed directly
+if __name__ == "__main__":
+    main()
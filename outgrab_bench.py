@@ -0,0 +1,252 @@
+#!/usr/bin/python3
+""" Benchmarks for the outgrab interpreter
+    usage:
+    python outgrab_bench.py -n 100000 --save results.json
+    python outgrab_bench.py -n 100000 --baseline results.json
+    -n (optional) number of lines of each generated input file (default 100000)
+    -b (optional) run only these benchmarks (default: all; -l lists them)
+    -r (optional) run each benchmark this many times and keep the fastest (default 3)
+    -a (optional) extra outgrab options for every run, e.g. -a "-e buffer -c"
+       (a single option is written -a=-c, so that it is not taken as an option here)
+    -d (optional) directory for the generated inputs (reused while they exist)
+    --save (optional) write the results to this JSON file
+    --baseline (optional) compare with the results saved in this JSON file; exits with
+       status 1 if a benchmark is more than --tolerance (default 0.2 = 20%) slower or bigger
+    Generates reproducible input files (a log, a fixed-width table, multi-line records),
+    runs outgrab.py over them with one small program per command family, and reports
+    the time, input lines per second and peak memory (RSS) of each run
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+outgrabscript = os.path.join(here,"outgrab.py")
+
+# first and last lines of every generated input, for searches that go all the way through
+firstline = "sentinel-start"
+lastline = "sentinel-end"
+# every recordfailed-th record of the records input has status failed
+recordlines = 6
+recordfailed = 10
+
+def genlog(i,rng):
+#   one line of a server log; about 1% are errors
+    level = "ERROR" if rng.random() < 0.01 else rng.choice(("INFO ","INFO ","INFO ","DEBUG","WARN "))
+    return "2026-01-{:02d}T{:02d}:{:02d}:{:02d}.{:03d} host{:02d} {} worker[{}]: request {} done in {} ms".format(
+           1 + i // 86400000 % 28,i // 3600000 % 24,i // 60000 % 60,i // 1000 % 60,i % 1000,
+           rng.randrange(32),level,rng.randrange(1000),i,rng.randrange(2000))
+
+def gentable(i,rng):
+#   one row of a fixed-width table of numbers
+    return "{:>10d} {:<12s} {:12.4f} {:12.4f} {:12.4f} {:>4s}".format(
+           i,"atom{}".format(rng.randrange(100)),rng.uniform(-100,100),rng.uniform(-100,100),
+           rng.uniform(-100,100),rng.choice(("C","H","O","N")))
+
+def genrecord(i,rng):
+#   line i of a file of multi-line records (recordlines lines each)
+    record,part = divmod(i,recordlines)
+    if part == 0:
+        return "BEGIN RECORD {}".format(record)
+    if part == 1:
+        return "  id = {}".format(record)
+    if part == 2:
+        return "  energy = {:.6f}".format(rng.uniform(-1000,0))
+    if part == 3:
+        return "  status = {}".format("failed" if record % recordfailed == 0 else "ok")
+    if part == 4:
+        return "  comment = step {} of run {}".format(rng.randrange(10000),rng.randrange(100))
+    return "END RECORD {}".format(record)
+
+generators = {"log": genlog, "table": gentable, "records": genrecord}
+
+def makeinput(kind,nlines,datadir,seed=1):
+#   the path of a generated input of kind with nlines lines (between the sentinels),
+#   written the first time it is needed.  The same seed gives the same file.
+    path = os.path.join(datadir,"{}_{}.txt".format(kind,nlines))
+    if os.path.exists(path):
+        return path
+    print("generating {}".format(path),file=sys.stderr)
+    rng = random.Random(seed)
+    gen = generators[kind]
+    partial = path + ".part"
+    with open(partial,"w") as f:
+        f.write(firstline + "\n")
+        for start in range(0,nlines,10000):
+            f.write("\n".join(gen(i,rng) for i in range(start,min(start + 10000,nlines))) + "\n")
+        f.write(lastline + "\n")
+    os.replace(partial,path)
+    return path
+
+def makeinclude(nlines,datadir):
+#   a program of nlines//10 print commands for the include benchmark
+    path = os.path.join(datadir,"include_{}.grab".format(nlines))
+    if not os.path.exists(path):
+        with open(path,"w") as f:
+            for i in range(max(1,nlines // 10)):
+                f.write("print included line {}\n".format(i))
+    return path
+
+# name: (input, program, number of input lines the program goes through, as a function of n)
+# programs are format strings; {n} is the number of lines, {records} the number of failed
+# records, {include}, {table} and {output} the paths of other files
+benchmarks = {
+    "load":           ("log", "goto bottom\ndumpline\n", lambda n: n),
+    "match":          ("log", "repeat 5\ngoto top\nmatch " + lastline + "\nendrepeat\ndumpline\n",
+                       lambda n: 5*n),
+    "matchback":      ("log", "repeat 5\ngoto bottom\nmatch " + firstline + " direction -1\nendrepeat\ndumpline\n",
+                       lambda n: 5*n),
+    "matchnextdump":  ("log", "matchnextdump ERROR nfind all\n", lambda n: n),
+    "dumpsection":    ("log", "dumpsection top bottom\n", lambda n: n),
+    "dumpuntilmatch": ("log", "dumpuntilmatch " + lastline + "\n", lambda n: n),
+    "fields":         ("table", "next\nrepeat {half}\nholdfields $field2\nnext\ndumpfields $hold1 $field3 1:10 30:42\nendrepeat\n",
+                       lambda n: n),
+    "extractfields":  ("log", "extractfields INFO $field1 $field3 1:10\n", lambda n: n),
+    "records":        ("records", "repeat {records}\nmatch failed\ndumpfields $field2 $field3\nendrepeat\n",
+                       lambda n: n),
+    "include":        ("log", "include {include}\n", lambda n: max(1,n // 10)),
+    "readinput":      ("log", "readinput {table}\nswitchinputto $file2\nmatch " + lastline + "\ndumpline\n",
+                       lambda n: 2*n),
+    "writefile":      ("log", "dumpsection top bottom\nwritefile output {output}\n", lambda n: n),
+    "joinlast":       ("log", "repeat 2000\ndumpline\nnext\nendrepeat\nrepeat 1500\njoinlast +\nendrepeat\n",
+                       lambda n: min(n,2000)),
+}
+# outgrab options some benchmarks always run with (before those of -a): joinlast checks
+# that output written while the program runs does not reach back into lines already written
+benchmarkoptions = {
+    "joinlast":       ["-f","--writebatch","10"],
+}
+
+def runonce(program,inputpath,outgrabargs,workdir):
+#   run outgrab.py with program over inputpath: return (seconds, peak RSS in KB or None)
+    command = [sys.executable,outgrabscript] + outgrabargs + ["-p",program]
+#   stderr goes to a file rather than a pipe, which a run writing a lot to it (--profile,
+#   -v) would fill up and then wait on, as nothing reads it until the run is over
+    with open(inputpath) as stdin, tempfile.TemporaryFile() as stderr:
+        start = time.perf_counter()
+        proc = subprocess.Popen(command,stdin=stdin,stdout=subprocess.DEVNULL,
+                                stderr=stderr,cwd=workdir)
+        if hasattr(os,"wait4"):
+            pid,status,usage = os.wait4(proc.pid,0)
+            elapsed = time.perf_counter() - start
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            peak = usage.ru_maxrss // 1024 if sys.platform == "darwin" else usage.ru_maxrss
+        else:
+            proc.wait()
+            elapsed = time.perf_counter() - start
+            peak = None
+        stderr.seek(0)
+        error = stderr.read().decode(errors="replace").strip()
+#   outgrab stops with a last line starting "stopping"; messages (-v) may come before it
+    lastline = error.rpartition("\n")[2]
+    if proc.returncode != 0 or lastline.startswith("stopping"):
+        sys.exit("stopping: benchmark program {} failed: {}".format(program,lastline))
+    return elapsed,peak
+
+def runbenchmark(name,nlines,datadir,outgrabargs,repeat):
+#   run benchmark name repeat times; return its result (fastest time, largest RSS)
+    kind,template,work = benchmarks[name]
+    inputpath = makeinput(kind,nlines,datadir)
+    program = os.path.join(datadir,"bench_{}.grab".format(name))
+    with open(program,"w") as f:
+        f.write(template.format(n=nlines,half=nlines // 2 - 1,
+                                records=(nlines // recordlines - 1) // recordfailed + 1,
+                                include=makeinclude(nlines,datadir),
+                                table=makeinput("table",nlines,datadir),
+                                output=os.path.join(datadir,"bench_output.txt")))
+    times = []
+    peaks = []
+    for i in range(repeat):
+        elapsed,peak = runonce(program,inputpath,benchmarkoptions.get(name,[]) + outgrabargs,datadir)
+        times.append(elapsed)
+        peaks.append(peak)
+    seconds = min(times)
+    return {"seconds": round(seconds,4),
+            "lines": work(nlines),
+            "lines_per_second": round(work(nlines)/seconds),
+            "peak_rss_kb": max(peaks) if None not in peaks else None}
+
+def compare(results,baseline,tolerance):
+#   print how results compare with baseline; return the names of those that got worse
+    worse = []
+    print("\n{:16s} {:>10s} {:>10s} {:>8s} {:>10s}".format("vs baseline","seconds","before","ratio","rss ratio"))
+    for name,result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        ratio = result["seconds"]/before["seconds"] if before["seconds"] else 1.0
+        rssratio = None
+        if result["peak_rss_kb"] and before.get("peak_rss_kb"):
+            rssratio = result["peak_rss_kb"]/before["peak_rss_kb"]
+        flag = ""
+        if ratio > 1 + tolerance or (rssratio is not None and rssratio > 1 + tolerance):
+            flag = "  WORSE"
+            worse.append(name)
+        elif ratio < 1 - tolerance:
+            flag = "  better"
+        print("{:16s} {:10.3f} {:10.3f} {:8.2f} {:>10s}{}".format(name,result["seconds"],before["seconds"],ratio,
+              "{:.2f}".format(rssratio) if rssratio is not None else "-",flag))
+    return worse
+
+def getparser():
+    parser = argparse.ArgumentParser(description=__doc__,
+                            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n","--lines",type=int,default=100000,
+                        help='number of lines of each generated input (default 100000)')
+    parser.add_argument("-b","--benchmarks",nargs='+',choices=list(benchmarks),default=None,
+                        help='benchmarks to run (default: all)')
+    parser.add_argument("-l","--list",action="store_true",help='list the benchmarks and stop')
+    parser.add_argument("-r","--repeat",type=int,default=3,
+                        help='runs of each benchmark; the fastest is kept (default 3)')
+    parser.add_argument("-a","--args",default="",
+                        help='extra outgrab options for every run, e.g. "-e buffer -c" or -a=-c')
+    parser.add_argument("-d","--datadir",default=os.path.join(tempfile.gettempdir(),"outgrab_bench"),
+                        help='directory for the generated inputs')
+    parser.add_argument("--save",default=None,help='write the results to this JSON file')
+    parser.add_argument("--baseline",default=None,help='compare with the results in this JSON file')
+    parser.add_argument("--tolerance",type=float,default=0.2,
+                        help='relative slowdown (or growth of RSS) counted as a regression (default 0.2)')
+    return parser.parse_args()
+
+def main():
+    args = getparser()
+    if args.list:
+        for name,(kind,template,work) in benchmarks.items():
+            print("{:16s} {:8s} {}{}".format(name,kind,template.strip().replace("\n"," / "),
+                  "  ({})".format(" ".join(benchmarkoptions[name])) if name in benchmarkoptions else ""))
+        return 0
+    os.makedirs(args.datadir,exist_ok=True)
+    names = args.benchmarks or list(benchmarks)
+    outgrabargs = args.args.split()
+    results = {}
+    print("{:16s} {:>10s} {:>12s} {:>10s}".format("benchmark","seconds","lines/s","peak KB"))
+    for name in names:
+        result = runbenchmark(name,args.lines,args.datadir,outgrabargs,max(1,args.repeat))
+        results[name] = result
+        print("{:16s} {:10.3f} {:12d} {:>10}".format(name,result["seconds"],result["lines_per_second"],
+              result["peak_rss_kb"] if result["peak_rss_kb"] is not None else "-"))
+        sys.stdout.flush()
+    if args.save:
+        with open(args.save,"w") as f:
+            json.dump({"lines": args.lines, "args": args.args, "python": platform.python_version(),
+                       "machine": platform.machine(), "results": results},f,indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("lines") != args.lines or baseline.get("args") != args.args:
+            print("warning: baseline was run with -n {} -a \"{}\"".format(baseline.get("lines"),baseline.get("args")))
+        worse = compare(results,baseline["results"],args.tolerance)
+        if worse:
+            print("slower or bigger than the baseline: {}".format(" ".join(worse)))
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,6 +3,7 @@
 
 import argparse
 import logging
+import os
 
 def getparser():
     """Get parser object. """
@@ -16,9 +17,61 @@ def getparser():
                         help='input file(s) to be processed as individuals')
     parser.add_argument("-p","--program",
                         type=argparse.FileType('r'),
-                        nargs='?',
+                        nargs='+',
                         default="default.grab",
-                        help='outgrab program file to be run on the input file(s)')
+                        help='outgrab program file(s) to be run on the input file(s); several programs share the input')
+    parser.add_argument("-e","--engine",
+                        choices=("lines","buffer","trigram"),
+                        default="lines",
+                        help='search engine for forward matches: line by line, over the whole file at once, or through a trigram index of the lines')
+    parser.add_argument("-s","--stream",
+                        action="store_true",
+                        help='read stdin lazily and write output as it is produced (forward-only programs)')
+    parser.add_argument("-w","--lookbehind",
+                        type=int,
+                        default=1000,
+                        help='with --stream, number of lines behind the current line kept in memory')
+    parser.add_argument("-m","--mmap",
+                        action="store_true",
+                        help='memory-map input files and decode lines only when they are used')
+    parser.add_argument("-c","--compact",
+                        action="store_true",
+                        help='keep input files as one block of text plus the position of each line, using much less memory per line')
+    parser.add_argument("-x","--indexcache",
+                        nargs='?',
+                        const=defaultindexcache(),
+                        default=None,
+                        help='with --mmap (implied), save line indexes of input files in this directory and reuse them while the files are unchanged')
+    parser.add_argument("--each",
+                        nargs='+',
+                        metavar="FILE",
+                        help='run the program separately over each of these files (or quoted glob patterns) instead of stdin')
+    parser.add_argument("-j","--jobs",
+                        type=int,
+                        default=None,
+                        help='with --each or several programs, number of worker processes (default: one per CPU)')
+    parser.add_argument("-o","--outputsuffix",
+                        default=None,
+                        help='with --each, write the output for each file to its name plus this suffix instead of to stdout; with several programs, the output of each program name.grab to name plus this suffix')
+    parser.add_argument("-f","--flush",
+                        action="store_true",
+                        help='write output lines while the program runs, as soon as they can no longer change')
+    parser.add_argument("--writebatch",
+                        type=int,
+                        default=10000,
+                        help='number of output lines written at a time')
+    parser.add_argument("--spill",
+                        type=float,
+                        default=None,
+                        metavar="MB",
+                        help='keep only about this many megabytes (millions of characters) of each output and scratch file in memory, moving older lines to temporary files')
+    parser.add_argument("--scanjobs",
+                        type=int,
+                        default=1,
+                        help='number of processes searching a large input file for matchnextdump ... nfind all')
+    parser.add_argument("--profile",
+                        action="store_true",
+                        help='report, on stderr, the executions, time, input lines searched and output lines of each program line')
     parser.add_argument("-v","--verbosity",
                         type=int,
                         nargs='?',
@@ -28,9 +81,15 @@ def getparser():
     parserargs = parser.parse_args()
     return parserargs
 
+def defaultindexcache():
+# directory for saved line indexes if -x is given without one
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"),".cache")
+    return os.path.join(base,"outgrab")
+
 def setlogging(myloglevel,names):
 # Set up logging levels and configure logging messages
-# arguments are logging level to use, and a list or tuple of names of logging levels
+# arguments are logging level to use (None leaves the level as it is), and a list or
+# tuple of names of logging levels
 # the first one is assigned level 1 (most verbose), the second 2, and so on
 # returns logging object, maximum logging level, tuple of levels
 # use like: (msg,maxlevel,(verbose,notverbose,)) = setlogging(myloglevel,("verbose","notverbose"))
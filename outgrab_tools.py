@@ -42,61 +42,645 @@ import sys
 import os
 import re
 import logging
+import functools
+import collections
+import bisect
+import locale
+import mmap
+import stat
+import json
+import hashlib
+import tempfile
+import itertools
+import time
+import copy
+import multiprocessing
+import io
+import glob
+import concurrent.futures
+import csv
+import gzip
+import bz2
+import lzma
+import threading
+import queue
+import asyncio
+import contextvars
+from array import array
+try:                                    # python 3.11+
+    import re._parser as sre_parse
+except ImportError:
+    import sre_parse
 from outgrab_startup import getparser, setlogging, setverbositylevels
 
 
 # global variables related to messaging
-verbosity = 0
 maxlevel = 4
 ogdebug = 0
 ogverbose = 0
 oginfo = 0
 ogmain = 0
 parserargs = ""
-msg = ""
-# and a global dictionary to hold the internal files by their names
-ifilesd = {}
+# lowest logging level emitted by msg in the default session or any session current in
+# some thread or task (see updatemsglevel); above maxlevel means silent, so that msg
+# costs one comparison when no session is logging
+msglevel = maxlevel + 1
+# the sessions current in some thread or task, with the number of times each was entered
+activesessions = collections.Counter()
+activelock = threading.Lock()
+# the settings of a run (search engine, streaming, ...) and its internal files are kept
+# by a Session; see the class below
+searchengines = ("lines","buffer","trigram")
+# parallel scans (--scanjobs) give each worker process ranges of at least scanchunklines lines
+scanchunklines = 100000
+# the lines being scanned in parallel, inherited by the (forked) worker processes;
+# one scan at a time in this process sets it (scanlock)
+scanlines = None
+scanlock = threading.Lock()
+# in a batch run (--each) with several jobs, the program lines and the extra (-i) input
+# file names of each worker process (see runbatch)
+batchprogram = []
+batchextrainputs = ()
+# in a fan-out run (several programs) with several jobs, the program lines, the input files
+# loaded once for all of them and their session, inherited by the forked worker processes
+# (see runfanout); one fan-out at a time in this process sets them (fanoutlock)
+fanoutprograms = []
+fanoutinputs = []
+fanoutsession = None
+fanoutlock = threading.Lock()
+# the coroutines (arunoutgrab, Session.arun, ...) read and write files and search the
+# input on a pool of at most asyncworkers threads (see asyncexecutor), and let other tasks
+# run after every asyncyieldwork units of work of a program: one per command, plus one per
+# input line a command moves over (see ProgramFile.aprocesscommands)
+asyncworkers = 4
+asyncpool = None
+asyncyieldwork = 1000
 #standard filename prefix; use with a postfix number in addfilename
 filebase = "$file"
 
+class OutgrabError(Exception):
+#   a run of a Session (or an Engine job) stopped: outgrab's "stopping: ..." message
+    pass
+
+class Session:
+#   The state of one outgrab run: its internal files by name (files; the ifilesd of the
+#   default session), the output files writing their lines as they go, the settings of
+#   the command-line options and where messages go (logger, default the logging module).
+#   Internal files belong to the session that is current when they are created (their
+#   session attribute), and the module-level functions work in the current session.
+#   Each thread (and each asyncio task) has its own current session: defaultsession (which
+#   outgrab.py configures with startup) until another one is entered with "with session:".
+#   So independent sessions can run in threads of one process at the same time (see
+#   Engine), or as tasks of an event loop (see arun).
+#   e.g.
+#       output = Session(engine="buffer").run("report.grab",["simulation.output"])
+#       output = await Session(engine="buffer").arun("report.grab",["simulation.output"])
+
+    def __init__(self,logger=None,**options):
+        self.files = {}
+        self.streamoutputs = []         # output files writing as they go (see OutputFile.setstream)
+        self.logger = logger
+        self.verbosity = 0
+        self.msglevel = maxlevel + 1    # lowest logging level emitted; above maxlevel is silent
+        self.searchengine = "lines"     # for forward matches in new input files (see setsearchengine)
+        self.streammode = False         # stdin read lazily as a StreamInputFile (-s)
+        self.streamlookbehind = 1000    # lines kept behind the current line when streaming
+        self.mmapinputs = False         # input files on disk memory-mapped (-m)
+        self.indexcache = None          # directory for saved line indexes (-x), or None
+        self.compactinputs = False      # input files kept as PackedLines (-c)
+        self.scanjobs = 1               # processes for matchnextdump ... nfind all (--scanjobs)
+        self.flushmode = False          # output written while the program runs (--flush)
+        self.writebatch = 10000         # lines written at a time
+        self.spillsize = None           # characters of output kept in memory (--spill), or None
+        self.profiling = False          # per-line profile of programs (--profile)
+        self.entered = []               # tokens to restore the session current before each "with self"
+        if options:
+            self.configure(**options)
+
+    def __enter__(self):
+        self.entered.append(sessionvar.set(self))
+        with activelock:
+            activesessions[self] += 1
+        updatemsglevel()
+        return self
+
+    def __exit__(self,*exc):
+        sessionvar.reset(self.entered.pop())
+        with activelock:
+            activesessions[self] -= 1
+            if activesessions[self] <= 0:
+                del activesessions[self]
+        updatemsglevel()
+
+    def configure(self,**options):
+#       change settings, by the names of the command-line options: verbosity, engine,
+#       stream, lookbehind, mmap, indexcache, compact, scanjobs, flush, writebatch,
+#       spill and profile (see sessionoptions)
+        unknown = set(options) - set(sessionoptions) - {"verbosity"}
+        if unknown:
+            raise TypeError("unknown outgrab options {}".format(", ".join(sorted(unknown))))
+        with self:
+            if "verbosity" in options:
+                self.verbosity = options["verbosity"]
+                setuplogging()
+            for name,value in options.items():
+                if name != "verbosity":
+                    sessionoptions[name](value)
+        return self
+
+    def settings(self):
+#       the options (see configure) that give a session the same settings as this one
+        return {"verbosity": self.verbosity, "engine": self.searchengine, "stream": self.streammode,
+                "lookbehind": self.streamlookbehind, "mmap": self.mmapinputs,
+                "indexcache": self.indexcache, "compact": self.compactinputs,
+                "scanjobs": self.scanjobs, "flush": self.flushmode, "writebatch": self.writebatch,
+                "spill": None if self.spillsize is None else self.spillsize/1000000,
+                "profile": self.profiling}
+
+    def derive(self):
+#       a new session, with no files, with the settings and logger of this one
+        return Session(logger=self.logger,**self.settings())
+
+    def log(self,level,message):
+        if self.logger is not None:
+            self.logger.log(level,message)
+        elif self is defaultsession:
+            logging.log(level,message)
+        else:
+#           msg has checked level against this session's msglevel already; the level of
+#           the root logger is the default session's, so pass the message straight to its handlers
+            root = logging.getLogger()
+            root.handle(root.makeRecord(root.name,level,"",0,message,None,None))
+
+    def run(self,program,inputfiles=(),outputfile=None):
+        """ Run an outgrab program (a path, an open file or a list of lines) in this
+            session over inputfiles, which become $file1, $file2, ...: paths, or input
+            files already loaded (e.g. by Engine.load), which are shared, not copied
+            (see InputFile.sharedcopy).  With outputfile the output is written there and
+            None is returned, otherwise the output is returned as a string.
+            Raises OutgrabError if the program stops with an error.
+        """
+        with self:
+            try:
+                programlines = self.addfiles(program,inputfiles)
+                return runprogramlines(programlines,outputfile)
+            except SystemExit as err:
+                raise OutgrabError(str(err)) from None
+
+    async def arun(self,program,inputfiles=(),outputfile=None,executor=None,yieldwork=None):
+        """ The same as run, for a coroutine: the program and input files are read, the
+            output written and the input searched on executor (default asyncexecutor()),
+            and the program lets other tasks run every yieldwork units of its work (see
+            ProgramFile.aprocesscommands), so that the event loop is never held for long.
+        """
+        with self:
+            try:
+                programlines = await inthread(self.addfiles,program,inputfiles,executor=executor)
+                return await arunprogramlines(programlines,outputfile,executor,yieldwork)
+            except SystemExit as err:
+                raise OutgrabError(str(err)) from None
+
+    def addfiles(self,program,inputfiles):
+#       (in this session) forget its files and read inputfiles as $file1, $file2, ...,
+#       sharing those already loaded; return the lines of program
+        if isinstance(program,(list,tuple)):
+            programlines = list(program)
+        else:
+            programlines = readprogramlines(program)
+        resetfiles()
+        for filenum,myfile in enumerate(inputfiles,1):
+            if isinstance(myfile,InputFile):
+                mycopy = myfile.sharedcopy()
+                mycopy.session = self
+                addfilename(mycopy,filebase,filenum)
+            else:
+                readinputfile(myfile,filenum)
+        if not inputfiles:
+            addfilename(createInputFile([],InputFile),filebase,1)
+        return programlines
+
+# the current session of each thread or asyncio task (see Session); defaultsession where
+# none was entered
+sessionvar = contextvars.ContextVar("outgrabsession",default=None)
+defaultsession = Session()
+# the internal files of the default session by their names
+ifilesd = defaultsession.files
+
+def currentsession():
+#   the Session the module-level functions of this thread or task work in
+    return sessionvar.get() or defaultsession
+
+class Engine:
+#   Runs outgrab programs as independent jobs on a pool of threads in this process, each
+#   job in a new Session with the engine's options (see Session.configure) and logger.
+#   Input files loaded with load are read once and shared by all the jobs that use them.
+#   e.g.
+#       with Engine(jobs=8,engine="buffer") as engine:
+#           engine.load("big.log")
+#           futures = [engine.submit(program,["big.log"]) for program in programs]
+#           outputs = [future.result() for future in futures]
+
+    def __init__(self,jobs=None,logger=None,**options):
+        Session(**options)      # check the options now rather than in every job
+        self.options = options
+        self.logger = logger
+        self.jobs = jobs or os.cpu_count() or 1
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs)
+        self.inputs = {}        # the loaded input files by path
+        self.loadlock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+    def session(self):
+#       a new session for a job
+        return Session(logger=self.logger,**self.options)
+
+    def load(self,path):
+#       read input file path now, for all the jobs that name it (it is then read only and
+#       must not change); lazy reading (-m, -s) does not apply, as the lines are shared
+        with self.loadlock:
+            if path not in self.inputs:
+                session = self.session().configure(mmap=False,stream=False)
+                with session:
+                    try:
+                        readinputfile(path,1)
+                    except SystemExit as err:
+                        raise OutgrabError(str(err)) from None
+                self.inputs[path] = session.files[filebase + "1"]
+            return self.inputs[path]
+
+    def run(self,program,inputfiles=(),outputfile=None):
+#       run a job now, in this thread: see Session.run.  Loaded inputs are shared
+        inputfiles = [self.inputs.get(myfile,myfile) if isinstance(myfile,str) else myfile
+                      for myfile in inputfiles]
+        return self.session().run(program,inputfiles,outputfile)
+
+    def submit(self,program,inputfiles=(),outputfile=None):
+#       run a job on the pool; returns a concurrent.futures.Future of what run returns
+        return self.pool.submit(self.run,program,inputfiles,outputfile)
+
+    def close(self):
+#       wait for the submitted jobs and stop the pool
+        self.pool.shutdown()
+
 #
 # module level functions
 #
 
+def msg(level,message,*args):
+#   log message at level (ogdebug, ogverbose, oginfo, ogmain).
+#   If args are given, message is a format string filled in with them; formatting is
+#   only done if the level is emitted, so callers should pass arguments rather than
+#   preformatted strings: msg(ogdebug,"line {}",x) costs one comparison when silent.
+    if level >= msglevel:
+        session = currentsession()
+        if level >= session.msglevel:
+            if args:
+                message = message.format(*args)
+            session.log(level,message)
+
+def setmsglevel(myloglevel):
+#   set the lowest logging level emitted by msg in the current session (and, for the
+#   default session, by the root logger of the logging module)
+    session = currentsession()
+    session.msglevel = myloglevel
+    updatemsglevel()
+    if session is defaultsession and session.logger is None:
+        logging.getLogger().setLevel(myloglevel)
+
+def updatemsglevel():
+#   set msglevel to the lowest level emitted by the default session or a session that is
+#   current now, so that it goes back up when a more verbose session is done
+    global msglevel
+    with activelock:
+        levels = [session.msglevel for session in activesessions]
+        levels.append(defaultsession.msglevel)
+        msglevel = min(levels)
+
 def startup():
 # Set up command line parsing; get verbosity level from command line
     global parserargs
-    global verbosity, maxlevel
     parserargs = getparser()
+#   -p can name several programs (see runfanout); parserargs.program is the first
+    if isinstance(parserargs.program,list):
+        parserargs.programs = parserargs.program
+        parserargs.program = parserargs.programs[0] if parserargs.programs else None
+    else:
+        parserargs.programs = [parserargs.program]
 
-    verbosity = parserargs.verbosity
+    currentsession().verbosity = parserargs.verbosity
     setuplogging()
+    setsearchengine(parserargs.engine)
+    setstreammode(parserargs.stream,parserargs.lookbehind)
+    setmmapinputs(parserargs.mmap)
+    setindexcache(parserargs.indexcache)
+    setcompactinputs(parserargs.compact)
+    setscanjobs(parserargs.scanjobs)
+    setflushmode(parserargs.flush,parserargs.writebatch)
+    setspillsize(parserargs.spill)
+    setprofiling(parserargs.profile)
     return
 
 def setuplogging():
-    global msg
     global ogdebug, ogverbose, oginfo, ogmain
     # Set up logging levels from most verbose to least.
-    myloglevel = setverbositylevels(verbosity,verbosity_default=2)
+    session = currentsession()
+    myloglevel = setverbositylevels(session.verbosity,verbosity_default=2)
     myloglevelnames = ("ogdebug","ogverbose","oginfo","ogmain")
-    (msg, maxlevel, (   ogdebug,  ogverbose,  oginfo,  ogmain)) = setlogging(myloglevel,myloglevelnames)
+#   only the default session sets the level of the root logger (see Session.log)
+    rootlevel = myloglevel if session is defaultsession else None
+    (logfunction, maxlevel, (   ogdebug,  ogverbose,  oginfo,  ogmain)) = setlogging(rootlevel,myloglevelnames)
+    setmsglevel(myloglevel)
     
     #Demonstration/Test of logging.
     #Only those with log(verbosity) level >=(<=) loglevel(verbosity) should be printed.
-    msg(ogmain,   "printing status messages at verbosity level {} (ogmain)".format(maxlevel-ogmain+1))
-    msg(oginfo,   "printing status messages at verbosity level {} (oginfo)".format(maxlevel-oginfo+1))
-    msg(ogverbose,"printing status messages at verbosity level {} (ogverbose)".format(maxlevel-ogverbose+1))
-    msg(ogdebug,  "printing  debug messages at verbosity level {} (ogdebug)".format(maxlevel-ogdebug+1))
+    msg(ogmain,   "printing status messages at verbosity level {} (ogmain)",maxlevel-ogmain+1)
+    msg(oginfo,   "printing status messages at verbosity level {} (oginfo)",maxlevel-oginfo+1)
+    msg(ogverbose,"printing status messages at verbosity level {} (ogverbose)",maxlevel-ogverbose+1)
+    msg(ogdebug,  "printing  debug messages at verbosity level {} (ogdebug)",maxlevel-ogdebug+1)
+
+def setsearchengine(engine):
+#   choose the search engine ("lines", "buffer" or "trigram") used by input files created from now on
+    if engine not in searchengines:
+        sys.exit("stopping: search engine must be one of {}".format(searchengines))
+    currentsession().searchengine = engine
+    msg(oginfo,"Using search engine {}",engine)
+
+def setstreammode(stream,lookbehind=None):
+#   turn streaming of stdin on or off, optionally setting the look-behind window (in lines)
+    session = currentsession()
+    session.streammode = stream
+    if lookbehind is not None:
+        session.streamlookbehind = lookbehind
+    if stream:
+        msg(oginfo,"Streaming stdin with a look-behind window of {} lines",session.streamlookbehind)
+
+def streaminput():
+#   True if stdin is being streamed (see setstreammode)
+    return currentsession().streammode
+
+def setflushmode(flush,batch=None):
+#   turn on or off writing the output while the program runs (see OutputFile.setstream),
+#   optionally setting the number of lines written at a time
+    session = currentsession()
+    session.flushmode = flush
+    if batch is not None:
+        session.writebatch = max(1,batch)
+    if flush:
+        msg(oginfo,"Writing output as it is produced, {} lines at a time",session.writebatch)
+
+def setspillsize(megabytes):
+#   let output and scratch files created from now on keep only about megabytes (millions
+#   of characters) of their lines in memory (see SpillLines); None keeps them all
+    spillsize = None if megabytes is None else int(megabytes*1000000)
+    currentsession().spillsize = spillsize
+    if spillsize is not None:
+        msg(oginfo,"Moving output beyond {} characters to temporary files",spillsize)
+
+def newlinelist(lines=()):
+#   the list of lines for a new output or scratch file: a SpillLines if they are to
+#   be moved to disk when large (see setspillsize), otherwise a list
+    spillsize = currentsession().spillsize
+    if spillsize is None:
+        return list(lines)
+    return SpillLines(lines,spillsize)
+
+def flushoutput():
+#   True if the output is to be written while the program runs (see setflushmode)
+    return currentsession().flushmode
+
+def setoutputstreaming(outfile,program,fileh=sys.stdout):
+#   when streaming stdin or flushing output, let outfile write its lines to fileh as soon as
+#   program can no longer change them (see OutputFile.setstream), unless it needs them all
+    session = currentsession()
+    if not (session.streammode or session.flushmode):
+        return
+    problem = program.readsoutput()
+    if problem:
+        msg(oginfo,"Writing output at the end: {} needs all of it",problem)
+        return
+    problem = program.repeatedtail()
+    if problem:
+        msg(oginfo,"Writing output at the end: {} can change any number of its last lines",problem)
+        return
+    outfile.setstream(fileh,keep=program.outputtail())
+
+def writelines(fileh,lines,batch=None):
+#   write lines (any iterable of strings) to fileh, each followed by a newline,
+#   joining them into one write per batch lines (default writebatch)
+    if batch is None:
+        batch = currentsession().writebatch
+    lines = iter(lines)
+    while True:
+        block = list(itertools.islice(lines,batch))
+        if not block:
+            return
+        block.append("")
+        fileh.write("\n".join(block))
+
+def setmmapinputs(flag):
+#   turn memory-mapping of input files (see MmapInputFile) on or off
+    currentsession().mmapinputs = flag
+    if flag:
+        msg(oginfo,"Memory-mapping input files")
+
+def setindexcache(directory):
+#   save and reuse the line indexes of memory-mapped input files in directory
+#   (see MmapLines); this also turns on memory-mapping.  None turns it off.
+    currentsession().indexcache = directory
+    if directory is not None:
+        setmmapinputs(True)
+        msg(oginfo,"Keeping line indexes in {}",directory)
+
+def setscanjobs(njobs):
+#   search large files in njobs worker processes for matchnextdump ... nfind all
+#   (see parallelmatchinglines); 1 searches them in this process
+    scanjobs = max(1,njobs)
+    currentsession().scanjobs = scanjobs
+    if scanjobs > 1:
+        msg(oginfo,"Scanning large files with {} processes",scanjobs)
+
+def setprofiling(flag):
+#   turn the per-line profile of programs run from now on on or off
+    currentsession().profiling = flag
+
+def setcompactinputs(flag):
+#   turn compact storage (see PackedLines) of input files read from now on on or off
+    currentsession().compactinputs = flag
+    if flag:
+        msg(oginfo,"Keeping input files as packed text")
+
+# the settings of a Session by the names of the command-line options (see Session.configure)
+sessionoptions = {
+    "engine":     setsearchengine,
+    "stream":     setstreammode,
+    "lookbehind": lambda lines: setstreammode(currentsession().streammode,lines),
+    "mmap":       setmmapinputs,
+    "indexcache": setindexcache,
+    "compact":    setcompactinputs,
+    "scanjobs":   setscanjobs,
+    "flush":      setflushmode,
+    "writebatch": lambda lines: setflushmode(currentsession().flushmode,lines),
+    "spill":      setspillsize,
+    "profile":    setprofiling,
+}
+
+# compressed formats read and written transparently: their modules, a pattern for the
+# bytes their data starts with, and the extension of files written in them.  "BZh" alone
+# is plain text, so bzip2 data is recognized by its whole header: a block size digit,
+# then the magic number of the first block (or of the end of an empty stream)
+compressions = (
+    (gzip,re.compile(b"\x1f\x8b"),".gz"),
+    (bz2,re.compile(b"BZh[1-9](?:1AY&SY|\x17rE8P\x90)"),".bz2"),
+    (lzma,re.compile(b"\xfd7zXZ\x00"),".xz"),
+)
+
+def compressionof(fh):
+#   the module (gzip, bz2 or lzma) that decompresses the data about to be read from the
+#   text file fh, from its first bytes (or its extension if they cannot be looked at),
+#   or None if it is not compressed
+    try:
+        head = fh.buffer.peek(10)
+    except (AttributeError,OSError,ValueError):
+        name = getattr(fh,"name","")
+        for module,magic,extension in compressions:
+            if isinstance(name,str) and name.endswith(extension):
+                return module
+        return None
+    for module,magic,extension in compressions:
+        if magic.match(head):
+            return module
+    return None
+
+def opendecompressed(fh):
+#   fh itself, or if its data is compressed, a text file (DecompressedText) with the same
+#   name and encoding that decompresses the data as it is read
+    module = compressionof(fh)
+    if module is None:
+        return fh
+    name = getattr(fh,"name",None)
+    msg(oginfo,"Decompressing {} with {}",name,module.__name__)
+    buffer = getattr(fh,"buffer",None) or open(name,"rb")
+    reader = ReadAhead(module.open(buffer,"rb"),closing=(buffer,fh))
+    return DecompressedText(io.BufferedReader(reader),name,
+                            encoding=getattr(fh,"encoding",None),errors=getattr(fh,"errors",None))
+
+def openoutput(filename):
+#   open filename for writing text, compressed if it has the extension of a compression
+    for module,magic,extension in compressions:
+        if filename.endswith(extension):
+            return module.open(filename,"wt")
+    return open(filename,"w")
+
+class ReadAhead(io.RawIOBase):
+#   A binary stream reading from source (a decompressing file) through a thread that stays
+#   up to depth chunks of chunksize bytes ahead, so that decompression (which runs without
+#   the GIL) overlaps with splitting and processing the lines already read.  Closing it
+#   also closes source and the files in closing (those source reads from).
+
+    def __init__(self,source,closing=(),chunksize=1<<20,depth=4):
+        io.RawIOBase.__init__(self)
+        self.source = source
+        self.closing = closing
+        self.chunks = queue.Queue(depth)
+        self.pending = memoryview(b"")
+        self.finished = False
+        self.stopped = False
+        self.thread = threading.Thread(target=self.fill,args=(chunksize,),daemon=True)
+        self.thread.start()
+
+    def fill(self,chunksize):
+#       the reading thread: put chunks in the queue until the end (b"") or an error
+        try:
+            while not self.stopped:
+                chunk = self.source.read(chunksize)
+                self.chunks.put(chunk)
+                if not chunk:
+                    return
+        except (OSError,EOFError,ValueError,lzma.LZMAError) as err:
+            self.chunks.put(err)
+
+    def readable(self):
+        return True
+
+    def fileno(self):
+        return self.source.fileno()
+
+    def readinto(self,b):
+        if not self.pending:
+            if self.finished:
+                return 0
+            chunk = self.chunks.get()
+            if isinstance(chunk,Exception):
+                self.finished = True
+                sys.exit("stopping: cannot decompress {}: {}".format(getattr(self.closing[-1],"name",""),chunk))
+            if not chunk:
+                self.finished = True
+                return 0
+            self.pending = memoryview(chunk)
+        n = min(len(b),len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+#           stop the thread, emptying the queue in case it is waiting to put a chunk
+            self.stopped = True
+            while self.thread.is_alive():
+                try:
+                    self.chunks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self.source.close()
+            for f in self.closing:
+                f.close()
+        io.RawIOBase.close(self)
+
+class DecompressedText(io.TextIOWrapper):
+#   the text of a compressed file, under the name of the file
+    def __init__(self,buffer,name,**kwargs):
+        io.TextIOWrapper.__init__(self,buffer,**kwargs)
+        self.sourcename = name
+
+    @property
+    def name(self):
+        return self.sourcename
+
+def inputfileclass(fh):
+#   the class to use for an input file read from fh: MmapInputFile if input files are
+#   memory-mapped and fh is a non-empty regular file in an encoding in which "\n" is
+#   the byte b"\n" (MmapLines splits the bytes on it), otherwise InputFile
+    if not currentsession().mmapinputs:
+        return InputFile
+    if isinstance(fh,DecompressedText):
+        msg(oginfo,"cannot memory-map compressed {}; reading it instead",fh.name)
+        return InputFile
+    try:
+        info = os.fstat(fh.fileno())
+        newline = "\n".encode(getattr(fh,"encoding",None) or locale.getpreferredencoding(False))
+    except (AttributeError,OSError,ValueError,LookupError):
+        return InputFile
+    if stat.S_ISREG(info.st_mode) and info.st_size > 0 and newline == b"\n":
+        return MmapInputFile
+    msg(oginfo,"cannot memory-map {}; reading it instead",getattr(fh,"name",fh))
+    return InputFile
 
 def runoutgrab(programfile,verboseness,outputfile,*inputfiles):
    """ function to set up files and launch outgrab from your program
        needs explicit file paths or local names for programfile, outputfile, and 
        an arbitrary number of inputfiles
    """
-   global verbosity
+   with currentsession().derive() as session:
+       session.configure(verbosity=verboseness)
+       runoutgrabfiles(programfile,outputfile,inputfiles)
 
-   verbosity = verboseness
-   setuplogging()
+def runoutgrabfiles(programfile,outputfile,inputfiles):
+#  runoutgrab, in the current session
 
 #  create program file
    filenum = 0
@@ -105,18 +689,18 @@ def runoutgrab(programfile,verboseness,outputfile,*inputfiles):
    pgmfh.close()
    addfilename(x,filebase,filenum)
    addfilename(x,"program")
-   msg(oginfo,"Creating program file with names = {}".format(x.names))
+   msg(oginfo,"Creating program file with names = {}",x.names)
 
 #  create output file
    y = OutputFile()
    addfilename(x,outputfile)
    y.filename = outputfile
-   msg(oginfo,"Creating output file with names: {}".format(y.names))
+   msg(oginfo,"Creating output file with names: {}",y.names)
 
 #   create scratch file
    x = createScratchFile("ScratchFile")
    addfilename(x,"scratch")
-   msg(oginfo,"Creating scratch file with names: {}".format(x.names))
+   msg(oginfo,"Creating scratch file with names: {}",x.names)
 
 #  create input files
    for myfile in inputfiles:
@@ -134,19 +718,266 @@ def runoutgrab(programfile,verboseness,outputfile,*inputfiles):
    z.processcommands()
 
 #  Write the output file
-   outf = open(y.filename,"w") 
+   outf = openoutput(y.filename)
    y.writefile(outf)
    outf.close()
 
+def runbatch(program,inputfiles,jobs=None,outputsuffix=None,extrainputs=(),fileh=sys.stdout):
+    """ Run the outgrab program (a path or an open file) separately over each of
+        inputfiles (paths; each one is $file1 for its run, with extrainputs as $file2,...)
+        in jobs worker processes (default: one per CPU).  The program is read once.
+        With outputsuffix, the output for each input is written to the input's path plus
+        outputsuffix; otherwise the outputs are written to fileh one after another,
+        in the order of inputfiles.
+    """
+    programlines = readprogramlines(program)
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = max(1,min(jobs,len(inputfiles)))
+    outputfiles = [myfile + outputsuffix if outputsuffix else None for myfile in inputfiles]
+    settings = currentsession().settings()
+    msg(oginfo,"Running program over {} input files with {} jobs",len(inputfiles),jobs)
+    if jobs == 1:
+        results = map(functools.partial(runbatchjob,programlines=programlines,extrainputs=extrainputs),
+                      inputfiles,outputfiles)
+        for result in results:
+            if result is not None:
+                fileh.write(result)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs,initializer=initbatchworker,
+                                                initargs=(programlines,extrainputs,settings)) as pool:
+#       map returns the results in the order of inputfiles, whatever order the jobs finish in
+        for result in pool.map(runbatchjob,inputfiles,outputfiles):
+            if result is not None:
+                fileh.write(result)
+
+def initbatchworker(programlines,extrainputs,settings):
+#   set up a worker process to run batch jobs (see runbatch), with the settings (see
+#   Session.settings) of the session that started it: a worker started by spawn rather
+#   than fork has none of its own
+    global batchprogram, batchextrainputs
+    batchprogram = programlines
+    batchextrainputs = tuple(extrainputs)
+    currentsession().configure(**settings)
+
+def runbatchjob(inputfile,outputfile=None,programlines=None,extrainputs=None):
+#   one job of a batch run: run the program (default: the batch program of this worker)
+#   with inputfile as $file1 and extrainputs as $file2,...  Writes the output to outputfile
+#   if given, otherwise returns it as a string
+    if programlines is None:
+        programlines,extrainputs = batchprogram,batchextrainputs
+    resetfiles()
+    try:
+        readinputfile(inputfile,1)
+        for filenum,myfile in enumerate(extrainputs,2):
+            readinputfile(myfile,filenum)
+        return runprogramlines(programlines,outputfile)
+    except SystemExit as err:
+        sys.exit("stopping: {}: {}".format(inputfile,err))
+
+def runfanout(programs,outputfiles=None,jobs=None,fileh=sys.stdout):
+    """ Run several outgrab programs (paths or open files) over the input files already
+        loaded ($file1, $file2, ...), which are read only once for all of them.  Each
+        program has its own current lines, labels, scratch file and output: with
+        outputfiles (one path per program) it is written there, otherwise the outputs are
+        written to fileh one after another, in the order of programs.
+        Where processes can be forked, up to jobs programs (default: one per CPU) run at
+        the same time in worker processes, which inherit the loaded input; otherwise they
+        run one after another.
+    """
+    global fanoutprograms, fanoutinputs, fanoutsession
+    programlines = [readprogramlines(program) for program in programs]
+    inputs = []
+    for fileobj in currentsession().files.values():
+        if isinstance(fileobj,InputFile) and not isinstance(fileobj,(ProgramFile,ScratchFile)) \
+           and fileobj not in inputs:
+            inputs.append(fileobj)
+    if outputfiles is None:
+        outputfiles = [None]*len(programs)
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = max(1,min(jobs,len(programs)))
+    if "fork" not in multiprocessing.get_all_start_methods():
+        jobs = 1
+    msg(oginfo,"Running {} programs over {} input files with {} jobs",len(programs),len(inputs),jobs)
+    if jobs == 1:
+        results = map(functools.partial(runfanoutjob,programs=programlines,inputs=inputs),
+                      range(len(programs)),outputfiles)
+        for result in results:
+            if result is not None:
+                fileh.write(result)
+        return
+    with fanoutlock:
+        fanoutprograms,fanoutinputs,fanoutsession = programlines,inputs,currentsession()
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+                                                        mp_context=multiprocessing.get_context("fork")) as pool:
+                for result in pool.map(runfanoutworker,range(len(programs)),outputfiles):
+                    if result is not None:
+                        fileh.write(result)
+        finally:
+            fanoutprograms,fanoutinputs,fanoutsession = [],[],None
+
+def runfanoutworker(index,outputfile=None):
+#   (in a worker process) run job index of the fan-out run that forked this process
+    with fanoutsession:
+        return runfanoutjob(index,outputfile,fanoutprograms,fanoutinputs)
+
+def runfanoutjob(index,outputfile=None,programs=None,inputs=None):
+#   one job of a fan-out run: run program number index of programs (lists of program lines)
+#   over its own copies (see InputFile.sharedcopy) of the loaded input files inputs.
+#   Writes the output to outputfile if given, otherwise returns it as a string
+    resetfiles()
+    for fileobj in inputs:
+        mycopy = fileobj.sharedcopy()
+        mycopy.session = currentsession()
+        for name in fileobj.names:
+            addfilename(mycopy,name)
+    try:
+        return runprogramlines(programs[index],outputfile)
+    except SystemExit as err:
+        sys.exit("stopping: program {}: {}".format(index + 1,err))
+
+def runprogramlines(programlines,outputfile=None):
+#   run the program made of programlines over the input files registered as $file1,...
+#   with a new output and scratch file.  Writes the output to outputfile if given,
+#   otherwise returns it as a string
+    x = newprogram(programlines)
+    x.processcommands()
+    return writeoutput(x.outfile,outputfile)
+
+async def arunprogramlines(programlines,outputfile=None,executor=None,yieldwork=None):
+#   runprogramlines for a coroutine: the program yields to other tasks as it runs
+#   (see ProgramFile.aprocesscommands) and the output is written on executor
+    x = newprogram(programlines)
+    await x.aprocesscommands(executor=executor,yieldwork=yieldwork)
+    return await inthread(writeoutput,x.outfile,outputfile,executor=executor)
+
+def newprogram(programlines):
+#   the program made of programlines, reading $file1 and writing to a new output file,
+#   with a new scratch file
+    x = createInputFile(programlines,ProgramFile)
+    addfilename(x,filebase,0)
+    addfilename(x,"program")
+    y = OutputFile()
+    s = createScratchFile("Scratch")
+    addfilename(s,"scratch")
+    x.setinputfile(getfilefromname("$file1"))
+    x.setoutputfile(y)
+    return x
+
+def writeoutput(outfile,outputfile=None):
+#   write the output file outfile to the file outputfile and return None, or if outputfile
+#   is not given, return its lines as a string
+    if outputfile:
+        with openoutput(outputfile) as outf:
+            outfile.writefile(outf)
+        return None
+    outf = io.StringIO()
+    outfile.writefile(outf)
+    return outf.getvalue()
+
+def asyncexecutor():
+#   the pool of (at most asyncworkers) threads on which the coroutines read and write files
+#   and search the input
+    global asyncpool
+    if asyncpool is None:
+        asyncpool = concurrent.futures.ThreadPoolExecutor(max_workers=asyncworkers,
+                                                          thread_name_prefix="outgrab")
+    return asyncpool
+
+async def inthread(function,*args,executor=None):
+#   await function(*args), run on executor (default asyncexecutor()) in the current
+#   context, so in the current Session
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(executor or asyncexecutor(),
+                                                            functools.partial(context.run,function,*args))
+
+async def arunoutgrab(programfile,verboseness,outputfile,*inputfiles,executor=None,yieldwork=None):
+    """ runoutgrab for asyncio services: run programfile over inputfiles ($file1, ...)
+        and write the output to outputfile, in a Session of its own (see Session.arun).
+        Files are read and written, and the input searched, on executor (default: a pool
+        of asyncworkers threads), and the program lets the other tasks of the event loop run every yieldwork
+        (default asyncyieldwork) commands or input lines searched.
+        Raises OutgrabError if the program stops with an error.
+    """
+    with currentsession().derive() as session:
+        session.configure(verbosity=verboseness)
+        await session.arun(programfile,inputfiles,outputfile,executor=executor,yieldwork=yieldwork)
+
+def readprogramlines(program):
+#   the lines of an outgrab program given as a path or an open file
+    if isinstance(program,str):
+        with open(program,"r") as f:
+            return f.readlines()
+    with program as f:
+        return f.readlines()
+
+def resetfiles():
+#   forget all internal files, e.g. before running a program over another input
+    session = currentsession()
+    session.files.clear()
+    del session.streamoutputs[:]
+
+def batchinputfiles():
+#   the input files given with --each (patterns expanded, in the order given), or []
+    myfiles = []
+    for pattern in getattr(parserargs,"each",None) or []:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                msg(ogmain,"No input files match {}",pattern)
+            myfiles.extend(matches)
+        else:
+            myfiles.append(pattern)
+    return myfiles
+
+def runbatchfromargs():
+#   if --each was given on the command line, run the program over each of its files
+#   (see runbatch) and return True; otherwise return False
+    inputfiles = batchinputfiles()
+    if not inputfiles:
+        if getattr(parserargs,"each",None):
+            sys.exit("stopping: no input files for --each")
+        return False
+    missing = [myfile for myfile in inputfiles if not os.path.isfile(myfile)]
+    if missing:
+        sys.exit("stopping: cannot read input files {}".format(missing))
+    extrainputs = [f.name for f in parserargs.inputfiles] if parserargs.inputfiles else []
+    if len(parserargs.programs) > 1:
+        sys.exit("stopping: --each runs a single program")
+    runbatch(parserargs.program,inputfiles,jobs=parserargs.jobs,
+             outputsuffix=parserargs.outputsuffix,extrainputs=extrainputs)
+    return True
+
+def runfanoutfromargs():
+#   if several programs were given with -p, run them all over the input files already
+#   created (see runfanout) and return True; otherwise return False.
+#   With -o SUFFIX, the output of program name.grab goes to name + SUFFIX
+    programs = parserargs.programs
+    if len(programs) < 2:
+        return False
+    if currentsession().streammode:
+        sys.exit("stopping: several programs cannot share streamed input; run without --stream")
+    outputfiles = None
+    if parserargs.outputsuffix:
+        outputfiles = [os.path.splitext(os.path.basename(program.name))[0] + parserargs.outputsuffix
+                       for program in programs]
+        if len(set(outputfiles)) < len(outputfiles):
+            sys.exit("stopping: programs with the same name would write the same output file")
+#   the first program has already been read (by createInputFiles), so go by the names
+    runfanout([program.name for program in programs],outputfiles,jobs=parserargs.jobs)
+    return True
+
 def readinputfile(myfile,filenum):
     """ given the path/name of a file, read it in to an internal input file
         give it a name filebase ($file) + str(filenum)
     """
-    fh = open(myfile, "r")
-    x = createInputFile(fh,InputFile)
+    fh = opendecompressed(open(myfile, "r"))
+    x = createInputFile(fh,inputfileclass(fh))
     fh.close()
     addfilename(x,filebase,filenum)    # create the standard filename ($fileN)
-    msg(ogdebug,"Creating input file with names = {}".format(x.names))
+    msg(ogdebug,"Creating input file with names = {}",x.names)
 
 def createInputFiles():
     """Create input files from the command line: from stdin, from --inputfiles,
@@ -154,24 +985,29 @@ def createInputFiles():
     Return them in a dictionary with standard names as keys: names = ("$file1", "$file2", etc. )
     Also give them names name = <stdin>, filename from the command line, or "scratch"
     """
-    global ifilesd 
+    streammode = currentsession().streammode
 
-#   Create InputFile from stdin
+#   Create InputFile from stdin (read lazily in streaming mode)
     msg(oginfo,"Creating input files from stdin")
-    x = createInputFile(sys.stdin,InputFile)
+    stdin = opendecompressed(sys.stdin)
+    if streammode:
+        x = createInputFile(stdin,StreamInputFile)
+    else:
+        x = createInputFile(stdin,inputfileclass(stdin))
     filenum = 1
     addfilename(x,filebase,filenum)
-    msg(oginfo,"Names = {}".format(x.names))
+    msg(oginfo,"Names = {}",x.names)
 
 #   Create any files from input argument "-i" or "--inputfiles"
     if parserargs.inputfiles:
         msg(oginfo,"Creating input files from -i or --inputfiles")
         for myfile in parserargs.inputfiles:
-            msg(ogdebug,"file = {}".format(myfile))
+            msg(ogdebug,"file = {}",myfile)
+            myfile = opendecompressed(myfile)
             filenum += 1
-            x = createInputFile(myfile,InputFile)
+            x = createInputFile(myfile,inputfileclass(myfile))
             addfilename(x,filebase,filenum)
-            msg(oginfo,"Names = {}".format(x.names))
+            msg(oginfo,"Names = {}",x.names)
 
 #   Create outgrab program files from input argument "-p" or "--program"
     if parserargs.program:
@@ -180,22 +1016,27 @@ def createInputFiles():
         x = createInputFile(parserargs.program,ProgramFile)
         addfilename(x,filebase,filenum)
         addfilename(x,"program")
-        msg(oginfo,"Names = {}".format(x.names))
+        msg(oginfo,"Names = {}",x.names)
+        if streammode:
+            problem = x.backwardcommand()
+            if problem:
+                msg(ogmain,"Cannot stream stdin: {}",problem)
+                sys.exit("stopping: program is not forward-only ({}); run without --stream".format(problem))
 
 #   now create one empty file named "scratch" for a scratch space
 #   ignore the original name created
     x = createScratchFile("Scratch")
     addfilename(x,"scratch")
-    msg(oginfo,"Creating scratch file with names: \"{}\"".format(x.names))
+    msg(oginfo,"Creating scratch file with names: \"{}\"",x.names)
 
     msg(ogdebug,"The ifilesd dictionary at end of createInputFiles:")
-    for key,value in ifilesd.items():
-        msg(ogdebug,"name= {}  :  object = {}".format(key,value))
+    for key,value in currentsession().files.items():
+        msg(ogdebug,"name= {}  :  object = {}",key,value)
      
 def createScratchFile(content):
 #   create ScratchFile object
     newfile = ScratchFile(content)
-    msg(ogdebug,"new file object: {}".format(newfile))
+    msg(ogdebug,"new file object: {}",newfile)
     try:
         addfilename(newfile,content.name)
     except:
@@ -205,7 +1046,7 @@ def createScratchFile(content):
 def createInputFile(content,Inp):
 #   create Inp=InputFile or ProgramFile object from filehandler,string, or list of strings
     newfile = Inp(content)
-    msg(ogdebug,"new file object: {}".format(newfile))
+    msg(ogdebug,"new file object: {}",newfile)
 #   add a blank line at the end of the new file (to prevent matches on last line repeating...)
     newfile.addblankline()    # note "bottom" set to line before this blank line
     try:
@@ -215,12 +1056,12 @@ def createInputFile(content,Inp):
     return newfile
 
 def getnextfilenum():
-    """ look through ifilesd for all files named $filexyz (actually filebasexyz)
-        and return the highest int(xyz) + 1: to be used as the next filenum
+    """ look through the files of the current session for all files named $filexyz
+        (actually filebasexyz) and return the highest int(xyz) + 1: to be used as the next filenum
     """
     largest = -1
     start = len(filebase)
-    for key in ifilesd.keys():
+    for key in currentsession().files.keys():
         if key.startswith(filebase):
             oldfilenum = int(key[start:])
             if oldfilenum > largest: largest = oldfilenum
@@ -228,7 +1069,7 @@ def getnextfilenum():
         
 def getfilefromname(name):
 #   returns the internal file object corresponding to myname
-    return ifilesd[name]   
+    return currentsession().files[name]
 
 def samevaluekeys(mykey,mydict):
     sameas = [k for k,v in mydict.items() if v == mydict[mykey]]
@@ -246,17 +1087,16 @@ def listofsamevaluekeys(mydict):
     return dumplist
 
 def addfilename(fileobj,name,postfix=""):
-#   add a name for fileobj to the ifilesd dictionary
+#   add a name for fileobj to the files of the current session
 #   and to the attribute list of names for the object
 #   if postfix is present, it is added to the end of name
 #   (to create standard names like $file1) 
-    global ifilesd
     if isinstance(postfix,int):
         postfix = str(postfix)
     name = name + postfix
-    ifilesd[name] = fileobj
+    currentsession().files[name] = fileobj
     fileobj.names.append(name)
-    msg(oginfo,"Adding name {} for file object {}".format(name,fileobj))
+    msg(oginfo,"Adding name {} for file object {}",name,fileobj)
 
 def setfilename(*names):
 #   give an internal file a new name (old one remains unless you overwrite it)
@@ -270,19 +1110,34 @@ def stringlisttostring(stringlist,delim=" "):
     for mystring in stringlist:     #does this ignore empty strings ("") ?
         result += (mystring + delim)
     result.rstrip()
-    msg(ogdebug,"--in stringlisttostring, result= \"{}\"".format(result))
+    msg(ogdebug,"--in stringlisttostring, result= \"{}\"",result)
     return result   
 
+# regular expressions for the named delimiters of stringtostringlist
+fielddelimiters = {
+    "whitespace": "[\s]+",
+    "comma": "[,]",     # no + so that empty fields are maintained
+}
+
+@functools.lru_cache(maxsize=64)
+def getdelimiter(delim):
+#   return the compiled regular expression for delimiter delim (a name in fielddelimiters
+#   or a regular expression), compiled once
+    return re.compile(fielddelimiters.get(delim,delim))
+
+def splitfields(mystring,delim="whitespace"):
+#   the fields of mystring (stripped) split on delim, as stringtostringlist does;
+#   str.split splits on the same whitespace as [\s]+, only faster
+    if delim == "whitespace":
+        return mystring.split() or [""]
+    return getdelimiter(delim).split(mystring.strip())
+
 def stringtostringlist(mystring,delim="whitespace"):
 #   split mystring into fields based on a regular expression delimiter
 #   returns list of strings
-    msg(ogdebug,"getting fields from string based on delimiter = {}".format(delim))
-    if delim == "whitespace":
-        delim = "[\s]+"                   # regular expression version
-    if delim == "comma":
-        delim = "[,]"   # regular expression version. no + so that empty fields are maintained
-    stringlist = re.split(delim,mystring) # regular expression version
-    msg(ogdebug,"stringtostringlist found {} fields".format(len(stringlist)))
+    msg(ogdebug,"getting fields from string based on delimiter = {}",delim)
+    stringlist = getdelimiter(delim).split(mystring)
+    msg(ogdebug,"stringtostringlist found {} fields",len(stringlist))
     msg(ogdebug,"--list of fields:")
     msg(ogdebug,stringlist)
     return stringlist
@@ -294,19 +1149,19 @@ def getslicelist(mystring,startend):
 #    [(start1,end1),(start2,end2),...]
 #    Returns a list of the resulting string slices
     mylength = len(mystring)
-    msg(ogdebug,"string has {} characters in getslicelist".format(mylength))
+    msg(ogdebug,"string has {} characters in getslicelist",mylength)
     myslices = []
     if mylength == 0: return myslices
     count = 0
     for (start,end) in startend:
         count += 1
         if end > len(mystring):     #short circuit if section too long
-            msg(oginfo,"section {} too long in getslicelist".format(count))
+            msg(oginfo,"section {} too long in getslicelist",count)
             end = len(mystring)
             myslices.append(mystring[start:end+1])
             break
         myslices.append(mystring[start:end+1])
-    msg(ogdebug,"--in getslicelist, captured slices = {}".format(myslices))
+    msg(ogdebug,"--in getslicelist, captured slices = {}",myslices)
     return myslices
 
 def getfielddic(mystring,fieldnameslist,delim="whitespace"):
@@ -323,6 +1178,78 @@ def getfielddic(mystring,fieldnameslist,delim="whitespace"):
     msg(ogdebug,fields)
     return fields
 
+# "$field3" or "$hold12": field and hold names as used by dumpfields and holdfields
+fieldname = re.compile(r"\$(field|hold)([1-9][0-9]*)$")
+
+def nameindex(name,kind):
+#   the list index given by a $fieldN or $holdN name (kind "field" or "hold"), or None
+    found = fieldname.match(name)
+    if found is None or found.group(1) != kind:
+        return None
+    return int(found.group(2)) - 1
+
+class FieldTemplate:
+#   The arguments of a dumpfields or holdfields command, classified once (when the program
+#   line is compiled) into an ordered list of items: ("text",text), ("field",index,arg),
+#   ("slice",start,end) with end inclusive, as in getslicelist, and ("hold",index,arg).
+#   apply then builds the texts for a line in one pass over the items.
+
+    def __init__(self,args):
+        self.items = []
+        for arg in args:
+            if ":" in arg:
+                try:
+                    start,end = arg.split(":")
+                    self.items.append(("slice",int(start) - 1,int(end) - 1))
+                except ValueError:  # a ":" in a text
+                    self.items.append(("text",arg))
+            elif "$field" in arg:
+                self.items.append(("field",nameindex(arg,"field"),arg))
+            elif "$hold" in arg:
+                self.items.append(("hold",nameindex(arg,"hold"),arg))
+            else:
+                self.items.append(("text",arg))
+        self.usesfields = any(item[0] == "field" for item in self.items)
+
+    def apply(self,mytext,fieldlist=None,holdlist=None):
+#       the texts of the items for line mytext, in order.  fieldlist is mytext's fields
+#       (e.g. from InputFile.getfieldlist), split here if not given; holds are taken from
+#       holdlist, and left out if it is None (as holdfields does).  Fields and holds that do
+#       not exist are left out; so are slices of an empty line, and those after the first
+#       slice that reaches past the end of the line (see getslicelist).
+        if self.usesfields and fieldlist is None:
+            fieldlist = splitfields(mytext)
+        texts = []
+        slicing = len(mytext) > 0
+        for item in self.items:
+            kind = item[0]
+            if kind == "text":
+                texts.append(item[1])
+            elif kind == "slice":
+                if slicing:
+                    start,end = item[1],item[2]
+                    texts.append(mytext[start:end+1])
+                    if end > len(mytext):
+                        msg(oginfo,"slice {}:{} too long for the line",start + 1,end + 1)
+                        slicing = False
+            elif kind == "field":
+                index = item[1]
+                if index is not None and index < len(fieldlist):
+                    texts.append(fieldlist[index])
+                else:
+                    msg(ogmain,"problem with field {} ",item[2])
+            elif holdlist is not None:
+                index = item[1]
+                if index is not None and index < len(holdlist):
+                    texts.append(holdlist[index])
+                else:
+                    msg(ogmain,"problem with hold {} ",item[2])
+        msg(ogdebug,"texts from fields, slices and holds: {} ",texts)
+        return texts
+
+    def __repr__(self):
+        return "FieldTemplate({!r})".format(self.items)
+
 def getslicedic(mystring,slicenameslist,startend):
 #   split current line into slices based on startend (see getsliceslist)
 #   returns dictionary with keys = $slice1, $slice2, etc.
@@ -356,7 +1283,7 @@ def translatefields(stringlist,fields=None,slices=None):
                 stringlist[i] = slices[mystring]
             else:
                  stringlist[i] = ""
-    msg(ogdebug,"--in translatefields, final list of strings = {}".format(stringlist))
+    msg(ogdebug,"--in translatefields, final list of strings = {}",stringlist)
     return stringlist
 
 def stringlistfromfields(fieldtypes,texts,slicetexts,fieldtexts,holdtexts=[]):
@@ -381,25 +1308,25 @@ def stringlistfromfields(fieldtypes,texts,slicetexts,fieldtexts,holdtexts=[]):
                 outstringlist.append(texts[textcount])
                 textcount += 1
             else:
-                msg(ogmain,"Ignoring text: only {} available.".format(ntext)) 
+                msg(ogmain,"Ignoring text: only {} available.",ntext) 
         if fieldtype == "slice" and nslice > 0:
             if slicecount <= nslice - 1:
                 outstringlist.append(slicetexts[slicecount])
                 slicecount += 1
             else:
-                msg(ogmain,"Ignoring slice: only {} available.".format(nslice)) 
+                msg(ogmain,"Ignoring slice: only {} available.",nslice) 
         if fieldtype == "field" and nfield > 0:
             if fieldcount <= nfield - 1:
                 outstringlist.append(fieldtexts[fieldcount])
                 fieldcount += 1
             else:
-                msg(ogmain,"Ignoring field: only {} available.".format(nfield)) 
+                msg(ogmain,"Ignoring field: only {} available.",nfield) 
         if fieldtype == "hold" and nhold > 0:
             if holdcount <= nhold - 1:
                 outstringlist.append(holdtexts[holdcount])
                 holdcount += 1
             else:
-                msg(ogmain,"Ignoring hold: only {} available.".format(nhold)) 
+                msg(ogmain,"Ignoring hold: only {} available.",nhold) 
 
     
     return outstringlist
@@ -414,14 +1341,14 @@ def combinequoted(inlist):
        The quotes are removed.
     """
 
-    msg(ogdebug,"In combinequoted, initial tokens = {} ".format(inlist))
+    msg(ogdebug,"In combinequoted, initial tokens = {} ",inlist)
 
     mybegin = False
     myend   = False
     ibegin = -1
     iend   = -1
     quotechar = '"'
-    msg(ogdebug,"In combinequoted, quotechar = {} ".format(quotechar))
+    msg(ogdebug,"In combinequoted, quotechar = {} ",quotechar)
 
 #       find first double quote at beginning of list item
     for i,item in enumerate(inlist):
@@ -437,9 +1364,9 @@ def combinequoted(inlist):
 
     
     if mybegin: 
-        msg(ogdebug,"In combinequoted, found token with beginning quote: {} ".format(inlist[ibegin]))
+        msg(ogdebug,"In combinequoted, found token with beginning quote: {} ",inlist[ibegin])
     if myend: 
-        msg(ogdebug,"In combinequoted, found token with ending quote: {} ".format(inlist[iend]))
+        msg(ogdebug,"In combinequoted, found token with ending quote: {} ",inlist[iend])
 
 #       concatenate all items between quotes
     outlist = []
@@ -457,13 +1384,275 @@ def combinequoted(inlist):
             for i in range(iend+1,len(inlist)):
                 outlist.append(inlist[i])
 
-        msg(ogdebug,"In combinequoted, final tokens = {} ".format(outlist))
+        msg(ogdebug,"In combinequoted, final tokens = {} ",outlist)
         return outlist
 
     else:
         msg(ogdebug,"In combinequoted, no change to tokens because no pair of suitable quote characters")
         return inlist
 
+# characters that make a match string a regular expression rather than plain text
+regexmetachars = frozenset(".^$*+?{}[]\\|()")
+
+class LiteralMatch:
+#   Result of a successful LiteralPattern search; mimics the parts of re.Match outgrab uses
+
+    def __init__(self,pattern,string,start):
+        self.re = pattern
+        self.string = string
+        self.pos = start
+        self.endpos = start + len(pattern.pattern)
+
+    def start(self):
+        return self.pos
+
+    def end(self):
+        return self.endpos
+
+    def span(self):
+        return (self.pos,self.endpos)
+
+    def group(self,*args):
+        return self.string[self.pos:self.endpos]
+
+    def __repr__(self):
+        return "<LiteralMatch object; span={}, match={!r}>".format(self.span(),self.group())
+
+class LiteralPattern:
+#   Stand-in for a compiled regular expression when the match string is plain text
+#   (no regular expression metacharacters): searched with str.find instead of the re engine
+
+    def __init__(self,text):
+        self.pattern = text
+        self.flags = 0
+
+    def search(self,string,pos=0,endpos=None):
+        if endpos is None:
+            idx = string.find(self.pattern,pos)
+        else:
+            idx = string.find(self.pattern,pos,endpos)
+        if idx < 0:
+            return None
+        return LiteralMatch(self,string,idx)
+
+    def __repr__(self):
+        return "LiteralPattern({!r})".format(self.pattern)
+
+@functools.lru_cache(maxsize=512)
+def getpattern(mystring,flags=0):
+#   return the compiled search pattern for match string mystring (cached by string and flags):
+#   a LiteralPattern if mystring has no regular expression metacharacters, else a re pattern
+    if not flags and regexmetachars.isdisjoint(mystring):
+        return LiteralPattern(mystring)
+    return re.compile(mystring,flags)
+
+# match strings containing these cannot be searched over a whole buffer, because
+# the newline next to a line boundary can make them fail where a single line would match
+bufferunsafe = ("(?!","(?<!","\\A","\\Z")
+
+class SearchBuffer:
+#   The lines of an internal file joined (by newlines) into one string, plus an array of
+#   the offset of the start of each line.  A forward match is then a pattern.search over
+#   the whole text at C speed, with the line number of a hit found by bisecting the offsets.
+#   valid is False if some line contains a newline itself (offsets would be wrong).
+
+    def __init__(self,lines):
+        self.text = "\n".join(lines)
+        self.nlines = len(lines)
+        starts = itertools.accumulate(len(line) + 1 for line in itertools.islice(lines,0,self.nlines - 1))
+        self.offsets = array("q",itertools.chain((0,),starts))
+        self.valid = self.nlines > 0 and self.text.count("\n") == self.nlines - 1
+
+    def linenumber(self,position):
+#       return the number of the line containing character position of text
+        return bisect.bisect_right(self.offsets,position) - 1
+
+    def matchinglines(self,mystring,lines,startline=0):
+#       generate, in order, the numbers (>= startline) of lines matching mystring.
+#       lines are the lines the buffer was built from; regular expression hits
+#       are checked against their line alone, so a hit that only exists because the
+#       search ran across a line boundary is skipped.
+        pattern = getpattern(mystring)
+        if isinstance(pattern,LiteralPattern) and "\n" not in mystring:
+            linesearch = None
+        else:
+            linesearch = pattern.search
+            pattern = getpattern(mystring,re.MULTILINE)
+        search = pattern.search
+        text = self.text
+        offsets = self.offsets
+        nlines = self.nlines
+        if startline >= nlines:
+            return
+        position = offsets[startline]
+        while True:
+            searchObj = search(text,position)
+            if searchObj is None:
+                return
+            lineno = bisect.bisect_right(offsets,searchObj.start(),startline) - 1
+            if linesearch is None or linesearch(lines[lineno]):
+                yield lineno
+            startline = lineno + 1
+            if startline >= nlines:
+                return
+            position = offsets[startline]
+
+def requiredliterals(mystring):
+#   return a list of pieces of plain text that every line matching mystring must contain
+#   (e.g. ["nergy"] for "[E|e]nergy"), or [] if none can be found: the runs of literal
+#   characters that must occur, in sequence, in any match of the regular expression
+    if isinstance(getpattern(mystring),LiteralPattern):
+        return [mystring]
+    try:
+        parsed = sre_parse.parse(mystring)
+    except (re.error,RecursionError):
+        return []
+    state = getattr(parsed,"state",None) or getattr(parsed,"pattern",None)
+    if getattr(state,"flags",0) & re.IGNORECASE:
+        return []
+    literals = []
+    run = []
+
+    def endrun():
+        if run:
+            literals.append("".join(run))
+            del run[:]
+
+    def walk(items):
+        for op,av in items:
+            if op is sre_parse.LITERAL:
+                run.append(chr(av))
+            elif op is sre_parse.SUBPATTERN and not av[1] & re.IGNORECASE:
+                walk(av[-1])
+            elif op in (sre_parse.MAX_REPEAT,sre_parse.MIN_REPEAT) and av[0] >= 1:
+#               the repeated item is required, but what follows it is not adjacent to it
+                endrun()
+                walk(av[2])
+                endrun()
+            else:
+                endrun()
+
+    walk(parsed)
+    endrun()
+    return literals
+
+def trigrams(mystring):
+#   the set of three-character pieces of mystring
+    return set(map("".join,zip(mystring,mystring[1:],mystring[2:])))
+
+def insorted(sortedarray,value):
+#   True if value is in the ascending sequence sortedarray
+    i = bisect.bisect_left(sortedarray,value)
+    return i < len(sortedarray) and sortedarray[i] == value
+
+class TrigramIndex:
+#   For every three-character piece of text (trigram), the ascending numbers of the lines of
+#   an internal file that contain it.  A line can only match a pattern if it contains every
+#   trigram of the text the pattern requires (see requiredliterals), so a forward match
+#   only needs to try the lines found in all of those postings.  Built once for a file and
+#   then shared by all its searches; worthwhile when a large file is searched many times.
+#   With an index cache (see setindexcache) the index of a file on disk is saved and reused.
+
+    def __init__(self,lines=(),postings=None):
+        if postings is None:
+            postings = collections.defaultdict(functools.partial(array,"I"))
+            for lineno,line in enumerate(lines):
+                for gram in trigrams(line):
+                    postings[gram].append(lineno)
+        self.postings = dict(postings)
+        self.candidatecache = {}
+
+    def candidates(self,mystring):
+#       return the ascending numbers of the lines that can match mystring, or None
+#       if the index cannot narrow them down (no required text of three characters)
+        if mystring in self.candidatecache:
+            return self.candidatecache[mystring]
+        grams = set()
+        for literal in requiredliterals(mystring):
+            grams.update(trigrams(literal))
+        if not grams:
+            result = None
+        else:
+            postings = sorted((self.postings.get(gram,array("I")) for gram in grams),key=len)
+            result = postings[0]
+            for posting in postings[1:]:
+                if not result:
+                    break
+                result = array("I",(lineno for lineno in result if insorted(posting,lineno)))
+        self.candidatecache[mystring] = result
+        return result
+
+    def matchinglines(self,mystring,lines,startline=0):
+#       return an iterator over the numbers (>= startline), in order, of the lines
+#       matching mystring, or None if the index cannot help with mystring
+        candidates = self.candidates(mystring)
+        if candidates is None:
+            return None
+        search = getpattern(mystring).search
+        first = bisect.bisect_left(candidates,startline)
+        return (candidates[i] for i in range(first,len(candidates)) if search(lines[candidates[i]]))
+
+    def delete(self,start,end):
+#       update the index for the deletion of lines start to end (inclusive) from its file
+        ndeleted = end - start + 1
+        for gram,posting in list(self.postings.items()):
+            lo = bisect.bisect_left(posting,start)
+            hi = bisect.bisect_right(posting,end,lo)
+            if hi < len(posting):
+                posting[lo:] = array("I",(lineno - ndeleted for lineno in posting[hi:]))
+            elif lo < len(posting):
+                del posting[lo:]
+            if not posting:
+                del self.postings[gram]
+        self.candidatecache = {}
+
+def parallelmatchinglines(lines,mystring,start):
+#   return the ascending numbers of all the lines (from start on) of lines (a list,
+#   PackedLines or MmapLines) that contain mystring, found by scanjobs worker processes searching ranges of
+#   lines at the same time; or None if the lines are too few, or cannot be split up this way
+    scanjobs = currentsession().scanjobs
+    if scanjobs <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+        return None
+    if isinstance(lines,(list,PackedLines)):
+        stop = len(lines)
+    elif isinstance(lines,MmapLines) and lines.contiguous:
+        lines.fillall()
+        stop = len(lines.offsets)   # the lines after these (lines.extra) are searched here
+    else:
+        return None
+    if stop - start < 2*scanchunklines:
+        return None
+    chunklines = max(scanchunklines,-(-(stop - start)//(4*scanjobs)))
+    starts = list(range(start,stop,chunklines))
+    stops = starts[1:] + [stop]
+    msg(oginfo,"searching lines {} to {} for \"{}\" in {} parts with {} processes",start,stop-1,
+        mystring,len(starts),scanjobs)
+    global scanlines
+    with scanlock:
+        scanlines = lines
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=scanjobs,
+                                                        mp_context=multiprocessing.get_context("fork")) as pool:
+                hits = list(itertools.chain.from_iterable(
+                            pool.map(scanrange,itertools.repeat(mystring),starts,stops)))
+        finally:
+            scanlines = None
+    search = getpattern(mystring).search
+    for lineno in range(stop,len(lines)):
+        if search(lines[lineno]):
+            hits.append(lineno)
+    return hits
+
+def scanrange(mystring,start,stop):
+#   (in a worker process) the numbers of the lines start to stop-1 of scanlines containing mystring
+    search = getpattern(mystring).search
+    lines = scanlines
+    if not isinstance(lines,MmapLines):
+        return [lineno for lineno in range(start,stop) if search(lines[lineno])]
+    text = lines.map[lines.offsets[start]:lines.offsets[stop] if stop < len(lines.offsets)
+                     else lines.scanned].decode(lines.encoding,lines.errors)
+    return [lineno for lineno,line in zip(range(start,stop),text.split("\n")) if search(line.rstrip())]
+
 def substitute(pattern,repl,instring,count=1):
 #   substitute repl for pattern in instring count times (if there are that many)
 #   return resulting string or None if no substitution occurred
@@ -473,8 +1662,8 @@ def substitute(pattern,repl,instring,count=1):
         msg(oginfo,"no substitute performed in substitute.")
     else:
         msg(oginfo,"in substitute, replaced line")
-        msg(ogdebug,"--old: \"{}\"".format(instring))
-        msg(ogdebug,"--new: \"{}\"".format(outstring))
+        msg(ogdebug,"--old: \"{}\"",instring)
+        msg(ogdebug,"--new: \"{}\"",outstring)
         
     return outstring
 
@@ -488,6 +1677,61 @@ def matchnextcopy(infile,outfile,mystring,*,nfind=1,increment=0,nlines=1):
         msg(ogdebug,mylines)
         outfile.addlines(mylines)
 
+# output formats of extractfields: how a row of texts is written as a line
+extractformats = {
+    "tsv": "\t".join,
+    "space": " ".join,
+    "csv": None,        # see csvlines
+}
+
+def csvlines(rows):
+#   the rows (lists of texts) as lines of CSV, quoted where needed
+    buffer = io.StringIO()
+    csv.writer(buffer,lineterminator="\n").writerows(rows)
+    return buffer.getvalue().split("\n")[:-1]
+
+def extractfields(infile,outfile,mystring,items,delim="whitespace",format="tsv"):
+#   for every line of infile from the current one on that contains mystring, add a row
+#   of items from it to outfile, writebatch rows at a time.  items are ("field",index),
+#   ("slice",start,end) or ("text",text) (see args_extractfields); a field the line does
+#   not have is left empty.  Like "match mystring nfind all", it leaves the current line
+#   at the end of the file (or at the last line, if that matched) with matchflag False.
+    usesfields = any(item[0] == "field" for item in items)
+    writebatch = currentsession().writebatch
+    join = extractformats[format]
+    rows = []
+
+    def addrows():
+        outfile.addlines([join(row) for row in rows] if join else csvlines(rows))
+        del rows[:]
+
+    def hits():
+#       the matching line numbers, extracting the row of each on the way
+        lines = infile.lines
+        for lineno in linenumbers:
+            text = lines[lineno]
+            fields = splitfields(text,delim) if usesfields else ()
+            row = []
+            for item in items:
+                if item[0] == "field":
+                    row.append(fields[item[1]] if item[1] < len(fields) else "")
+                elif item[0] == "slice":
+                    row.append(text[item[1]:item[2]])
+                else:
+                    row.append(item[1])
+            rows.append(row)
+            if len(rows) >= writebatch:
+                addrows()
+            yield lineno
+
+    linenumbers = infile.parallelmatches(mystring)
+    if linenumbers is None:
+        linenumbers = infile.matchinglines(mystring,infile.current)
+    infile.matchflag = False
+    infile.matchlines(hits(),mystring,sys.maxsize)
+    if rows:
+        addrows()
+
 def copyline(infile,outfile):
     msg(oginfo,"copying line from input to output")
     myline = infile.getline()
@@ -495,20 +1739,20 @@ def copyline(infile,outfile):
 
 def copylines(infile,outfile,nlines=1):
 #   copy nlines lines, starting from current line in infile, to outfile
-    msg(ogverbose,"copying {} lines from input to output".format(nlines))
+    msg(ogverbose,"copying {} lines from input to output",nlines)
     mylines = infile.getlines(nlines)
     outfile.addlines(mylines)
 
 def copyuntilmatch(infile,outfile,mystring,*,start=False,end=False):
 #   copy all lines (exclusive of start and end by default) from current to line matching mystring
-    msg(oginfo,"copying all lines until {} matched from input to output".format(mystring))
+    msg(oginfo,"copying all lines until {} matched from input to output",mystring)
     mylines,endpos = infile.getuntilmatch(mystring,start=start,end=end)
     outfile.addlines(mylines)
     return endpos
 
 def copysection(infile,outfile,start,end):
 #   copy a section of input lines from line start to line end, inclusive
-    msg(oginfo,"copying section ( {} to {} ) from input to output".format(start,end))
+    msg(oginfo,"copying section ( {} to {} ) from input to output",start,end)
     mylines,endposition = infile.getsection(start,end)
     outfile.addlines(mylines)
     return endposition
@@ -549,7 +1793,7 @@ def removesubstring(mystring,substring,occurrence=1):
                 newstring = mystring[:idx] + mystring[position:] 
                 return newstring
         else:
-            msg(ogmain,"In removesubstring, {} occurrences of {} not found".format(occurrence,substring))
+            msg(ogmain,"In removesubstring, {} occurrences of {} not found",occurrence,substring)
             return mystring
     
 def replacesubstring(mystring,substring,replacement,occurrence=1):
@@ -566,10 +1810,172 @@ def replacesubstring(mystring,substring,replacement,occurrence=1):
                 newstring = mystring[:idx] + replacement + mystring[position:] 
                 return newstring
         else:
-            msg(ogmain,"In replacesubstring, {} occurrences of {} not found".format(occurrence,substring))
+            msg(ogmain,"In replacesubstring, {} occurrences of {} not found",occurrence,substring)
             return mystring
         
 
+class SpillLines:
+#   A list of lines, for an OutputFile or ScratchFile, that keeps only its last lines in
+#   memory.  Once those pass maxsize characters, all but the last keep lines are appended
+#   to a temporary file (UTF-8, one after another) and self.offsets records where each
+#   starts.  Spilled lines are read back a block at a time, so that a search through them
+#   (match, goto on a ScratchFile) does not read them one by one.  Changing a spilled
+#   line (e.g. joinlast after the last lines were spilled) first moves it back to memory.
+
+    def __init__(self,lines=(),maxsize=1000000,keep=100,blocklines=4096):
+        self.maxsize = maxsize
+        self.keep = keep
+        self.blocklines = blocklines
+        self.tail = []
+        self.tailsize = 0
+        self.file = None
+        self.offsets = array("Q",[0])   # spilled line i is bytes offsets[i] to offsets[i+1]
+        self.cachestart = 0
+        self.cache = []
+        self.extend(lines)
+
+    def nspilled(self):
+        return len(self.offsets) - 1
+
+    def __len__(self):
+        return len(self.offsets) - 1 + len(self.tail)
+
+    def append(self,line):
+        self.tail.append(line)
+        self.tailsize += len(line)
+        if self.tailsize > self.maxsize:
+            self.spill()
+
+    def extend(self,lines):
+        lines = list(lines)
+        self.tail.extend(lines)
+        self.tailsize += sum(map(len,lines))
+        if self.tailsize > self.maxsize:
+            self.spill()
+
+    def spill(self):
+#       move all but the last keep lines in memory to the temporary file
+        nspill = len(self.tail) - self.keep
+        if nspill <= 0:
+            return
+        if self.file is None:
+            self.file = tempfile.TemporaryFile()
+            msg(ogverbose,"moving lines beyond {} characters to a temporary file",self.maxsize)
+        data = [line.encode("utf-8","surrogateescape") for line in self.tail[:nspill]]
+        end = self.offsets[-1]
+        self.file.seek(end)
+        self.file.write(b"".join(data))
+        self.offsets.extend(itertools.islice(itertools.accumulate(map(len,data),initial=end),1,None))
+        del self.tail[:nspill]
+        self.tailsize = sum(map(len,self.tail))
+
+    def unspill(self,nlines):
+#       move the last nlines spilled lines back to memory
+        nlines = min(nlines,self.nspilled())
+        if nlines <= 0:
+            return
+        lines = self.readspilled(self.nspilled() - nlines,self.nspilled())
+        del self.offsets[-nlines:]
+        self.tail[0:0] = lines
+        self.tailsize += sum(map(len,lines))
+        self.cache = []
+
+    def readspilled(self,start,stop):
+#       the spilled lines start to stop-1
+        if stop <= start:
+            return []
+        offsets = self.offsets
+        base = offsets[start]
+        self.file.seek(base)
+        data = self.file.read(offsets[stop] - base)
+        return [data[offsets[i]-base:offsets[i+1]-base].decode("utf-8","surrogateescape")
+                for i in range(start,stop)]
+
+    def spilledline(self,index):
+#       spilled line index, reading the block of lines around it if it is not cached
+        if not self.cachestart <= index < self.cachestart + len(self.cache):
+            if index < self.cachestart:     # going backwards: read the block ending here
+                self.cachestart = max(0,index - self.blocklines + 1)
+            else:
+                self.cachestart = index
+            self.cache = self.readspilled(self.cachestart,
+                                          min(self.cachestart + self.blocklines,self.nspilled()))
+        return self.cache[index - self.cachestart]
+
+    def normalize(self,index):
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("line {} out of range".format(index))
+        return index
+
+    def __getitem__(self,index):
+        nspilled = self.nspilled()
+        if isinstance(index,slice):
+            start,stop,step = index.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start,stop,step)]
+            return (self.readspilled(start,min(stop,nspilled))
+                    + self.tail[max(start - nspilled,0):max(stop - nspilled,0)])
+        index = self.normalize(index)
+        if index >= nspilled:
+            return self.tail[index - nspilled]
+        return self.spilledline(index)
+
+    def __setitem__(self,index,line):
+        index = self.normalize(index)
+        if index < self.nspilled():
+            self.unspill(self.nspilled() - index)
+        index -= self.nspilled()
+        self.tailsize += len(line) - len(self.tail[index])
+        self.tail[index] = line
+
+    def __delitem__(self,index):
+        if isinstance(index,slice):
+            start,stop,step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("SpillLines can only delete contiguous lines")
+        else:
+            start = self.normalize(index)
+            stop = start + 1
+        if stop <= start:
+            return
+        nspilled = self.nspilled()
+        if start >= nspilled:
+            del self.tail[start - nspilled:stop - nspilled]
+            self.tailsize = sum(map(len,self.tail))
+            return
+        self.cache = []
+        if stop >= nspilled:
+#           the spilled lines from start on go, and the first lines in memory
+            del self.offsets[start+1:]
+            del self.tail[:stop - nspilled]
+            self.tailsize = sum(map(len,self.tail))
+            return
+#       lines in the middle of the spilled ones: move the bytes after them down
+        offsets = self.offsets
+        gap = offsets[stop] - offsets[start]
+        position = offsets[stop]
+        end = offsets[-1]
+        while position < end:
+            self.file.seek(position)
+            data = self.file.read(min(1<<24,end - position))
+            self.file.seek(position - gap)
+            self.file.write(data)
+            position += len(data)
+        offsets[start+1:] = array("Q",(offset - gap for offset in offsets[stop+1:]))
+
+    def __iter__(self):
+        nspilled = self.nspilled()
+        for start in range(0,nspilled,self.blocklines):
+            yield from self.readspilled(start,min(start + self.blocklines,nspilled))
+        yield from list(self.tail)
+
+    def copy(self):
+        return SpillLines(self,self.maxsize,self.keep,self.blocklines)
+
+
 class InternalFile:
 #   Base class for internal representation of files
 
@@ -578,8 +1984,19 @@ class InternalFile:
         self.length = 0
         self.names = []
         self.type = "InternalFile"
+        self.searchbuffer = None
+        self.trigramindex = None
+        self.sharedlines = False    # True if self.lines belongs to another file too
+        self.fieldcache = None      # (line number, delimiter, line, its fields); see getfieldlist
+        self.session = currentsession()     # the Session the file belongs to
         msg(ogdebug,"initializing empty InternalFile")
 
+    def linesmodified(self):
+#       must be called whenever self.lines changes: drops what was derived from the old lines
+        self.searchbuffer = None
+        self.trigramindex = None
+        self.fieldcache = None
+
     def checkstartposition(self,start):
 #       if position is before begin of file, set to to begin of file and report
         if start < 0:
@@ -597,13 +2014,13 @@ class InternalFile:
     def addblankline(self):
         self.lines.append("")
         self.length += 1
+        self.linesmodified()
 
     def writefile(self,fileh=sys.stdout):
 #   write the in-memory file object to file (default stdout)
-        msg(oginfo,"writing {} file {}".format(self.type,self.names))
+        msg(oginfo,"writing {} file {}",self.type,self.names)
         msg(oginfo,"-----------------------------------------------")
-        for line in self.lines:
-            print(line,file=fileh)
+        writelines(fileh,self.lines)
         msg(ogmain,"finished writing")
 
 class OutputFile(InternalFile):
@@ -612,9 +2029,11 @@ class OutputFile(InternalFile):
     def __init__(self):
         InternalFile.__init__(self)
         self.type = "OutputFile"
+        self.lines = newlinelist()
+        self.stream = None
         addfilename(self,"output")
         msg(ogdebug,"Initializing output file.")
-        msg(ogdebug,"Names = {}".format(self.names))
+        msg(ogdebug,"Names = {}",self.names)
 
     def addline(self,mystring,printblank=False):
 #   add mystring as new line at end of file
@@ -623,9 +2042,34 @@ class OutputFile(InternalFile):
                 msg(ogdebug,"-- not adding blank line in addline")
                 return
         else:
-            msg(ogdebug,"--adding line \"{}\" to {} file {}".format(mystring,self.type,self.names))
+            msg(ogdebug,"--adding line \"{}\" to {} file {}",mystring,self.type,self.names)
             self.lines.append(mystring)
             self.length += 1
+            if self.stream is not None and len(self.lines) >= self.streambatch:
+                self.flushlines()
+
+    def setstream(self,fh,keep=2,batch=None):
+#       write lines to fh once they can no longer change, in batches of about batch lines
+#       (default writebatch), rather than holding them all for writefile (which then writes
+#       only what is left).  joinlast, switchlast, remove and replace change at most the
+#       last two lines, so the last keep lines are held back.
+        if batch is None:
+            batch = self.session.writebatch
+        self.stream = fh
+        self.streamkeep = keep
+        self.streambatch = keep + batch
+        if self not in self.session.streamoutputs:
+            self.session.streamoutputs.append(self)
+
+    def flushlines(self,flush=False):
+#       write all but the last streamkeep lines to the stream and drop them from memory;
+#       with flush, also flush the stream itself
+        nflush = len(self.lines) - self.streamkeep
+        if nflush > 0:
+            writelines(self.stream,self.lines[:nflush],nflush)
+            del self.lines[:nflush]
+        if flush:
+            self.stream.flush()
 
     def addlines(self,mylines,printblank=False):
 #   add mylines as new lines at end of output file
@@ -633,53 +2077,829 @@ class OutputFile(InternalFile):
             msg(ogdebug,"-- not adding empty lines in addlines")
             return
         else:
-            msg(ogdebug,"--adding lines \"{}\" to {} file {}".format(mylines,self.type,self.names))
+            msg(ogdebug,"--adding lines \"{}\" to {} file {}",mylines,self.type,self.names)
             self.lines.extend(mylines)
             self.length += len(mylines)
+            if self.stream is not None and len(self.lines) >= self.streambatch:
+                self.flushlines()
 
     def joinlastlines(self,joiner=""):
 #       join last two lines of output file,
 #       assign the result to the next-to-last line and
 #       delete the last line.
 
-        msg(ogdebug,"In joinlastlines, file length = {}:".format(self.length))
+        msg(ogdebug,"In joinlastlines, file length = {}:",self.length)
         msg(ogdebug,"Last two lines are:")
-        msg(ogdebug,"{}".format(self.lines[-2]))
-        msg(ogdebug,"{}".format(self.lines[-1]))
+        msg(ogdebug,"{}",self.lines[-2])
+        msg(ogdebug,"{}",self.lines[-1])
         self.lines[-2] = self.lines[-2] + joiner + self.lines[-1]
-        msg(ogdebug,"New line is: {}".format(self.lines[-2]))
+        msg(ogdebug,"New line is: {}",self.lines[-2])
         del self.lines[-1]
-        self.length = len(self.lines)
-        msg(ogdebug,"In joinlastlines, file length = {}:".format(self.length))
+        self.length -= 1
+        self.linesmodified()
+        msg(ogdebug,"In joinlastlines, file length = {}:",self.length)
         self.current = self.length - 1
 
     def switchlastlines(self):
 #       switch last two lines of output file,
-        msg(ogdebug,"In switchlastlines, file length = {}:".format(self.length))
+        msg(ogdebug,"In switchlastlines, file length = {}:",self.length)
         msg(ogdebug,"Last two lines are:")
-        msg(ogdebug,"{}".format(self.lines[-2]))
-        msg(ogdebug,"{}".format(self.lines[-1]))
+        msg(ogdebug,"{}",self.lines[-2])
+        msg(ogdebug,"{}",self.lines[-1])
         self.lines[-2],self.lines[-1] = self.lines[-1],self.lines[-2]
+        self.linesmodified()
         msg(ogdebug,"Last two lines are:")
-        msg(ogdebug,"{}".format(self.lines[-2]))
-        msg(ogdebug,"{}".format(self.lines[-1]))
-        msg(ogdebug,"In switchlastlines, file length = {}:".format(self.length))
+        msg(ogdebug,"{}",self.lines[-2])
+        msg(ogdebug,"{}",self.lines[-1])
+        msg(ogdebug,"In switchlastlines, file length = {}:",self.length)
 
     def replacelastline(self,newtext):
 #       replace the last line with some new text
         msg(ogdebug,"In replacelastline before replacement, last line is:")
-        msg(ogdebug,"{}".format(self.lines[-1]))
+        msg(ogdebug,"{}",self.lines[-1])
         self.lines[-1] = newtext
+        self.linesmodified()
         msg(ogdebug,"In replacelastline after replacement, last line is:")
-        msg(ogdebug,"{}".format(self.lines[-1]))
+        msg(ogdebug,"{}",self.lines[-1])
+
+
+class StreamLines:
+#   The lines of a text stream (e.g. stdin) read only as far as they are needed, for a
+#   StreamInputFile.  Lines are indexed by their absolute line number, but only those from
+#   self.first onward are held in memory; release() drops older ones (those more than
+#   lookbehind lines behind the current one).  As createInputFile does for other input
+#   files, a blank line is added when the stream ends.
+
+    def __init__(self,fh,chunksize=1000,lookbehind=None):
+        self.fh = fh
+        self.chunksize = chunksize
+        self.lookbehind = lookbehind
+        self.buffer = []
+        self.first = 0          # absolute line number of self.buffer[0]
+        self.pin = None         # if set, release() keeps lines from this one onward
+        self.eof = False
+
+    def __len__(self):
+#       number of lines read so far (the length of the stream once eof is True)
+        return self.first + len(self.buffer)
+
+    def readchunk(self):
+#       read up to chunksize more lines from the stream.  Reading may wait for more input,
+#       so first send out whatever output is ready (see OutputFile.setstream)
+        for outfile in currentsession().streamoutputs:
+            outfile.flushlines(flush=True)
+        chunk = [x.rstrip() for x in itertools.islice(self.fh,self.chunksize)]
+        self.buffer.extend(chunk)
+        if len(chunk) < self.chunksize:
+            self.buffer.append("")
+            self.eof = True
+
+    def fill(self,lineno):
+#       read until line lineno is held or the stream ends; return True if line lineno exists
+        while self.first + len(self.buffer) <= lineno:
+            if self.eof:
+                return False
+            self.readchunk()
+        return True
+
+    def fillall(self):
+#       read the rest of the stream
+        while not self.eof:
+            self.readchunk()
+
+    def checkavailable(self,lineno):
+        if lineno < self.first:
+            msg(ogmain,"Line {} of the streamed input was already discarded (look-behind {} lines)",lineno,
+                self.lookbehind if self.lookbehind is not None else currentsession().streamlookbehind)
+            sys.exit("stopping: line {} of the streamed input is no longer available;"
+                     " increase --lookbehind or run without --stream".format(lineno))
+
+    def __getitem__(self,index):
+        if isinstance(index,slice):
+            start = 0 if index.start is None else index.start
+            if index.stop is None:
+                self.fillall()
+                stop = len(self)
+            else:
+                stop = index.stop
+                self.fill(stop - 1)
+            if stop <= start:
+                return []
+            self.checkavailable(start)
+            return self.buffer[start - self.first:stop - self.first]
+        if index < 0:
+            self.fillall()
+            index += len(self)
+        if not self.fill(index):
+            raise IndexError("streamed input has no line {}".format(index))
+        self.checkavailable(index)
+        return self.buffer[index - self.first]
+
+    def __iter__(self):
+        for lineno,line in self.scan(self.first):
+            yield line
+
+    def scan(self,start,keep=None):
+#       generate (lineno,line) for every line from start to the end of the stream,
+#       reading as needed; if keep is given, lines more than keep lines behind
+#       the last one generated are released as the scan goes on
+        lineno = start
+        self.checkavailable(start)
+        while self.fill(lineno):
+            for line in self.buffer[lineno - self.first:]:
+                yield lineno,line
+                lineno += 1
+            if keep is not None:
+                self.release(lineno - keep)
+
+    def matchinglines(self,mystring,start,keep=None):
+#       generate the numbers of the lines from start on that contain mystring
+        search = getpattern(mystring).search
+        for lineno,line in self.scan(start,keep):
+            if search(line):
+                yield lineno
+
+    def release(self,lineno):
+#       drop the lines before lineno (and after any pinned line) from memory.
+#       Done in batches, so that the buffer is not copied for every line.
+        if self.pin is not None and self.pin < lineno:
+            lineno = self.pin
+        drop = lineno - self.first
+        if drop >= self.chunksize and 2*drop >= len(self.buffer):
+            del self.buffer[:drop]
+            self.first = lineno
+
+
+def lineindexpath(fh,info,suffix=".ogidx"):
+#   the file in which the line index (or, with another suffix, another index) of the file
+#   open as fh (with os.fstat info) is saved: named after its real path, or after its
+#   device and inode if it has no path (stdin)
+    name = getattr(fh,"name",None)
+    if isinstance(name,str) and not name.startswith("<") and os.path.exists(name):
+        key = os.path.realpath(name)
+    else:
+        key = "{}:{}".format(info.st_dev,info.st_ino)
+    return os.path.join(currentsession().indexcache,hashlib.sha1(key.encode()).hexdigest() + suffix)
+
+def lineindexheader(info):
+#   what a saved line index must agree on with the file for it to be used
+    return {"device":info.st_dev,"inode":info.st_ino,"size":info.st_size,"mtime":info.st_mtime_ns}
+
+def loadlineindex(path,info):
+#   return the line offsets saved in path if they are for the file described by info
+#   (same device, inode, size and modification time), otherwise None
+    try:
+        with open(path,"rb") as f:
+            header = json.loads(f.readline())
+            if {key:header.get(key) for key in ("device","inode","size","mtime")} != lineindexheader(info):
+                msg(oginfo,"line index {} is out of date",path)
+                return None
+            offsets = array("Q")
+            offsets.frombytes(f.read())
+    except (OSError,ValueError):
+        return None
+    if len(offsets) != header.get("lines"):
+        return None
+    msg(oginfo,"using line index {} ({} lines)",path,len(offsets))
+    return offsets
+
+def savelineindex(path,info,offsets):
+#   save offsets as the line index of the file described by info.  Written to a temporary
+#   file and renamed, so that runs reading the index at the same time never see half of it.
+    header = lineindexheader(info)
+    header["lines"] = len(offsets)
+    try:
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        fd,tmppath = tempfile.mkstemp(dir=os.path.dirname(path),suffix=".tmp")
+        with os.fdopen(fd,"wb") as f:
+            f.write(json.dumps(header).encode() + b"\n")
+            offsets.tofile(f)
+        os.replace(tmppath,path)
+        msg(oginfo,"saved line index {} ({} lines)",path,len(offsets))
+    except OSError as err:
+        msg(oginfo,"could not save line index {}: {}",path,err)
+
+def fileinfo(fh):
+#   os.fstat of the regular file open as fh, or None if it is not one
+    try:
+        info = os.fstat(fh.fileno())
+    except (AttributeError,OSError,ValueError):
+        return None
+    return info if stat.S_ISREG(info.st_mode) else None
+
+def loadtrigramindex(path,info,nlines):
+#   return the TrigramIndex saved in path if it is for the file described by info and has
+#   nlines lines, otherwise None.  After a JSON header listing each trigram and the length
+#   of its postings, the postings follow as one array("I").
+    try:
+        with open(path,"rb") as f:
+            header = json.loads(f.readline())
+            if {key:header.get(key) for key in ("device","inode","size","mtime")} != lineindexheader(info):
+                msg(oginfo,"trigram index {} is out of date",path)
+                return None
+            if header.get("lines") != nlines:
+                return None
+            allpostings = array("I")
+            allpostings.frombytes(f.read())
+    except (OSError,ValueError):
+        return None
+    postings = {}
+    position = 0
+    for gram,length in header["grams"]:
+        postings[gram] = allpostings[position:position+length]
+        position += length
+    if position != len(allpostings):
+        return None
+    msg(oginfo,"using trigram index {} ({} trigrams)",path,len(postings))
+    return TrigramIndex(postings=postings)
+
+def savetrigramindex(path,info,index,nlines):
+#   save index, built from the nlines lines of the file described by info, in path
+#   (written to a temporary file and renamed, as in savelineindex)
+    header = lineindexheader(info)
+    header["lines"] = nlines
+    header["grams"] = [(gram,len(posting)) for gram,posting in index.postings.items()]
+    try:
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        fd,tmppath = tempfile.mkstemp(dir=os.path.dirname(path),suffix=".tmp")
+        with os.fdopen(fd,"wb") as f:
+            f.write(json.dumps(header).encode() + b"\n")
+            for posting in index.postings.values():
+                posting.tofile(f)
+        os.replace(tmppath,path)
+        msg(oginfo,"saved trigram index {} ({} trigrams)",path,len(index.postings))
+    except OSError as err:
+        msg(oginfo,"could not save trigram index {}: {}",path,err)
+
+
+class MmapLines:
+#   The lines of a file on disk, for an MmapInputFile.  The file is memory-mapped, and
+#   indexed (self.offsets holds the byte offset at which each line starts) only as far as
+#   it is needed; a line is decoded to a (rstripped) string only when it is accessed.
+#   As for StreamLines, a blank line is added after the last line of the file; lines added
+#   after that are kept in self.extra.  With an index cache (see setindexcache), the index
+#   of the whole file is saved once it is complete and reused while the file is unchanged.
+
+    def __init__(self,fh,chunksize=1<<22):
+        self.encoding = getattr(fh,"encoding",None) or locale.getpreferredencoding(False)
+        self.errors = getattr(fh,"errors",None) or "strict"
+        self.info = os.fstat(fh.fileno())
+        self.size = self.info.st_size
+        self.map = mmap.mmap(fh.fileno(),0,access=mmap.ACCESS_READ)
+        self.chunksize = chunksize
+        self.offsets = array("Q")
+        self.scanned = 0        # bytes before this one have been indexed
+        self.contiguous = True  # False once lines have been deleted
+        self.extra = []
+        self.eof = False
+#       with an index cache, a saved index of the whole file replaces the scan
+        self.indexpath = lineindexpath(fh,self.info) if currentsession().indexcache is not None else None
+        if self.indexpath is not None:
+            offsets = loadlineindex(self.indexpath,self.info)
+            if offsets is not None:
+                self.offsets = offsets
+                self.scanned = self.size
+                self.extra.append("")
+                self.eof = True
+
+    def __len__(self):
+#       number of lines indexed so far (the length of the file once eof is True)
+        return len(self.offsets) + len(self.extra)
+
+    def __bool__(self):
+        return self.fill(0)
+
+    def indexchunk(self):
+#       index about chunksize more bytes of the file, up to the end of a line
+        start = self.scanned
+        stop = self.map.rfind(b"\n",start,min(start + self.chunksize,self.size))
+        if stop < 0:
+            stop = self.map.find(b"\n",start + self.chunksize)
+        if stop < 0:
+            stop = self.size - 1    # last line, without a newline
+        pieces = self.map[start:stop+1].split(b"\n")
+        if pieces[-1]:
+            pieces.append(b"")
+        self.offsets.extend(itertools.accumulate(itertools.chain((start,),
+                                                 (len(x) + 1 for x in pieces[:-2]))))
+        self.scanned = stop + 1
+        if self.scanned >= self.size:
+            self.extra.append("")
+            self.eof = True
+            if self.indexpath is not None and self.contiguous:
+                savelineindex(self.indexpath,self.info,self.offsets)
+
+    def fill(self,lineno):
+#       index until line lineno is known or the file ends; return True if line lineno exists
+        while len(self) <= lineno:
+            if self.eof:
+                return False
+            self.indexchunk()
+        return True
+
+    def fillall(self):
+        while not self.eof:
+            self.indexchunk()
+
+    def fillbytes(self,position):
+#       index at least up to the line containing byte position
+        while self.scanned <= position and not self.eof:
+            self.indexchunk()
+
+    def decode(self,start):
+        end = self.map.find(b"\n",start)
+        if end < 0:
+            end = self.size
+        return self.map[start:end].decode(self.encoding,self.errors).rstrip()
+
+    def __getitem__(self,index):
+        if isinstance(index,slice):
+            start,stop,step = index.indices(sys.maxsize)
+            if index.stop is None or stop < 0 or start < 0:
+                self.fillall()
+                start,stop,step = index.indices(len(self))
+            else:
+                self.fill(stop - 1)
+                stop = min(stop,len(self))
+            return [self[i] for i in range(start,stop,step)]
+        if index < 0:
+            self.fillall()
+            index += len(self)
+        if not self.fill(index):
+            raise IndexError("file has no line {}".format(index))
+        if index < len(self.offsets):
+            return self.decode(self.offsets[index])
+        return self.extra[index - len(self.offsets)]
+
+    def __delitem__(self,index):
+        start,stop,step = index.indices(sys.maxsize)
+        if index.stop is None or stop < 0 or start < 0:
+            self.fillall()
+            start,stop,step = index.indices(len(self))
+        else:
+            self.fill(stop - 1)
+        nindexed = len(self.offsets)
+        del self.offsets[min(start,nindexed):min(stop,nindexed)]
+        if stop > nindexed:
+            del self.extra[max(start - nindexed,0):stop - nindexed]
+        self.contiguous = False
+
+    def append(self,line):
+        self.fillall()
+        self.extra.append(line)
+
+    def copy(self):
+#       another MmapLines over the same map, with its own index (so lines can be deleted)
+        other = copy.copy(self)
+        other.offsets = array("Q",self.offsets)
+        other.extra = list(self.extra)
+        return other
+
+    def __iter__(self):
+        for lineno,line in self.scan(0):
+            yield line
+
+    def scan(self,start,blocklines=10000,firstblock=16):
+#       generate (lineno,line) for every line from start to the end of the file, decoding
+#       blocks of lines at once while no lines have been deleted.  The first block is
+#       firstblock lines and each next one twice as long, up to blocklines, so that a
+#       search that stops after a few lines (a match with hits close together) decodes
+#       only a few
+        lineno = start
+        size = firstblock
+        while self.fill(lineno):
+            nindexed = len(self.offsets)
+            if lineno >= nindexed:
+                yield lineno,self.extra[lineno - nindexed]
+                lineno += 1
+            elif self.contiguous:
+                last = min(lineno + size,nindexed)
+                size = min(2*size,blocklines)
+                end = self.offsets[last] if last < nindexed else self.scanned
+                text = self.map[self.offsets[lineno]:end].decode(self.encoding,self.errors)
+                for line in text.split("\n")[:last - lineno]:
+                    yield lineno,line.rstrip()
+                    lineno += 1
+            else:
+                yield lineno,self.decode(self.offsets[lineno])
+                lineno += 1
+
+    def matchinglines(self,mystring,start):
+#       generate the numbers of the lines from start on that contain mystring.
+#       A literal string is searched for in the mapped bytes, so only the lines
+#       that contain it are decoded (each hit is checked on the decoded line).
+        pattern = getpattern(mystring)
+        if isinstance(pattern,LiteralPattern) and self.contiguous and mystring:
+            try:
+                needle = mystring.encode(self.encoding)
+            except UnicodeEncodeError:
+                return
+            if not self.fill(start):
+                return
+            position = self.offsets[start] if start < len(self.offsets) else self.size
+            while True:
+                position = self.map.find(needle,position)
+                if position < 0:
+                    break
+                self.fillbytes(position)
+                lineno = bisect.bisect_right(self.offsets,position) - 1
+                if pattern.search(self[lineno]):
+                    yield lineno
+                position = self.map.find(b"\n",position)
+                if position < 0:
+                    break
+                position += 1
+            self.fillall()
+            for lineno in range(max(start,len(self.offsets)),len(self)):
+                if pattern.search(self.extra[lineno - len(self.offsets)]):
+                    yield lineno
+            return
+        search = pattern.search
+        for lineno,line in self.scan(start):
+            if search(line):
+                yield lineno
+
+
+class PackedLines:
+#   The lines of an input file kept as the text of the whole file in one string, plus an
+#   array of the position at which each line starts: about 8 bytes per line on top of the
+#   text, instead of a str object (50-80 bytes) per line.  A line is cut out of the text
+#   (and rstripped) only when it is accessed.  Deleting lines deletes their positions, not
+#   their text.  Lines appended after the file's own (the blank line createInputFile adds)
+#   are kept in self.extra, as in MmapLines.
+
+    def __init__(self,text,chunksize=1<<22):
+        self.text = text
+        self.starts = array("Q")
+        position = 0
+        while position < len(text):
+            stop = text.rfind("\n",position,position + chunksize)
+            if stop < 0:
+                stop = text.find("\n",position + chunksize)
+            if stop < 0:
+                stop = len(text) - 1    # last line, without a newline
+            pieces = text[position:stop+1].split("\n")
+            if pieces[-1] == "":
+                pieces.pop()
+            self.starts.extend(itertools.accumulate(itertools.chain((position,),
+                                                    (len(x) + 1 for x in pieces[:-1]))))
+            position = stop + 1
+        self.extra = []
+
+    def __len__(self):
+        return len(self.starts) + len(self.extra)
+
+    def line(self,start):
+        end = self.text.find("\n",start)
+        if end < 0:
+            end = len(self.text)
+        return self.text[start:end].rstrip()
+
+    def __getitem__(self,index):
+        if isinstance(index,slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("file has no line {}".format(index))
+        if index < len(self.starts):
+            return self.line(self.starts[index])
+        return self.extra[index - len(self.starts)]
+
+    def __delitem__(self,index):
+        start,stop,step = index.indices(len(self))
+        nstarts = len(self.starts)
+        del self.starts[min(start,nstarts):min(stop,nstarts)]
+        if stop > nstarts:
+            del self.extra[max(start - nstarts,0):stop - nstarts]
+
+    def append(self,line):
+        self.extra.append(line)
+
+    def blocks(self,start=0,blocksize=1024,firstblock=16):
+#       yield (number of the first line, list of lines) for the lines from start on, cutting
+#       each run of lines out of the text at once when nothing between them was deleted (it
+#       then splits into exactly that many lines).  The first run is firstblock lines and
+#       each next one twice as long, up to blocksize, so that a search that stops after a
+#       few lines cuts out only a few
+        starts = self.starts
+        first = start
+        size = firstblock
+        while first < len(starts):
+            last = min(first + size,len(starts)) - 1
+            end = self.text.find("\n",starts[last])
+            if end < 0:
+                end = len(self.text)
+            block = self.text[starts[first]:end].split("\n")
+            if len(block) == last - first + 1:
+                yield first,[x.rstrip() for x in block]
+            else:
+                yield first,[self.line(x) for x in starts[first:last+1]]
+            first = last + 1
+            size = min(2*size,blocksize)
+        if self.extra:
+            nstarts = len(starts)
+            yield max(start,nstarts),self.extra[max(start - nstarts,0):]
+
+    def __iter__(self):
+        for first,block in self.blocks():
+            yield from block
+
+    def matchinglines(self,mystring,start):
+#       yield the numbers of the lines from start on that contain mystring.  Plain text is
+#       found with str.find in the text itself, and the line of each hit by bisecting the
+#       line starts, so only the lines that contain it are cut out (each hit is checked on
+#       its line); other patterns are searched line by line
+        pattern = getpattern(mystring)
+        search = pattern.search
+        starts = self.starts
+        if isinstance(pattern,LiteralPattern) and mystring and start < len(starts):
+            text = self.text
+            position = starts[start]
+            found = -1
+            while True:
+                position = text.find(mystring,position)
+                if position < 0:
+                    break
+                lineno = bisect.bisect_right(starts,position) - 1
+                if lineno > found and search(self.line(starts[lineno])):
+                    found = lineno
+                    yield lineno
+                position = text.find("\n",position)
+                if position < 0:
+                    break
+                position += 1
+            start = len(starts)
+        for first,block in self.blocks(start):
+            for offset,line in enumerate(block):
+                if search(line):
+                    yield first + offset
+
+    def copy(self):
+#       another PackedLines over the same text, with its own positions
+        other = copy.copy(self)
+        other.starts = array("Q",self.starts)
+        other.extra = list(self.extra)
+        return other
+
+
+class PieceLines:
+#   The lines of a file as a table of pieces, each the run base[start:stop] of some list of
+#   lines: at first the list the file was read into, later also lists of lines inserted or
+#   appended.  Deleting or inserting lines changes a few entries of the table instead of
+#   moving all the lines after them, and a line is found by bisecting the line numbers at
+#   which the pieces start.  The table only changes lists it made itself (owned pieces),
+#   so the list it starts from can be shared with other files (see InputFile.sharedcopy).
+#   Once edits leave more than maxpieces pieces, they are joined into one list again.
+
+    maxpieces = 256
+
+    def __init__(self,lines=(),owned=False):
+        if not isinstance(lines,list):
+            lines,owned = list(lines),True
+        self.pieces = [[lines,0,len(lines),owned]] if lines else []
+        self.renumber()
+
+    def renumber(self):
+#       recompute the first line number of each piece (and, last, the number of lines),
+#       first joining the pieces if there are too many
+        if len(self.pieces) > self.maxpieces:
+            lines = list(self)
+            self.pieces = [[lines,0,len(lines),True]]
+        self.starts = list(itertools.accumulate((piece[2] - piece[1] for piece in self.pieces),
+                                                initial=0))
+        self.lastpiece = 0
+
+    def __len__(self):
+        return self.starts[-1]
+
+    def findpiece(self,index):
+#       the number of the piece holding line index (0 <= index < len(self))
+        i = self.lastpiece
+        starts = self.starts
+        if not starts[i] <= index < starts[i+1]:
+            i = bisect.bisect_right(starts,index) - 1
+            self.lastpiece = i
+        return i
+
+    def splitat(self,index):
+#       make a piece start at line index (splitting the piece holding it if need be)
+#       and return its number (len(self.pieces) if index is the number of lines)
+        if index >= len(self):
+            return len(self.pieces)
+        i = self.findpiece(index)
+        offset = index - self.starts[i]
+        if offset:
+            base,start,stop,owned = self.pieces[i]
+            self.pieces[i:i+1] = [[base,start,start + offset,owned],[base,start + offset,stop,owned]]
+            self.starts.insert(i + 1,index)
+            i += 1
+        return i
+
+    def checkindex(self,index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("file has no line {}".format(index))
+        return index
+
+    def __getitem__(self,index):
+        if isinstance(index,slice):
+            start,stop,step = index.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start,stop,step)]
+            mylines = []
+            for first,block in self.blocks(start):
+                if first >= stop:
+                    break
+                mylines.extend(block[:stop - first])
+            return mylines
+        index = self.checkindex(index)
+        i = self.findpiece(index)
+        base,start,stop,owned = self.pieces[i]
+        return base[start + index - self.starts[i]]
+
+    def __setitem__(self,index,value):
+        if isinstance(index,slice):
+            start,stop,step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("cannot assign to an extended slice of lines")
+            value = list(value)
+            first = self.splitat(start)
+            last = self.splitat(max(start,stop))
+            self.pieces[first:last] = [[value,0,len(value),True]] if value else []
+            self.renumber()
+            return
+        index = self.checkindex(index)
+        i = self.findpiece(index)
+        piece = self.pieces[i]
+        if piece[3]:
+            piece[0][piece[1] + index - self.starts[i]] = value
+        else:
+            self[index:index+1] = [value]
+
+    def __delitem__(self,index):
+        if isinstance(index,slice):
+            start,stop,step = index.indices(len(self))
+            if step != 1:
+                for i in sorted(range(start,stop,step),reverse=True):
+                    del self[i:i+1]
+                return
+        else:
+            start = self.checkindex(index)
+            stop = start + 1
+        if stop > start:
+            first = self.splitat(start)
+            last = self.splitat(stop)
+            del self.pieces[first:last]
+            self.renumber()
+
+    def append(self,line):
+        self.extend([line])
+
+    def extend(self,mylines):
+        mylines = list(mylines)
+        if not mylines:
+            return
+        last = self.pieces[-1] if self.pieces else None
+        if last is not None and last[3] and last[2] == len(last[0]):
+            last[0].extend(mylines)
+            last[2] += len(mylines)
+        else:
+            self.pieces.append([mylines,0,len(mylines),True])
+            self.starts.append(self.starts[-1])
+        self.starts[-1] += len(mylines)
+
+    def blocks(self,start=0,blocksize=4096):
+#       yield (number of the first line, list of lines) for the lines from start on
+        if start >= len(self):
+            return
+        i = bisect.bisect_right(self.starts,start) - 1
+        for piece,first in zip(self.pieces[i:],self.starts[i:]):
+            base,begin,stop,owned = piece
+            begin += max(start - first,0)
+            first = max(start,first)
+            for block in range(begin,stop,blocksize):
+                yield first + block - begin,base[block:min(block + blocksize,stop)]
+
+    def __iter__(self):
+        for first,block in self.blocks():
+            yield from block
+
+    def matchinglines(self,mystring,start):
+#       yield the numbers of the lines from start on that contain mystring
+        search = getpattern(mystring).search
+        for first,block in self.blocks(start):
+            for offset,line in enumerate(block):
+                if search(line):
+                    yield first + offset
+
+    def copy(self):
+#       another PieceLines with the same lines; from now on neither changes the lists
+#       they share in place
+        for piece in self.pieces:
+            piece[3] = False
+        other = copy.copy(self)
+        other.pieces = [list(piece) for piece in self.pieces]
+        other.starts = list(self.starts)
+        return other
+
+
+class LinePositions(dict):
+#   The remembered positions (labels) of a file: label -> line number.  Deleting lines
+#   (see deleted) only records the deletion; a label is moved up past the deleted lines,
+#   or forgotten if its line was deleted, when it is next looked up.
+
+    def __init__(self,*args,**kwargs):
+        dict.__init__(self,*args,**kwargs)
+        self.deletions = []     # (first,last) line numbers of each deletion, in order
+        self.applied = {}       # label -> number of deletions already applied to it
+
+    def deleted(self,start,end):
+#       note that lines start to end (inclusive) have been deleted
+        self.deletions.append((start,end))
+        if len(self.deletions) > 64:
+#           apply them all so the list does not grow without end
+            for key in list(dict.keys(self)):
+                self.resolve(key)
+            self.deletions = []
+            self.applied = {}
+
+    def resolve(self,key):
+#       apply the deletions made since key was set; return whether it still exists
+        done = self.applied.get(key,0)
+        if done == len(self.deletions) or not dict.__contains__(self,key):
+            return dict.__contains__(self,key)
+        z = dict.__getitem__(self,key)
+        for start,end in self.deletions[done:]:
+            if start <= z <= end:
+                msg(oginfo,"deleting remembered position {} with value {}",key,z)
+                dict.__delitem__(self,key)
+                self.applied.pop(key,None)
+                return False
+            if z > end:
+                z -= end - start + 1
+        msg(oginfo,"resetting remembered position {} to {}",key,z)
+        dict.__setitem__(self,key,z)
+        self.applied[key] = len(self.deletions)
+        return True
+
+    def __setitem__(self,key,value):
+        dict.__setitem__(self,key,value)
+#       (a label with no entry in applied was set before all the deletions)
+        if self.deletions:
+            self.applied[key] = len(self.deletions)
+
+    def __getitem__(self,key):
+        if self.deletions:
+            self.resolve(key)
+        return dict.__getitem__(self,key)
+
+    def __contains__(self,key):
+        return self.resolve(key)
+
+    def get(self,key,default=None):
+        return dict.__getitem__(self,key) if self.resolve(key) else default
+
+    def pop(self,key,*default):
+        self.resolve(key)
+        self.applied.pop(key,None)
+        return dict.pop(self,key,*default)
+
+    def __delitem__(self,key):
+        dict.__delitem__(self,key)
+        self.applied.pop(key,None)
+
+    def keys(self):
+        for key in list(dict.keys(self)):
+            self.resolve(key)
+        return dict.keys(self)
+
+    def items(self):
+        self.keys()
+        return dict.items(self)
+
+    def values(self):
+        self.keys()
+        return dict.values(self)
+
+    def copy(self):
+        self.keys()
+        return LinePositions(dict.items(self))
 
 
 class InputFile(InternalFile):
 # InputFile is object holding an input file
 
+#   whether a file read in full may keep its lines as PackedLines (see setcompactinputs)
+    compactable = True
+
     def __init__(self,content,start=None,end=None):    # fh is a filehandler object or a list of strings
         InternalFile.__init__(self)
         self.type = "InputFile"
+        self.searchengine = self.session.searchengine
+        self.sourceinfo = None      # os.fstat of the file read, while the lines are unchanged
+        self.trigrampath = None     # where its TrigramIndex is saved (see setindexcache)
         if isinstance(content,list):
             self.loadinputfilefromstringlist(content,start,end)
         elif isinstance(content,str):
@@ -688,7 +2908,7 @@ class InputFile(InternalFile):
             self.loadinputfilefromstringlist(contentlist,start,end)
         else:
             self.getinputfile(content,start,end)
-            msg(ogmain,"reading {}".format(content.name))
+            msg(ogmain,"reading {}",content.name)
         self.initializepositions()
         self.fieldnameslist = initializenameslist("$field",100)
         self.slicenameslist = initializenameslist("$slice",100)
@@ -709,12 +2929,20 @@ class InputFile(InternalFile):
                 self.lines=[x.rstrip() for i,x in enumerate(mystringlist) if i>= start and i<=end]
 
         self.length = len(self.lines)
+        self.linesmodified()
 
     def getinputfile(self,fh,start=None,end=None):
 #   fh is a filehandler object. If fh == 0 or None, do nothing
 #   read in the file (or part of it) and load into "lines" list
         if not fh or fh == 0:
             return
+        if self.session.compactinputs and self.compactable and start is None and end is None:
+            with fh as f:
+                self.lines = PackedLines(f.read())
+            self.setsource(fh,fileinfo(fh))
+            self.length = len(self.lines)
+            self.linesmodified()
+            return
         if end is None:
             if start is None:  # no start and no end specified: read entire file
                 with fh as f:
@@ -729,15 +2957,35 @@ class InputFile(InternalFile):
             else:              # both given: read from "start" to "end"
                 with fh as f:
                     self.lines=[x.rstrip() for i,x in enumerate(f) if i>= start and i<=end]
+        if start is None and end is None:
+            self.setsource(fh,fileinfo(fh))
 
         self.length = len(self.lines)
+        self.linesmodified()
+
+    def setsource(self,fh,info):
+#   note that the lines are those of the file open as fh, with os.fstat info (or None),
+#   so that indexes of it can be saved and reused while it is unchanged
+        self.sourceinfo = info
+        if self.session.indexcache is not None and info is not None:
+            self.trigrampath = lineindexpath(fh,info,".ogtri")
+
+    def sharedcopy(self):
+#   return a new file object of the same kind over the same lines (and search indexes),
+#   without copying them, but with its own current line, labels and matchflag.
+#   Its lines are copied only if it deletes some (see deleteinputsection).
+        other = copy.copy(self)
+        other.names = []
+        other.positions = self.positions.copy()
+        other.sharedlines = True
+        return other
 
     def initializepositions(self):
 #   define standard locations within the file
 #   define a dictionary to hold them and any remembered positions
 #   initialize current to first line of file
         self.current=0
-        self.positions = {}
+        self.positions = LinePositions()
         self.positions["current"] = self.current
         self.positions["top"] =     0
         self.positions["bottom"] =  self.length - 1
@@ -799,18 +3047,18 @@ class InputFile(InternalFile):
 
     def remember(self,myposition):
 #   label current line for later use
-        msg(oginfo,"--remembering current line as {}".format(myposition))
+        msg(oginfo,"--remembering current line as {}",myposition)
         if myposition in self.reserved_positions:
-            msg(ogmain,"Unable to overwrite reserved position {}.".format(myposition)) 
+            msg(ogmain,"Unable to overwrite reserved position {}.",myposition) 
             return
         else:
             self.positions[myposition] = self.current 
 
     def forget(self,myposition):
 #   remove reference to myposition
-        msg(ogdebug,"--forgetting line position {}".format(myposition))
+        msg(ogdebug,"--forgetting line position {}",myposition)
         if myposition in self.reserved_positions:
-            msg(ogmain,"Unable to forget reserved position {}.".format(myposition)) 
+            msg(ogmain,"Unable to forget reserved position {}.",myposition) 
             return
         else:
             del self.positions[myposition]
@@ -855,6 +3103,18 @@ class InputFile(InternalFile):
 #   with keys $field1, $field2, etc. defined in fieldnameslist
         return getfielddic(self.lines[self.current],self.fieldnameslist,delim)
 
+    def getfieldlist(self,delim="whitespace"):
+#   return the fields of the current line (stripped) split on delim.  The split is kept
+#   for the next call, e.g. dumpfields after holdfields on the same line, and used
+#   again if the line number, delimiter and line are all the same
+        text = self.lines[self.current]
+        cache = self.fieldcache
+        if cache is not None and cache[0] == self.current and cache[1] == delim and cache[2] == text:
+            return cache[3]
+        fields = splitfields(text,delim)
+        self.fieldcache = (self.current,delim,text,fields)
+        return fields
+
     def getslices(self,startend):
 #   return slices from current line based on startend (see getsliceslist)
 #   e.g.:to get columns 2-5 as $slice1 and 8-13 as $slice2, startend = [(2,5),(8,13)]
@@ -872,40 +3132,134 @@ class InputFile(InternalFile):
         else:
             dir = -1
             myend = -1
-        msg(ogdebug,"--in match, dir= {}".format(dir)) 
-        msg(ogdebug,"--in match, searching for \"{}\" from line {} to {}".format(mystring,mystart,myend-1)) 
+        msg(ogdebug,"--in match, dir= {}",dir) 
+        msg(ogdebug,"--in match, searching for \"{}\" from line {} to {}",mystring,mystart,myend-1) 
         nfound = 0
         self.matchflag = False
-        msg(ogdebug,"--in match, setting matchflag to {}".format(self.matchflag)) 
+        msg(ogdebug,"--in match, setting matchflag to {}",self.matchflag) 
+        if dir == 1:
+            linenumbers = self.fastmatches(mystring,mystart)
+            if linenumbers is not None:
+                return self.matchlines(linenumbers,mystring,nfind)
+        search = getpattern(mystring).search
+        lines = self.lines
+        lastline = self.length - 1
         for lineno in range(mystart,myend,dir):
-            searchObj = re.search(mystring,self.lines[lineno])
+            searchObj = search(lines[lineno])
             if searchObj:
                 nfound += 1
                 self.goto(lineno) 
-                msg(oginfo,"found {} match of \"{}\" out of {} on line {}:".format(nfound,mystring,nfind,lineno))
-                msg(oginfo,self.lines[lineno])
-                msg(ogverbose,"found returned search object \"{}\"".format(searchObj))
+                msg(oginfo,"found {} match of \"{}\" out of {} on line {}:",nfound,mystring,nfind,lineno)
+                msg(oginfo,lines[lineno])
+                msg(ogverbose,"found returned search object \"{}\"",searchObj)
                 if nfind == nfound:
                     self.matchflag = True
-                    msg(ogdebug,"--in match, setting matchflag to {}".format(self.matchflag)) 
+                    msg(ogdebug,"--in match, setting matchflag to {}",self.matchflag) 
                     return nfind
-            elif mystart != self.length - 1 and lineno == self.length -1:
+            elif mystart != lastline and lineno == lastline:
                 self.matchflag = False
-                msg(ogdebug,"--in match, setting matchflag to {}".format(self.matchflag)) 
+                msg(ogdebug,"--in match, setting matchflag to {}",self.matchflag) 
                 msg(oginfo,"reached end of file during match.")
-                msg(oginfo,"found only {} out of {} matches of \"{}\"".format(nfound,nfind,mystring)) 
-                self.goto(self.length - 1)
+                msg(oginfo,"found only {} out of {} matches of \"{}\"",nfound,nfind,mystring) 
+                self.goto(lastline)
                 return -1
             elif mystart != 0 and lineno == 0:
                 self.matchflag = False
-                msg(ogdebug,"--in match, setting matchflag to {}".format(self.matchflag)) 
+                msg(ogdebug,"--in match, setting matchflag to {}",self.matchflag) 
                 msg(oginfo,"reached beginning of file during match.")
-                msg(oginfo,"found only {} out of {} matches of \"{}\"".format(nfound,nfind,mystring)) 
+                msg(oginfo,"found only {} out of {} matches of \"{}\"",nfound,nfind,mystring) 
                 self.goto(0)
                 return -1
 
         return 0
 
+    def fastmatches(self,mystring,start):
+#   the numbers of the lines from start on that contain mystring, from the search buffer,
+#   trigram index or line storage (see match), or None if the lines are to be searched
+#   one by one
+        if self.searchengine == "buffer":
+            searchbuffer = self.getsearchbuffer(mystring)
+            if searchbuffer is not None:
+                return searchbuffer.matchinglines(mystring,self.lines,start)
+        if self.searchengine == "trigram":
+            linenumbers = self.gettrigramindex().matchinglines(mystring,self.lines,start)
+            if linenumbers is not None:
+                return linenumbers
+        if isinstance(self.lines,(PackedLines,PieceLines)):
+            return self.lines.matchinglines(mystring,start)
+        return None
+
+    def matchinglines(self,mystring,start):
+#   the numbers of the lines from start on that contain mystring, found the fastest way
+        linenumbers = self.fastmatches(mystring,start)
+        if linenumbers is None:
+            search = getpattern(mystring).search
+            lines = self.lines
+            linenumbers = (lineno for lineno in range(start,self.length) if search(lines[lineno]))
+        return linenumbers
+
+    def hasline(self,lineno):
+#   True if the file has a line number lineno
+        return lineno < self.length
+
+    def matchlimit(self):
+#   the largest number of matches a search through the file can find (nfind "all")
+        return self.length
+
+    def getsearchbuffer(self,mystring):
+#   return the SearchBuffer for the current lines (built the first time it is needed
+#   after any change) or None if mystring or the lines cannot be searched that way
+        for unsafe in bufferunsafe:
+            if unsafe in mystring:
+                return None
+        if self.searchbuffer is None:
+            msg(ogverbose,"building search buffer for {} file {}",self.type,self.names)
+            self.searchbuffer = SearchBuffer(self.lines)
+        if not self.searchbuffer.valid:
+            return None
+        return self.searchbuffer
+
+    def gettrigramindex(self):
+#   return the TrigramIndex for the current lines, built the first time it is needed
+#   (or, with an index cache, loaded if it was saved for the unchanged file)
+        if self.trigramindex is None:
+            path = self.trigrampath if self.sourceinfo is not None else None
+            if path is not None:
+                self.trigramindex = loadtrigramindex(path,self.sourceinfo,len(self.lines))
+            if self.trigramindex is None:
+                msg(ogverbose,"building trigram index for {} file {}",self.type,self.names)
+                self.trigramindex = TrigramIndex(self.lines)
+                if path is not None:
+                    savetrigramindex(path,self.sourceinfo,self.trigramindex,len(self.lines))
+        return self.trigramindex
+
+    def matchlines(self,linenumbers,mystring,nfind=1):
+#   forward version of match given the numbers of the lines, from the current one on, that
+#   contain mystring (from a SearchBuffer or a lazily read file): same results, current line
+#   and matchflag
+        mystart = self.current
+        nfound = 0
+        lineno = -1
+        for lineno in linenumbers:
+            nfound += 1
+            self.goto(lineno)
+            msg(oginfo,"found {} match of \"{}\" out of {} on line {}:",nfound,mystring,nfind,lineno)
+            msg(oginfo,self.lines[lineno])
+            if nfind == nfound:
+                self.matchflag = True
+                msg(ogdebug,"--in match, setting matchflag to {}",self.matchflag) 
+                return nfind
+#       as in match: running off the end (without a hit on the last line) is reported with -1
+        lastline = len(self.lines) - 1
+        if mystart != lastline and lineno != lastline:
+            self.matchflag = False
+            msg(ogdebug,"--in match, setting matchflag to {}",self.matchflag) 
+            msg(oginfo,"reached end of file during match.")
+            msg(oginfo,"found only {} out of {} matches of \"{}\"",nfound,nfind,mystring) 
+            self.goto(lastline)
+            return -1
+        return 0
+
     def matchnextreturn(self,mystring,nfind=1,increment=0,nlines=1):
 #   for nfind instances: find match string, go forward or backward increment lines,
 #   (determined by sign) and return nlines lines.
@@ -914,14 +3268,27 @@ class InputFile(InternalFile):
 #   Default is search for mystring once, and return the line containing the match.
 #   Note the special value for nfind: "all": searches the entire file
 
+        hits = None
         if nfind == "all":
-            nfind = self.length
+#           search the file once (in parallel if it is large enough) rather than once per hit
+            nfind = self.matchlimit()
+            hits = self.parallelmatches(mystring)
+            if hits is None:
+                hits = self.matchinglines(mystring,self.current)
+            hits = iter(hits)
 
         mylines = []
         for i in range(nfind):
-            result = self.match(mystring,nfind=1,dir=1)
+            if hits is None:
+                result = self.match(mystring,nfind=1,dir=1)
+            else:
+#               the same as match, but from the lines found to match, skipping those
+#               before the current line (the lines returned with the last hit)
+                self.matchflag = False
+                current = self.current
+                result = self.matchlines(itertools.dropwhile(lambda lineno: lineno < current,hits),mystring)
             if result == 0: 
-                msg(oginfo,"match {} of \"{}\" not found in matchnextreturn.".format(i+1,mystring))
+                msg(oginfo,"match {} of \"{}\" not found in matchnextreturn.",i+1,mystring)
                 break
             elif result == -1: 
                 msg(oginfo,"reached end or begin of file in matchnextreturn") 
@@ -929,7 +3296,7 @@ class InputFile(InternalFile):
             elif result < -1:
                 msg(oginfo,"something weird in match called from matchnextreturn") 
                 break                
-            if self.current + nlines <= self.length: 
+            if self.hasline(self.current + nlines - 1): 
                 if increment == 0 and nlines == 1:
                     mylines.append(self.getline())
                     self.step(nlines)
@@ -938,13 +3305,20 @@ class InputFile(InternalFile):
                     mylines.extend(self.getlines(nlines))
                     self.step(nlines)
             else:
-                msg(oginfo,"Not enough lines in file for return section in matchnextreturn".format(i+1))
+                msg(oginfo,"Not enough lines in file for return section in matchnextreturn",i+1)
                 mylines.append(self.getlines(nlines))
                 result = self.step(nlines)
                 break 
 
         return mylines
 
+    def parallelmatches(self,mystring):
+#   the numbers of all the lines from the current one on that contain mystring, if the
+#   file is large enough to be searched by several processes (see setscanjobs), else None
+        if self.searchengine == "trigram":
+            return None
+        return parallelmatchinglines(self.lines,mystring,self.current)
+
     def empty(self):
 #   empty the file in memory
         self.deleteinputsection("top","bottom")
@@ -952,41 +3326,53 @@ class InputFile(InternalFile):
     def deleteinputsection(self,position1,position2):
 #   delete lines from an input file in memory
 #   probably doing this for memory or efficiency for future searches
-        msg(ogdebug,"--deleteinputsection positions 1 & 2: {} {} ".format(position1,position2))
+        msg(ogdebug,"--deleteinputsection positions 1 & 2: {} {} ",position1,position2)
         start = self.interpretposition(position1)
         end = self.interpretposition(position2)
-        msg(oginfo,"deleting input from line {} to line {} in {} ".format(start,end,self.names))
+        msg(oginfo,"deleting input from line {} to line {} in {} ",start,end,self.names)
+        trigramindex = self.trigramindex
+        self.sourceinfo = None
+        if isinstance(self.lines,list):
+#           delete from a piece table over the list rather than moving the lines after
+#           the deleted ones (and the list can stay shared)
+            self.lines = PieceLines(self.lines)
+        if self.sharedlines:
+#           copy the lines (and leave the index) of the file they are shared with
+            self.lines = self.lines.copy()
+            self.sharedlines = False
+            trigramindex = None
         del self.lines[start:end+1]
-        if len(self.lines) == 0:
+        if not self.lines:
             self.lines.append("")
+        self.linesmodified()
+        if trigramindex is not None and end >= start:
+#           cheaper to shift the line numbers in the index than to build it again
+            trigramindex.delete(start,end)
+            self.trigramindex = trigramindex
         self.updatelabels(start,end)
         
         return
 
     def updatelabels(self,start,end):
 #   update the remembered labels after deleting section of input file in memory
-        keylist =  list(self.positions.keys())
-        for mykey in keylist:
-            z = self.positions[mykey]
-            if z >= start and z <= end:  
-                msg(oginfo,"deleting remembered position {} with value {}".format(mykey,z))
-#                del self.positions[mykey]
-                self.forget(mykey)
-            if z > end:
-                z = z - (end - start) 
-                msg(oginfo,"resetting remembered position {} to {}".format(mykey,z))
-                self.positions[mykey]=z
+#   (each label is moved, or forgotten, when it is next used; see LinePositions)
+        if end >= start:
+            self.positions.deleted(start,end)
         msg(oginfo,"resetting current position to top of file")
         self.updatecurrent(0)
         msg(oginfo,"resetting \"top\" and \"bottom\" remembered labels")
         self.length = len(self.lines)
         self.positions["top"] =     0
+        self.resetbottom()
+        return
+
+    def resetbottom(self):
+#   set the "bottom" label from the lines now in the file
         finalline = self.lines[self.length - 1]
         if finalline == "":
             self.positions["bottom"] =  self.length - 2  # assume xtra blank line is there
         else:
             self.positions["bottom"] =  self.length - 1  # assume xtra blank line is not there
-        return
 
 class ScratchFile(InputFile,OutputFile):
 #   A Scratchfile has the methods and attributes of both InputFile and OutputFile
@@ -996,9 +3382,10 @@ class ScratchFile(InputFile,OutputFile):
     def __init__(self,content,start=None,end=None):
         InputFile.__init__(self,content,start,end)
         self.type = "ScratchFile"
+        self.lines = newlinelist(self.lines)
         addfilename(self,"scratch")
         msg(ogdebug,"Initializing scratch file.")
-        msg(ogdebug,"Names = {}".format(self.names))
+        msg(ogdebug,"Names = {}",self.names)
 
     def addline(self,mystring,printblank=False):
 #   add mystring as new line at end of file
@@ -1008,9 +3395,10 @@ class ScratchFile(InputFile,OutputFile):
                 msg(ogdebug,"-- not adding blank line in addline")
                 return
         else:
-            msg(ogdebug,"--adding line \"{}\" to {} file {}".format(mystring,self.type,self.names))
+            msg(ogdebug,"--adding line \"{}\" to {} file {}",mystring,self.type,self.names)
             self.lines.append(mystring)
             self.length += 1
+            self.linesmodified()
             self.current += 1
             self.positions["bottom"] = self.current
 
@@ -1021,13 +3409,183 @@ class ScratchFile(InputFile,OutputFile):
             msg(ogdebug,"-- not adding empty lines in addlines")
             return
         else:
-            msg(ogdebug,"--adding lines \"{}\" to {} file {}".format(mylines,self.type,self.names))
+            msg(ogdebug,"--adding lines \"{}\" to {} file {}",mylines,self.type,self.names)
             self.lines.extend(mylines)
             self.length += len(mylines)
+            self.linesmodified()
             self.current += len(mylines)
             self.positions["bottom"] = self.current
 
 
+class Instruction:
+#   A compiled outgrab program line.
+#   kind is "command", "blank", "comment" or "exit"; for commands, tokens are the
+#   split line, arg1/kwargs (or args) the arguments as getargs returns them,
+#   and spec the registry entry (OutgrabCommand) of the command, or None if unknown.
+#   params holds the arguments already converted for the command (ints, booleans...)
+#   so that a line executed many times (e.g. inside repeat) is only parsed once.
+#   error is why the arguments could not be converted, if they could not: it is only
+#   reported if the line runs, so a line skipped within ifmatch may have bad arguments.
+
+    def __init__(self,kind,text,lineno=None):
+        self.kind = kind
+        self.text = text
+        self.lineno = lineno
+        self.command = ""
+        self.tokens = []
+        self.arg1 = ""
+        self.kwargs = {}
+        self.args = []
+        self.params = {}
+        self.spec = None
+        self.error = ""
+
+    def __repr__(self):
+        return "Instruction({},{!r},line {})".format(self.kind,self.text,self.lineno)
+
+
+class LazyInputFile(InputFile):
+#   An InputFile whose lines are read or indexed only as far as commands need them
+#   (self.lines is a StreamLines or MmapLines rather than a list), so that opening a large
+#   input costs nothing up front.  self.length is the number of lines known so far;
+#   "bottom" is known only once something has asked for it (which reads to the end).
+
+    def __init__(self,content):
+        InputFile.__init__(self,content)
+        self.searchengine = "lines"
+
+    def addblankline(self):
+#       the blank line at the end is added by self.lines when it reaches the end of the file
+        pass
+
+    def initializepositions(self):
+        self.current=0
+        self.positions = LinePositions()
+        self.positions["current"] = self.current
+        self.positions["top"] =     0
+        self.reserved_positions = ["top","bottom"]
+
+    def readto(self,lineno):
+#       read the file up to line lineno (if it has that many) and update length
+        found = self.lines.fill(lineno)
+        self.length = len(self.lines)
+        return found
+
+    def hasline(self,lineno):
+        return self.readto(lineno)
+
+    def matchlimit(self):
+        self.lines.fillall()
+        self.length = len(self.lines)
+        return self.length
+
+    def checkendposition(self,end):
+        self.readto(end)
+        return InputFile.checkendposition(self,end)
+
+    def interpretposition(self,myposition):
+        if myposition == "bottom" and "bottom" not in self.positions:
+            msg(oginfo,"reading to the end of {} {} to find bottom",self.type,self.names)
+            self.lines.fillall()
+            self.length = len(self.lines)
+            InputFile.resetbottom(self)
+        return InputFile.interpretposition(self,myposition)
+
+    def resetbottom(self):
+#       after a deletion, leave "bottom" to be found when it is needed
+        if self.lines.eof:
+            InputFile.resetbottom(self)
+        else:
+            self.positions.pop("bottom",None)
+
+    def match(self,mystring,*,nfind=1,dir=1):
+#   as InputFile.match, but a forward search reads the file only as far as the matches go
+#   (except with a trigram index, which is of the whole file)
+        if int(dir) < 0:
+            return InputFile.match(self,mystring,nfind=nfind,dir=dir)
+        if self.searchengine == "trigram":
+            self.matchlimit()
+            return InputFile.match(self,mystring,nfind=nfind,dir=dir)
+        msg(ogdebug,"--in match, searching for \"{}\" from line {} of {}",mystring,self.current,self.type) 
+        self.matchflag = False
+        return self.matchlines(self.lines.matchinglines(mystring,self.current),mystring,nfind)
+
+    def matchinglines(self,mystring,start):
+#       as InputFile.matchinglines, reading the file only as far as it is searched
+#       (all of it for a trigram index)
+        if self.searchengine == "trigram":
+            self.matchlimit()
+            return InputFile.matchinglines(self,mystring,start)
+        return self.lines.matchinglines(mystring,start)
+
+
+class StreamInputFile(LazyInputFile):
+#   An InputFile read lazily from a stream (stdin) for programs that only move forward
+#   through it (see ProgramFile.backwardcommand).  Lines are read as commands need them
+#   and dropped once they are more than lookbehind lines behind the current line,
+#   so memory does not grow with the size of the input.
+
+    def __init__(self,content,lookbehind=None):
+        if lookbehind is None:
+            lookbehind = currentsession().streamlookbehind
+        self.lookbehind = lookbehind
+        LazyInputFile.__init__(self,content)
+        self.type = "StreamInputFile"
+
+    def getinputfile(self,fh,start=None,end=None):
+#       instead of reading fh, set up the lazily read lines
+        self.lines = StreamLines(fh,lookbehind=self.lookbehind)
+        self.length = 0
+
+    def matchlimit(self):
+#       the number of lines is not known in advance; every forward match moves on
+        return sys.maxsize
+
+    def updatecurrent(self,newline):
+        InputFile.updatecurrent(self,newline)
+        self.lines.release(self.current - self.lookbehind)
+        return self.current
+
+    def match(self,mystring,*,nfind=1,dir=1):
+#   forward-only version of InputFile.match that reads the stream as it searches
+        if int(dir) < 0:
+            sys.exit("stopping: cannot match backwards (direction -1) in streamed input")
+        self.matchflag = False
+        return self.matchlines(self.matchinglines(mystring,self.current),mystring,nfind)
+
+    def matchinglines(self,mystring,start):
+        return self.lines.matchinglines(mystring,start,self.lookbehind)
+
+    def getuntilmatch(self,mystring,*,start=False,end=False):
+#   keep the lines from the current one while searching, so they can be returned
+        self.lines.pin = self.current
+        try:
+            return InputFile.getuntilmatch(self,mystring,start=start,end=end)
+        finally:
+            self.lines.pin = None
+
+    def deleteinputsection(self,position1,position2):
+        sys.exit("stopping: cannot delete lines from streamed input {}".format(self.names))
+
+
+class MmapInputFile(LazyInputFile):
+#   An InputFile for a file on disk that is memory-mapped instead of read (see MmapLines):
+#   only the part of the file that commands reach is indexed, and lines are decoded
+#   only when they are used, so e.g. "goto 1532" in a huge file is immediate.
+#   Unlike a StreamInputFile it can be searched backwards and deleted from.
+
+    def __init__(self,content):
+        LazyInputFile.__init__(self,content)
+        self.type = "MmapInputFile"
+        if self.session.searchengine == "trigram":
+            self.searchengine = "trigram"
+
+    def getinputfile(self,fh,start=None,end=None):
+        self.lines = MmapLines(fh)
+        self.length = 0
+        self.setsource(fh,self.lines.info)
+
+
 class ProgramFile(InputFile):
 #   A ProgramFile is an Inputfile with added methods so that it can be interpreted
 #   as an outgrab program file
@@ -1035,22 +3593,54 @@ class ProgramFile(InputFile):
 #   and self.outfile is the file to be written.
 #   They must be set by an outside program
 
+#   program lines are changed by include and compiled one by one, so they stay a list
+    compactable = False
+
     def __init__(self,fh,start=None,end=None):
         InputFile.__init__(self,fh,start=None,end=None)
         self.type = "ProgramFile"
         self.infile = ""
-        self.nestlevel = -1
-        self.loopmaxiter = []
-        self.loopiter = []
-        self.looplabel = []
+#       the open repeat loops, innermost last: [line of the repeat, iteration, ntimes]
+        self.loops = []
+        self.loopends = None
         self.matchflag = False
         self.execute  = True
         self.ifmatchlevel = -1
-        self.holddic = {}
+        self.holdlist = []
+        self.instructions = []
+        self.comments = ["#","!"]
 
     def setinputfile(self,infile):
         self.infile = infile
 
+    def linesmodified(self):
+        InputFile.linesmodified(self)
+#       include moves the endrepeat lines
+        self.loopends = None
+
+    def loopend(self,start):
+#       the line number of the endrepeat that closes the repeat on line start, or None.
+#       The repeat/endrepeat pairs of the whole program are matched the first time
+#       this is needed, and again after the program lines change (include)
+        if self.loopends is None:
+            self.loopends = {}
+            repeats = []
+            for lineno,line in enumerate(self.lines):
+                words = line.split(None,1)
+                if not words:
+                    continue
+                if words[0] == "repeat":
+                    repeats.append(lineno)
+                elif words[0] == "endrepeat" and repeats:
+                    self.loopends[repeats.pop()] = lineno
+        return self.loopends.get(start)
+
+    def jump(self,lineno):
+#       make program line lineno (a line number of the program, e.g. of a repeat) the
+#       current one, without the checks of goto
+        self.current = lineno
+        self.positions["current"] = lineno
+
     def setoutputfile(self,outfile):
         self.outfile = outfile
 
@@ -1062,23 +3652,32 @@ class ProgramFile(InputFile):
            after the current line (overwrite = False).
         """
 
-        msg(ogverbose,"inserting program file: {} ".format(filename))
+        msg(ogverbose,"inserting program file: {} ",filename)
         with open(filename, "r") as f:
             mylines = [x.rstrip().lstrip() for x in f]
 
             for thing in mylines:
-                msg(ogdebug," line = {} ".format(thing))
+                msg(ogdebug," line = {} ",thing)
 
             if overwrite:
                 lineadjust = 0
             else:
                 lineadjust = 1
-            self.lines = ( self.lines[:self.current+lineadjust]
-                         + [" "]   # insert blank line to ensure first line of new program lines executed
-                         + mylines[:]
-                         + self.lines[self.current+1:] )
+#           splice the lines into piece tables (see PieceLines) so that an include run
+#           again and again (in a loop) does not copy the whole program each time
+            if not isinstance(self.lines,PieceLines):
+                self.lines = PieceLines(self.lines)
+                self.instructions = PieceLines(self.instructions,owned=True)
+            instructions = self.instructions
+            instructions.extend([None]*(self.length - len(instructions)))
+            self.lines[self.current+lineadjust:self.current+1] = (
+                          [" "]   # insert blank line to ensure first line of new program lines executed
+                        + mylines )
+            instructions[self.current+lineadjust:self.current+1] = [None]*(len(mylines) + 1)
             
         self.length = len(self.lines) 
+        self.sourceinfo = None
+        self.linesmodified()
         self.positions["bottom"] =  self.length - 1
         self.current = self.current + lineadjust
         self.positions["current"] = self.current
@@ -1087,10 +3686,45 @@ class ProgramFile(InputFile):
         """process commands in this file; translate them to the outgrab methods
            ignore comment lines beginning with any character in comments
            and strip off any whitespace from beginning or end of line
+           Each program line is compiled into an Instruction the first time it
+           is reached (see compileline); later executions reuse it.
         """
-
+        for step in self.commandsteps(comments):
+            pass
+
+    async def aprocesscommands(self,comments=["#","!"],executor=None,yieldwork=None):
+        """ processcommands for a coroutine: every yieldwork (default asyncyieldwork) units
+            of work (a command, or an input line it moves over) let the other tasks of the
+            event loop run.  Commands that read or write files or search the input (see
+            registercommand) run on executor (default asyncexecutor()), and so do the
+            commands after them until the next pause, so that a search in a loop does not
+            cost a trip to a thread every time.
+        """
+        runinstruction = self.profileinstruction if self.session.profiling else self.runinstruction
+        steps = self.commandsteps(comments,yieldwork or asyncyieldwork)
+        for instruction in steps:
+            if instruction is not None:
+                if not await inthread(self.runsteps,steps,instruction,runinstruction,executor=executor):
+                    break
+            await asyncio.sleep(0)
+
+    def runsteps(self,steps,instruction,runinstruction):
+#       (on a thread) run instruction, a command that steps (see commandsteps) yielded
+#       rather than run, then go on with steps until they pause; return False if they end
+        runinstruction(instruction)
+        for step in steps:
+            if step is None:
+                return True
+            runinstruction(step)
+        return False
+
+    def commandsteps(self,comments,yieldwork=None):
+#       run the program (see processcommands).  Without yieldwork, nothing is yielded.
+#       With it, yield None after every yieldwork units of work (a command, or an input
+#       line it moves over), and yield each blocking or scanning command (see
+#       registercommand) instead of running it, to be run by the caller before going on.
         msg(ogmain,"The files known at the start of processing commands:")
-        samevalueslist = listofsamevaluekeys(ifilesd)
+        samevalueslist = listofsamevaluekeys(self.session.files)
         for item in samevalueslist:
             printline = "    "
             for key in item[:-1]:
@@ -1098,67 +3732,235 @@ class ProgramFile(InputFile):
             printline += item[-1]
             msg(ogmain,printline)
 
-        maxlastlinecount = 10
-        lastlinecount = 0
+        self.comments = comments
+#       with --profile, run each instruction through profileinstruction instead
+        profiling = self.session.profiling
+        runinstruction = self.profileinstruction if profiling else self.runinstruction
+        self.profile = {}
 
         countline = 0
+        work = 0
+        budget = yieldwork or sys.maxsize
         while True:
-            line = self.getline()
-            line = line.rstrip().lstrip()
+            instruction = self.getinstruction(self.current)
             countline +=1
-            msg(ogdebug,"In processcommands at start, matchflag, execute: {}, {}".format(self.matchflag,self.execute))
 
-            if self.interpretposition(self.current) >= self.interpretposition("bottom"):
-                lastlinecount +=1
-                msg(ogdebug,"Processing command at bottom of program file")
-
-            if lastlinecount >= maxlastlinecount:
-                msg(ogmain,"At end of program file for {} steps. Finishing processing outgrab commands."
-                .format(lastlinecount))
+            if instruction.kind == "command":
+                if msglevel <= ogdebug:
+                    msg(ogdebug,"In processcommands at start, matchflag, execute: {}, {}",self.matchflag,self.execute)
+                    msg(ogdebug,"*******processing outgrab file line {}*********************************",countline)
+                    msg(ogdebug,"Processing command:")
+                    msg(ogdebug," ")
+                    msg(ogdebug,"{} ",instruction.text)
+                    msg(ogdebug," ")
+                if yieldwork:
+                    infile = self.infile
+                    start = infile.current
+                    spec = instruction.spec
+                    if spec is not None and (spec.blocking or spec.scans):
+                        yield instruction
+                    else:
+                        runinstruction(instruction)
+                    work += 1
+                    if self.infile is infile:
+                        work += abs(infile.current - start)
+                else:
+                    runinstruction(instruction)
+                if msglevel <= ogdebug:
+                    msg(ogdebug,"In processcommands, after processcommand: matchflag, execute: {}, {}",self.matchflag,self.execute)
+            elif instruction.kind == "exit":
+                msg(ogmain,"Exit found: finished processing outgrab commands.")
                 msg(ogmain,"-------------------------------------------------")
                 break
-             
-            if line:
-                msg(ogdebug,"*******processing outgrab file line {}*********************************".format(countline))
-                iscomment = False 
-                for comment in comments:
-                    if line.startswith(comment):
-                        msg(ogdebug,"Found a comment: {} ".format(line))
-                        self.step()
-                        iscomment = True
-                        break
-                if not iscomment:
-                    if line.startswith("exit"):
-                        msg(ogmain,"Exit found: finished processing outgrab commands.")
-                        msg(ogmain,"-------------------------------------------------")
-                        break
-                    else:
-                        msg(ogdebug,"Processing command:")
-                        msg(ogdebug," ")
-                        msg(ogdebug,"{} ".format(line))
-                        msg(ogdebug," ")
-                        self.processcommand(line) 
-                        msg(ogdebug,"In processcommands, after processcommand: matchflag, execute: {}, {}".format(self.matchflag,self.execute))
-                        self.step()
-            else:
-                # blank line
-                self.step()
-             
+            elif instruction.kind == "comment":
+                msg(ogdebug,"Found a comment: {} ",instruction.text)
+
+#           on to the next line (after the repeat if endrepeat jumped back), unless this
+#           was the last one
+            nextline = self.current + 1
+            if nextline >= self.length:
+                msg(ogmain,"At end of program file. Finishing processing outgrab commands.")
+                msg(ogmain,"-------------------------------------------------")
+                break
+            self.current = nextline
+            self.positions["current"] = nextline
+            if work >= budget:
+                work = 0
+                yield None
+        if profiling:
+            self.profilereport()
+
+    def profileinstruction(self,instruction):
+#       runinstruction, adding to the profile of the instruction's program line: the number
+#       of executions, the time taken, the input lines moved over by commands that search
+#       (see registercommand) and the output lines added
+        infile = self.infile
+        outfile = self.outfile
+        start = infile.current
+        produced = outfile.length
+        started = time.perf_counter()
+        self.runinstruction(instruction)
+        elapsed = time.perf_counter() - started
+        record = self.profile.get(instruction)
+        if record is None:
+            record = self.profile[instruction] = [0,0.0,0,0]
+        record[0] += 1
+        record[1] += elapsed
+        if instruction.spec is not None and instruction.spec.scans and self.infile is infile:
+            record[2] += abs(infile.current - start)
+        if self.outfile is outfile:
+            record[3] += outfile.length - produced
+
+    def profilereport(self,fileh=None):
+#       write the profile of the program's lines (see profileinstruction) to fileh (stderr),
+#       slowest first.  Lines are numbered from 1, as in the program after any includes.
+        if fileh is None:
+            fileh = sys.stderr
+        total = sum(record[1] for record in self.profile.values()) or 1.0
+        fileh.write("Profile of program {}\n".format(self.names[0] if self.names else ""))
+        fileh.write("{:>6s} {:>10s} {:>10s} {:>6s} {:>10s} {:>10s} {:>10s}  {}\n".format(
+                    "line","count","seconds","%","us/call","scanned","output","command"))
+        for instruction,(count,elapsed,scanned,produced) in sorted(self.profile.items(),
+                                                                  key=lambda item: -item[1][1]):
+            fileh.write("{:>6d} {:>10d} {:>10.4f} {:>6.1f} {:>10.1f} {:>10d} {:>10d}  {}\n".format(
+                        instruction.lineno + 1,count,elapsed,100*elapsed/total,1e6*elapsed/count,
+                        scanned,produced,instruction.text))
+        fileh.write("{:>6s} {:>10d} {:>10.4f}\n".format("total",
+                    sum(record[0] for record in self.profile.values()),
+                    sum(record[1] for record in self.profile.values())))
+
+    def getinstruction(self,lineno):
+#       return the compiled Instruction for program line lineno, compiling it
+#       the first time it is needed.  self.instructions runs parallel to self.lines
+        instructions = self.instructions
+        if lineno >= len(instructions):
+            instructions.extend([None]*(len(self.lines) - len(instructions)))
+        instruction = instructions[lineno]
+        if instruction is None:
+            instruction = self.compileline(self.lines[lineno],lineno)
+            instructions[lineno] = instruction
+        return instruction
+
+    def compileline(self,line,lineno=None):
+#       turn one program line into an Instruction: classify it as blank, comment,
+#       exit or command, tokenize it, and convert its arguments
+        line = line.rstrip().lstrip()
+        if not line:
+            return Instruction("blank",line,lineno)
+        for comment in self.comments:
+            if line.startswith(comment):
+                return Instruction("comment",line,lineno)
+        if line.startswith("exit"):
+            return Instruction("exit",line,lineno)
+
+        instruction = Instruction("command",line,lineno)
+        instruction.tokens = stringtostringlist(line,delim="whitespace")
+        msg(ogdebug,"In compileline, tokens: {} ",instruction.tokens)
+        instruction.command = instruction.tokens[0]
+        self.compilecommand(instruction)
+        return instruction
+
+    def compilecommand(self,instruction):
+#       split the tokens of instruction into arguments according to the style of its command
+#       and let the command's compiler (see registercommand) convert them once
+#       to the values (ints, booleans...) used at every execution
+        command = instruction.command
+        spec = commandregistry.get(command)
+        instruction.spec = spec
+        style = spec.style if spec else "comargdict"
+        if style == "comargs":
+            instruction.args = self.getargs(instruction.tokens,"comargs")
+        else:
+            instruction.arg1,instruction.kwargs = self.getargs(instruction.tokens,"comargdict")
+        if spec is None or spec.compiler is None:
+            return
+
+        try:
+            spec.compiler(self,instruction)
+        except (ValueError,IndexError) as err:
+            instruction.error = str(err) or type(err).__name__
+
+    def badarguments(self,instruction):
+#       stop on instruction, whose arguments could not be converted when it was compiled
+        msg(ogmain,"Bad arguments for command {} near line {} in Program {}: {}",
+                   instruction.command,instruction.lineno,self.names,instruction.error)
+        sys.exit("stopping: bad arguments for command {} near line {} in Program {}"
+                   .format(instruction.command,instruction.lineno,self.names))
+
+    def outputtail(self):
+#       return the number of lines at the end of an output file that the commands of the
+#       program can change (see registercommand); a streamed output must hold those back.
+#       This is the sum for all the commands, not the largest: joinlast removes a line,
+#       so e.g. joinlast then switchlast with no new line in between reaches three lines.
+        tail = 0
+        for lineno in range(len(self.lines)):
+            instruction = self.getinstruction(lineno)
+            if instruction.kind == "exit":
+                break
+            if instruction.kind == "command" and instruction.spec is not None:
+                tail += instruction.spec.outputtail
+        return tail
+
+    def repeatedtail(self):
+#       return a description of the first command in the program that can change the end
+#       of an output file (see registercommand) an unknown number of times, or "" if there
+#       is none: outputtail counts each line once, but a line inside a repeat loop runs
+#       many times (and each joinlast reaches one line further back), and an included
+#       program may hold any commands.  Program lines only run again through repeat.
+        depth = 0
+        for lineno in range(len(self.lines)):
+            instruction = self.getinstruction(lineno)
+            if instruction.kind == "exit":
+                break
+            if instruction.kind != "command":
+                continue
+            if instruction.command == "repeat":
+                depth += 1
+            elif instruction.command == "endrepeat":
+                depth = max(0,depth - 1)
+            elif instruction.command == "include" or \
+                 (depth and instruction.spec is not None and instruction.spec.outputtail):
+                return "\"{}\" near line {}".format(instruction.text,lineno)
+        return ""
+
+    def readsoutput(self):
+#       return a description of the first command in the program that needs all the lines
+#       of an output file (see registercommand), or "" if there is none: the output of a
+#       program without such commands can be written while it runs (OutputFile.setstream)
+        for lineno in range(len(self.lines)):
+            instruction = self.getinstruction(lineno)
+            if instruction.kind == "exit":
+                break
+            if instruction.kind == "command" and instruction.spec is not None \
+               and instruction.spec.readsoutput:
+                return "\"{}\" near line {}".format(instruction.text,lineno)
+        return ""
+
+    def backwardcommand(self):
+#       return a description of the first command in the program that can move an input
+#       file backwards (see registercommand), or "" if there is none: a program without
+#       such commands can be run over streamed input (StreamInputFile)
+        for lineno in range(len(self.lines)):
+            instruction = self.getinstruction(lineno)
+            if instruction.kind == "exit":
+                break
+            if instruction.kind != "command" or instruction.spec is None or instruction.error:
+                continue
+            backward = instruction.spec.backward
+            if callable(backward):
+                backward = backward(instruction)
+            if backward:
+                return "\"{}\" near line {}".format(instruction.text,lineno)
+        return ""
+
     def processcommand(self,myline):
         """split the command up into the command itself and its keyword arguments
+           and execute it (one-off version of what processcommands does per line)
         """
-
-#       split outgrab command into tokens/parts; first is command
-#       e.g.  match thistext direction -1
-        msg(ogdebug,"In processcommand at start, matchflag, execute: {}, {}".format(self.matchflag,self.execute))
-
-        tokens = stringtostringlist(myline,delim="whitespace")
-        msg(ogdebug,"In processcommand, tokens: {} ".format(tokens))
-
-#       capture the command
-        command = tokens[0]
-
-        self.interpretcommand(command,tokens)
+        msg(ogdebug,"In processcommand at start, matchflag, execute: {}, {}",self.matchflag,self.execute)
+        instruction = self.compileline(myline,self.current)
+        if instruction.kind == "command":
+            self.runinstruction(instruction)
 
     def getargs(self,tokens,style):
 #        convert tokens into arguments based on style of command
@@ -1188,389 +3990,483 @@ class ProgramFile(InputFile):
                         lname = True
                         kwargs[myname] = myarg
 
-            msg(ogdebug,"In getargs , kwargs =: {} ".format(kwargs))
+            msg(ogdebug,"In getargs , kwargs =: {} ",kwargs)
             return arg1,kwargs
 
         elif style == "comargs":
             args = tokens[1:]
             return args
 
-    def processfields(self,args,mytext,holddic=[]):
-#       for use by dumpfields and related commands
-#       args are the arguments to that command
-#       mytext is the inputfile line the commands operate on
-#       command line as a string.
-#       produce lists of different kinds of fields from a command line
-#       texts: simple text strings
-#       fields: words delimited by the delimiter
-#       slices: e.g. 4:21 for characters 4 - 21 from the input line
-#       holds: fields of all types stored previously: passed in thru holddic
-
-        msg(ogdebug,"In process fields, the original line:\n {}".format(mytext))
-        fieldtypes = []
-        slicesplitter = ":"
-        fieldbase = "$field"
-        holdbase  = "$hold"
-        slicedef = []
-        fielddef = []
-        holddef  = []
-        fieldtexts = []
-        holdtexts  = []
-        texts = []
-        for arg in args:
-            msg(ogdebug,"looking at argument: {} ".format(arg))
-            if slicesplitter in arg:
-                start,end = arg.split(slicesplitter)
-                try:
-                    start = int(start) - 1
-                    end   = int(end) - 1
-                    fieldtypes.append("slice")
-                    slicedef.append((start,end))
-                    msg(ogdebug,"assigning argument {} to slice ".format(arg))
-                except:            # take care of the case where ":" in a text field
-                    texts.append(arg)
-                    fieldtypes.append("text")
-                    msg(ogdebug,"assigning argument {} to text".format(arg))
-            elif fieldbase in arg:
-                fielddef.append(arg)
-                fieldtypes.append("field")
-                msg(ogdebug,"assigning argument {} to field".format(arg))
-            elif holdbase in arg:
-                holddef.append(arg)
-                fieldtypes.append("hold")
-                msg(ogdebug,"assigning argument {} to hold".format(arg))
-            else:
-                texts.append(arg)
-                fieldtypes.append("text")
-                msg(ogdebug,"assigning argument {} to text".format(arg))
-    #           create lists of the slices and fields
-        slicetexts = getslicelist(mytext,slicedef)
-        fielddic   = getfielddic(mytext,self.fieldnameslist)
-        for field in fielddef:
-            try:
-                fieldtexts.append(fielddic[field]) 
-            except:
-                msg(ogmain,"problem with field {} ".format(field))
-        for hold in holddef:
-            try:
-                holdtexts.append(holddic[hold]) 
-            except:
-                msg(ogmain,"problem with hold {} ".format(field))
-     
-        msg(ogdebug,"texts found: {} ".format(texts))
-        msg(ogdebug,"fielddef: {} ".format(fielddef))
-        msg(ogdebug,"fieldtypes: {} ".format(fieldtypes))
-        msg(ogdebug,"fieldtexts found: {} ".format(fieldtexts))
-        msg(ogdebug,"slicedef: {} ".format(slicedef))
-        msg(ogdebug,"slicetexts found: {} ".format(slicetexts))
-        msg(ogdebug,"holddef: {} ".format(holddef))
-        msg(ogdebug,"holdtexts found: {} ".format(holdtexts))
-
-        return fieldtypes,texts,slicetexts,fieldtexts,holdtexts
-
     def updatemsg(self,command):
+            if msglevel > ogverbose: return
             msg(ogverbose,"____________________________________________")
-            msg(ogverbose,"After command: {}, line # = {}, line =  ".format(command,self.infile.current))
-            msg(ogverbose,"{}".format(self.infile.lines[self.infile.current]))
+            msg(ogverbose,"After command: {}, line # = {}, line =  ",command,self.infile.current)
+            msg(ogverbose,"{}",self.infile.lines[self.infile.current])
             msg(ogverbose,"____________________________________________")
 
     def interpretcommand(self,command,tokens):
         """ Translate an outgrab command into calls to outgrab_tools methods
+            (tokens are compiled into an Instruction first; see runinstruction)
         """
-        msg(ogdebug,"In interpretcommand, matchflag, execute: {}, {}".format(self.matchflag,self.execute))
-
-
-        if command == "include":
-            args = self.getargs(tokens,"comargs")
-            self.insertfile(args[0],overwrite=True)
-            self.updatemsg(command)
-            return
-
-        if command == "match" and self.execute:        
-            arg1,kwargdict = self.getargs(tokens,"comargdict")
-            nfind    = int(kwargdict.get("nfind",1))
-            dir = parameterstartswithkey("direction",1,kwargdict)
-            dir = int(dir) 
-            self.infile.match(arg1,nfind=int(nfind),dir=dir)
-            self.matchflag = self.infile.matchflag
-            self.updatemsg(command)
-
-        elif command == "ifmatch":
-            kwargdict = {}
-            self.ifmatchlevel += 1
-            msg(ogdebug,"In interpretcommand (ifmatch), matchlevel: {}".format(self.ifmatchlevel))
-            if self.ifmatchlevel > 1:
-                sys.exit("stopping: no nested ifmatch/ifnomatch allowed")
-            self.execute = self.matchflag
-            msg(ogdebug,"In interpretcommand (ifmatch), matchflag, execute: {}, {}".format(self.matchflag,self.execute))
-            self.updatemsg(command)
-
-        elif command == "ifnomatch":
-            kwargdict = {}
-            self.ifmatchlevel += 1
-            msg(ogdebug,"In interpretcommand (ifnomatch), matchlevel: {}".format(self.ifmatchlevel))
-            if self.ifmatchlevel > 1:
-                sys.exit("stopping: no nested ifmatch/ifnomatch allowed")
-            self.execute = not self.matchflag
-            msg(ogdebug,"In interpretcommand (ifnomatch), matchflag, execute: {}, {}".format(self.matchflag,self.execute))
-            self.updatemsg(command)
-
-        elif command == "endifmatch" or command == "endif":
-            kwargdict = {}
-            self.ifmatchlevel -= 1
-            msg(ogdebug,"In interpretcommand (endifmatch), matchlevel: {}".format(self.ifmatchlevel))
-            self.execute = True
-            msg(ogdebug,"In interpretcommand (endifmatch), matchflag, execute: {}, {}".format(self.matchflag,self.execute))
-            self.updatemsg(command)
-
-        elif (command == "next" or command == "step") and self.execute:
-            arg1,kwargdict = self.getargs(tokens,"comargdict")
-            if arg1:
-                self.infile.step(increment=int(arg1))
-            else:
-                self.infile.step(increment=1)
-            self.updatemsg(command)
+        instruction = Instruction("command"," ".join(tokens),self.current)
+        instruction.command = command
+        instruction.tokens = tokens
+        self.compilecommand(instruction)
+        self.runinstruction(instruction)
+
+    def runinstruction(self,instruction):
+        """ Execute a compiled Instruction: look up its command in the registry
+            (done once, at compile time) and call the command's handler
+        """
+        msg(ogdebug,"In interpretcommand, matchflag, execute: {}, {}",self.matchflag,self.execute)
+        spec = instruction.spec
+        if spec is not None and (self.execute or not spec.conditional):
+            if instruction.error:
+                self.badarguments(instruction)
+            spec.handler(self,instruction)
 
-        elif command == "back" and self.execute:
-            arg1,kwargdict = self.getargs(tokens,"comargdict")
-            if arg1:
-                self.infile.back(int(arg1))
-            else:
-                self.infile.back(increment=1)
-            self.updatemsg(command)
-
-        elif command == "remember" and self.execute:
-            arg1,kwargdict = self.getargs(tokens,"comargdict")
-            self.infile.remember(arg1)
-            self.updatemsg(command)
-
-        elif command == "forget" and self.execute:
-            arg1,kwargdict = self.getargs(tokens,"comargdict")
-            self.infile.forget(arg1)
-            self.updatemsg(command)
-
-        elif command == "setverbosity" and self.execute:
-            args = self.getargs(tokens,"comargs")
-            verbosity = int(args[0])
-            myloglevel = setverbositylevels(verbosity,verbosity_default=2)
-#           Note that running logging.basicConfig a 2nd time does nothing
-#           must run setLevel instead to reset verbosity/loglevel
-            logging.getLogger().setLevel(myloglevel)
-            msg(ogmain,"Resetting verbosity to {} ".format(verbosity))
-            self.updatemsg(command)
-
-        elif command == "dumpline" and self.execute:
-            arg1,kwargdict = self.getargs(tokens,"comargdict")
-            copyline(self.infile,self.outfile)
-            self.infile.step(increment=1)
-            self.updatemsg(command)
-
-        elif command == "dumplines" and self.execute:
-            arg1,kwargdict = self.getargs(tokens,"comargdict")
-            if not arg1: arg1 = 1
-            copylines(self.infile,self.outfile,int(arg1))
-            self.infile.step(increment=int(arg1))
-            self.updatemsg(command)
-
-        elif command == "dumpsection" and self.execute:
-            args = self.getargs(tokens,"comargs")
-            endpos = copysection(self.infile,self.outfile,args[0],args[1])
-            self.infile.goto(endpos)
-            self.infile.step(increment=1)
-            self.updatemsg(command)
-
-        elif command == "dumpuntilmatch" and self.execute:
-            arg1,kwargdict = self.getargs(tokens,"comargdict")
-            start = kwargdict.get("start",False)
-            end   = kwargdict.get("end",False)
-            if start in ["True","true","T","t","yes","Yes"]: start = True
-            if end   in ["True","true","T","t","yes","Yes"]: end   = True
-            endpos = copyuntilmatch(self.infile,self.outfile,arg1,start=start,end=end)
-            self.infile.goto(endpos)
-            self.infile.step(increment=1)
-            if not end: self.infile.step(increment=1)
-            self.updatemsg(command)
-
-        elif command == "switchinputto" and self.execute:
-            arg1,kwargdict = self.getargs(tokens,"comargdict")
-            x = getfilefromname(arg1)
-            self.setinputfile(x)
-            self.updatemsg(command)
-
-        elif command == "switchoutputto" and self.execute:
-            arg1,kwargdict = self.getargs(tokens,"comargdict")
-            x = getfilefromname(arg1)
-            self.setoutputfile(x)
-            self.updatemsg(command)
-
-        elif command == "setoutputname" and self.execute:
-            arg1,kwargdict = self.getargs(tokens,"comargdict")
-            self.setfilename(self.output,arg1)
-            self.updatemsg(command)
-
-        elif command == "setinputname" and self.execute:
-            arg1,kwargdict = self.getargs(tokens,"comargdict")
-            self.setfilename(self.input,arg1)
-            self.updatemsg(command)
-
-        elif command == "empty" and self.execute:
-            arg1,kwargdict = self.getargs(tokens,"comargdict")
-            if arg1:
-                x = getfilefromname(arg1)
-                x.empty()
-                msg(ogmain,"Emptying file {} ".format(arg1))
-            else:
-                msg(ogmain,"Ignoring 'empty' command: must specify file to empty.")
-            self.updatemsg(command)
-
-        elif command == "goto" and self.execute:
-            arg1,kwargdict = self.getargs(tokens,"comargdict")
-            self.infile.goto(arg1)
-            self.updatemsg(command)
-
-        elif command == "writefile" and self.execute:
-            arg1,arg2 = self.getargs(tokens,"comargs")
-            if arg1:
-                x = getfilefromname(arg1)
-            else:
-                x = getfilefromname("output")
-            fh = open(arg2,"w")
-            x.writefile(fh)
-            self.updatemsg(command)
-
-        elif command == "readinput" and self.execute:
-            arg1,kwargdict = self.getargs(tokens,"comargdict")
-            filenum = getnextfilenum()
-            readinputfile(arg1,filenum)
-            self.updatemsg(command)
-
-        elif command == "print" and self.execute:
-            args = self.getargs(tokens,"comargs")
-            self.outfile.addline(" ".join(args))
-            self.updatemsg(command)
-            
-        elif command == "joinlast" and self.execute:
-            arg1,kwargdict = self.getargs(tokens,"comargdict")
-            if not arg1: arg1 = ""
-            self.outfile.joinlastlines(arg1)
-            self.updatemsg(command)
-
-        elif command == "switchlast" and self.execute:
-            self.outfile.switchlastlines()
-            self.updatemsg(command)
-
-        elif command == "remove":
-            args = self.getargs(tokens,"comargs")
-            substring = args[0]
-            if len(args) > 1:
-                occurrence = int(args[1])
-            else:
-                occurrence = 1
-            mytext = self.outfile.lines[-1]
-            mytext = removesubstring(mytext,substring,occurrence)
-            self.outfile.replacelastline(mytext)
-            self.updatemsg(command)
-            
-        elif command == "replace":
-            args = self.getargs(tokens,"comargs")
-            substring = args[0]
-            replacement = args[1]
-            if len(args) > 2:
-                occurrence = int(args[2])
-            else:
-                occurrence = 1
-            mytext = self.outfile.lines[-1]
-            mytext = replacesubstring(mytext,substring,replacement,occurrence)
-            self.outfile.replacelastline(mytext)
-            self.updatemsg(command)
-
-        elif command == "matchnextdump" and self.execute:
-            arg1,kwargdict = self.getargs(tokens,"comargdict")
-            nfind = parameterstartswithkey("nfind",1,kwargdict)
-            if nfind == "all":
-                pass
-            else:
-                nfind = int(nfind)
-            increment = int(parameterstartswithkey("increment",0,kwargdict))
-            nlines =    int(parameterstartswithkey("nlines",1,kwargdict))
-            matchnextcopy(self.infile,self.outfile,arg1,nfind=nfind,increment=increment,nlines=nlines)
-            self.updatemsg(command)
-
-        elif command == "dumpfields" and self.execute:
-            args = self.getargs(tokens,"comargs")
-            mytext = self.infile.getline()
-            fieldtypes,texts,slicetexts,fieldtexts,holdtexts = self.processfields(args,mytext,self.holddic)
-            outputstringlist = stringlistfromfields(fieldtypes,texts,slicetexts,fieldtexts,holdtexts)
-            outputstring = stringlisttostring(outputstringlist,delim=" ")
-            if outputstring:
-                msg(ogdebug,"The line to be added: {} ".format(outputstring))
-                self.outfile.addline(outputstring) 
-            self.infile.step(increment=1)
-            self.updatemsg(command)
-
-        elif command == "holdfields" and self.execute:
-            args = self.getargs(tokens,"comargs")
-            mytext = self.infile.getline()
-            fieldtypes,texts,slicetexts,fieldtexts,holdtexts = self.processfields(args,mytext,self.holddic)
-            holdtexts = stringlistfromfields(fieldtypes,texts,slicetexts,fieldtexts)
-            self.holddic = dict(zip(self.holdnameslist,holdtexts))
-            msg(ogdebug,"Texts to be held from this line: {} ".format(holdtexts))
-            msg(ogdebug,"holddic: {} ".format(self.holddic))
-            self.updatemsg(command)
-
-        elif command == "break" and self.execute:
-            if self.ifmatchlevel >= 0:
-                if self.nestlevel >= 0:
-                    self.match("endrepeat")
-                    self.ifmatchlevel -= 1
-                    self.execute = True
-                    self.match = False
-                else:
-                    sys.exit("break command must be executed inside repeat loop")
-            else:
-                sys.exit("break command must be executed inside ifmatch or ifnomatch")
-
-        elif  command == "repeat" and self.execute:
-#           loop: repeat sequence of commands from this line to "endrepeat" arg1 times
-            arg1,kwargdict = self.getargs(tokens,"comargdict")
-            arg1 = int(arg1)
-            self.nestlevel += 1
-            self.loopmaxiter.append(arg1)
-            msg(ogdebug,"Found repeat. nestlevel = {}, maxiter = {} ".format(self.nestlevel,arg1))
-            self.loopiter.append(1)
-            mylooplabel = "loop_" + str(self.nestlevel)
-            self.looplabel.append(mylooplabel)
-            self.remember(mylooplabel) # label the line after the repeat
-
-        elif (command == "endrepeat"):
-            if self.execute:
-                if self.loopiter[self.nestlevel] >= self.loopmaxiter[self.nestlevel]:
-                    msg(ogdebug,"Reached endrepeat. nestlevel = {}, iter = {}, maxiter = {} "
-                                .format(self.nestlevel,self.loopiter[self.nestlevel],self.loopmaxiter[self.nestlevel]))
-#                   finished with this loop
-                    self.loopmaxiter.pop() 
-                    self.loopiter.pop() 
-#                   forget looplabel....
-                    self.forget(self.looplabel[self.nestlevel])
-                    self.looplabel.pop()
-                    self.nestlevel -= 1
-                else:
-                    msg(ogdebug,"Reached endrepeat. nestlevel = {}, iter = {}, maxiter = {} "
-                                 .format(self.nestlevel,self.loopiter[self.nestlevel],self.loopmaxiter[self.nestlevel]))
-                    self.loopiter[self.nestlevel] +=1 
-                    self.goto(self.looplabel[self.nestlevel])
-                
         elif not self.execute:
-            msg(ogmain,"Not executing command {} near line {} in Program {}: within ifmatch "
-                       .format(command,self.current,self.names))
+            msg(ogmain,"Not executing command {} near line {} in Program {}: within ifmatch ",
+                       instruction.command,self.current,self.names)
 
-        elif command != "include":
-            msg(ogmain,"Command {} near line {} in Program {} is not a valid outgrab command"
-                       .format(command,self.current,self.names))
-            ifkwargdict: msg(ogmain,"Arguments found: {} ".format(kwargdict))
+        else:
+            command = instruction.command
+            msg(ogmain,"Command {} near line {} in Program {} is not a valid outgrab command",
+                       command,self.current,self.names)
+            if instruction.kwargs: msg(ogmain,"Arguments found: {} ",instruction.kwargs)
             sys.exit("Command {} near line {} in Program {} is not a valid outgrab command"
                        .format(command,self.current,self.names))
 
+#
+# outgrab commands
+#
+# Each command is a handler function, handler(program,instruction), where program is the
+# running ProgramFile (with program.infile and program.outfile) and instruction the compiled
+# Instruction for the program line.  An optional compiler function with the same signature
+# is run once, when the line is compiled, and usually fills in instruction.params.
+# Commands are looked up by name in commandregistry; see registercommand.
+#
+
+class OutgrabCommand:
+#   Registry entry for one outgrab command.
+#   style is the getargs style of its arguments ("comargdict" or "comargs").
+#   conditional commands are skipped inside an ifmatch/ifnomatch block that is not executing;
+#   non-conditional ones (the if/loop structure commands themselves, etc.) always run.
+#   backward says whether the command can move the input backwards (so the program cannot
+#   run over streamed input): True, False, or a function of the compiled Instruction.
+#   outputtail is the number of lines at the end of the output the command can change
+#   (e.g. 2 for joinlast), which a streamed output file must hold back.
+#   readsoutput commands (writefile) use all the lines of an output file, so the output
+#   cannot be written out while the program runs.
+#   scans marks commands that search through the input, so that --profile reports the
+#   number of input lines they go over.
+#   blocking commands read or write files or copy any number of lines; they and those that
+#   scan are run on a thread by the coroutines (see ProgramFile.aprocesscommands) rather
+#   than hold up the event loop.
+
+    def __init__(self,name,handler,style="comargdict",compiler=None,conditional=True,backward=False,
+                 outputtail=0,readsoutput=False,scans=False,blocking=False):
+        self.name = name
+        self.handler = handler
+        self.style = style
+        self.compiler = compiler
+        self.conditional = conditional
+        self.backward = backward
+        self.outputtail = outputtail
+        self.readsoutput = readsoutput
+        self.scans = scans
+        self.blocking = blocking
+
+    def __repr__(self):
+        return "OutgrabCommand({})".format(self.name)
+
+# registry of outgrab commands by name
+commandregistry = {}
+
+def registercommand(name,handler,style="comargdict",compiler=None,conditional=True,aliases=(),
+                    backward=False,outputtail=0,readsoutput=False,scans=False,blocking=False):
+    """ Register handler as the outgrab command name (and any aliases).
+        handler(program,instruction) is called each time the command is executed;
+        compiler(program,instruction), if given, is called once when the program line
+        is compiled and can convert the arguments into instruction.params.
+        backward (True, or a function of the instruction returning True) marks commands
+        that move the input backwards, which stops a program from running with --stream,
+        and outputtail is the number of final output lines the command can change.
+        readsoutput marks commands that need all the lines of an output file, scans
+        those that search the input (their lines searched are counted by --profile),
+        and blocking those that read or write files or copy any number of lines (these
+        and those that scan are run on a thread by arunoutgrab).
+        A command registered under an existing name replaces the old one.
+        e.g.
+            def cmd_shout(program,instruction):
+                program.outfile.addline(" ".join(instruction.args).upper())
+            registercommand("shout",cmd_shout,style="comargs")
+    """
+    spec = OutgrabCommand(name,handler,style,compiler,conditional,backward,outputtail,readsoutput,scans,
+                          blocking)
+    for myname in (name,) + tuple(aliases):
+        commandregistry[myname] = spec
+    return spec
+
+def unregistercommand(name):
+#   remove a command (by name) from the registry
+    del commandregistry[name]
+
+def cmd_include(program,instruction):
+    program.insertfile(instruction.args[0],overwrite=True)
+    program.updatemsg(instruction.command)
+
+def args_match(program,instruction):
+    kwargdict = instruction.kwargs
+    instruction.params["nfind"] = int(kwargdict.get("nfind",1))
+    instruction.params["dir"]   = int(parameterstartswithkey("direction",1,kwargdict))
+
+def backward_match(instruction):
+    return instruction.params["dir"] < 0
+
+def cmd_match(program,instruction):
+    params = instruction.params
+    program.infile.match(instruction.arg1,nfind=params["nfind"],dir=params["dir"])
+    program.matchflag = program.infile.matchflag
+    program.updatemsg(instruction.command)
+
+def cmd_ifmatch(program,instruction):
+    command = instruction.command
+    program.ifmatchlevel += 1
+    msg(ogdebug,"In interpretcommand ({}), matchlevel: {}",command,program.ifmatchlevel)
+    if program.ifmatchlevel > 1:
+        sys.exit("stopping: no nested ifmatch/ifnomatch allowed")
+    if command == "ifmatch":
+        program.execute = program.matchflag
+    else:
+        program.execute = not program.matchflag
+    msg(ogdebug,"In interpretcommand ({}), matchflag, execute: {}, {}",command,program.matchflag,program.execute)
+    program.updatemsg(command)
+
+def cmd_endifmatch(program,instruction):
+    program.ifmatchlevel -= 1
+    msg(ogdebug,"In interpretcommand (endifmatch), matchlevel: {}",program.ifmatchlevel)
+    program.execute = True
+    msg(ogdebug,"In interpretcommand (endifmatch), matchflag, execute: {}, {}",program.matchflag,program.execute)
+    program.updatemsg(instruction.command)
+
+def args_increment(program,instruction):
+    arg1 = instruction.arg1
+    instruction.params["increment"] = int(arg1) if arg1 else 1
+
+def backward_increment(instruction):
+    return instruction.params["increment"] < 0
+
+def cmd_next(program,instruction):
+    program.infile.step(increment=instruction.params["increment"])
+    program.updatemsg(instruction.command)
+
+def cmd_back(program,instruction):
+    program.infile.back(increment=instruction.params["increment"])
+    program.updatemsg(instruction.command)
+
+def cmd_remember(program,instruction):
+    program.infile.remember(instruction.arg1)
+    program.updatemsg(instruction.command)
+
+def cmd_forget(program,instruction):
+    program.infile.forget(instruction.arg1)
+    program.updatemsg(instruction.command)
+
+def args_setverbosity(program,instruction):
+    instruction.params["verbosity"] = int(instruction.args[0])
+
+def cmd_setverbosity(program,instruction):
+    verbosity = instruction.params["verbosity"]
+    myloglevel = setverbositylevels(verbosity,verbosity_default=2)
+#   Note that running logging.basicConfig a 2nd time does nothing
+#   must run setLevel instead to reset verbosity/loglevel
+    setmsglevel(myloglevel)
+    msg(ogmain,"Resetting verbosity to {} ",verbosity)
+    program.updatemsg(instruction.command)
+
+def cmd_dumpline(program,instruction):
+    copyline(program.infile,program.outfile)
+    program.infile.step(increment=1)
+    program.updatemsg(instruction.command)
+
+def args_dumplines(program,instruction):
+    arg1 = instruction.arg1
+    instruction.params["nlines"] = int(arg1) if arg1 else 1
+
+def cmd_dumplines(program,instruction):
+    nlines = instruction.params["nlines"]
+    copylines(program.infile,program.outfile,nlines)
+    program.infile.step(increment=nlines)
+    program.updatemsg(instruction.command)
+
+def args_dumpsection(program,instruction):
+    instruction.params["start"] = instruction.args[0]
+    instruction.params["end"]   = instruction.args[1]
+
+def cmd_dumpsection(program,instruction):
+    params = instruction.params
+    endpos = copysection(program.infile,program.outfile,params["start"],params["end"])
+    program.infile.goto(endpos)
+    program.infile.step(increment=1)
+    program.updatemsg(instruction.command)
+
+def args_dumpuntilmatch(program,instruction):
+    start = instruction.kwargs.get("start",False)
+    end   = instruction.kwargs.get("end",False)
+    if start in ["True","true","T","t","yes","Yes"]: start = True
+    if end   in ["True","true","T","t","yes","Yes"]: end   = True
+    instruction.params["start"] = bool(start)
+    instruction.params["end"]   = bool(end)
+
+def cmd_dumpuntilmatch(program,instruction):
+    end = instruction.params["end"]
+    endpos = copyuntilmatch(program.infile,program.outfile,instruction.arg1,start=instruction.params["start"],end=end)
+    program.infile.goto(endpos)
+    program.infile.step(increment=1)
+    if not end: program.infile.step(increment=1)
+    program.updatemsg(instruction.command)
+
+def cmd_switchinputto(program,instruction):
+    x = getfilefromname(instruction.arg1)
+    program.setinputfile(x)
+    program.updatemsg(instruction.command)
+
+def cmd_switchoutputto(program,instruction):
+    x = getfilefromname(instruction.arg1)
+    program.setoutputfile(x)
+    program.updatemsg(instruction.command)
+
+def cmd_setoutputname(program,instruction):
+    program.setfilename(program.output,instruction.arg1)
+    program.updatemsg(instruction.command)
+
+def cmd_setinputname(program,instruction):
+    program.setfilename(program.input,instruction.arg1)
+    program.updatemsg(instruction.command)
+
+def cmd_empty(program,instruction):
+    arg1 = instruction.arg1
+    if arg1:
+        x = getfilefromname(arg1)
+        x.empty()
+        msg(ogmain,"Emptying file {} ",arg1)
+    else:
+        msg(ogmain,"Ignoring 'empty' command: must specify file to empty.")
+    program.updatemsg(instruction.command)
+
+def backward_goto(instruction):
+    return instruction.arg1 == "top"
+
+def cmd_goto(program,instruction):
+    program.infile.goto(instruction.arg1)
+    program.updatemsg(instruction.command)
+
+def args_writefile(program,instruction):
+    instruction.params["name"],instruction.params["filename"] = instruction.args
+
+def cmd_writefile(program,instruction):
+    params = instruction.params
+    if params["name"]:
+        x = getfilefromname(params["name"])
+    else:
+        x = getfilefromname("output")
+    with openoutput(params["filename"]) as fh:
+        x.writefile(fh)
+    program.updatemsg(instruction.command)
+
+def cmd_readinput(program,instruction):
+    filenum = getnextfilenum()
+    readinputfile(instruction.arg1,filenum)
+    program.updatemsg(instruction.command)
+
+def cmd_print(program,instruction):
+    program.outfile.addline(" ".join(instruction.args))
+    program.updatemsg(instruction.command)
+
+def args_joinlast(program,instruction):
+    instruction.params["joiner"] = instruction.arg1 if instruction.arg1 else ""
+
+def cmd_joinlast(program,instruction):
+    program.outfile.joinlastlines(instruction.params["joiner"])
+    program.updatemsg(instruction.command)
+
+def cmd_switchlast(program,instruction):
+    program.outfile.switchlastlines()
+    program.updatemsg(instruction.command)
+
+def args_remove(program,instruction):
+    args = instruction.args
+    instruction.params["substring"] = args[0]
+    instruction.params["occurrence"] = int(args[1]) if len(args) > 1 else 1
+
+def cmd_remove(program,instruction):
+    params = instruction.params
+    mytext = program.outfile.lines[-1]
+    mytext = removesubstring(mytext,params["substring"],params["occurrence"])
+    program.outfile.replacelastline(mytext)
+    program.updatemsg(instruction.command)
+
+def args_replace(program,instruction):
+    args = instruction.args
+    instruction.params["substring"] = args[0]
+    instruction.params["replacement"] = args[1]
+    instruction.params["occurrence"] = int(args[2]) if len(args) > 2 else 1
+
+def cmd_replace(program,instruction):
+    params = instruction.params
+    mytext = program.outfile.lines[-1]
+    mytext = replacesubstring(mytext,params["substring"],params["replacement"],params["occurrence"])
+    program.outfile.replacelastline(mytext)
+    program.updatemsg(instruction.command)
+
+def args_matchnextdump(program,instruction):
+    kwargdict = instruction.kwargs
+    nfind = parameterstartswithkey("nfind",1,kwargdict)
+    instruction.params["nfind"] = nfind if nfind == "all" else int(nfind)
+    instruction.params["increment"] = int(parameterstartswithkey("increment",0,kwargdict))
+    instruction.params["nlines"]    = int(parameterstartswithkey("nlines",1,kwargdict))
+
+def cmd_matchnextdump(program,instruction):
+    params = instruction.params
+    matchnextcopy(program.infile,program.outfile,instruction.arg1,nfind=params["nfind"],
+                  increment=params["increment"],nlines=params["nlines"])
+    program.updatemsg(instruction.command)
+
+def args_extractfields(program,instruction):
+#   extractfields pattern item... [delim d] [format f]: items are $fieldN, m:p (columns
+#   m to p) or text; delim splits the fields of the input lines (whitespace, comma or a
+#   regular expression) and format is the output's (tsv, csv or space)
+    args = list(instruction.args)
+    if len(args) < 2:
+        raise ValueError("extractfields needs a pattern and at least one field")
+    params = instruction.params
+    params["pattern"] = args.pop(0)
+    params["delim"] = "whitespace"
+    params["format"] = "tsv"
+    items = []
+    while args:
+        arg = args.pop(0)
+        if arg in ("delim","format") and args:
+            params[arg] = args.pop(0)
+        elif nameindex(arg,"field") is not None:
+            items.append(("field",nameindex(arg,"field")))
+        elif ":" in arg and all(part.isdigit() for part in arg.split(":",1)):
+            start,end = arg.split(":")
+            items.append(("slice",int(start) - 1,int(end)))
+        else:
+            items.append(("text",arg))
+    if params["format"] not in extractformats:
+        raise ValueError("format must be one of {}".format(", ".join(extractformats)))
+    getdelimiter(params["delim"])
+    params["items"] = items
+
+def cmd_extractfields(program,instruction):
+    params = instruction.params
+    extractfields(program.infile,program.outfile,params["pattern"],params["items"],
+                  delim=params["delim"],format=params["format"])
+    program.updatemsg(instruction.command)
+
+def args_fields(program,instruction):
+    instruction.params["template"] = FieldTemplate(instruction.args)
+
+def applyfields(program,template,holdlist=None):
+#   the texts of template (a FieldTemplate) for the current input line
+    infile = program.infile
+    fieldlist = infile.getfieldlist() if template.usesfields else None
+    return template.apply(infile.getline(),fieldlist,holdlist)
+
+def cmd_dumpfields(program,instruction):
+    texts = applyfields(program,instruction.params["template"],program.holdlist)
+    if texts:
+#       each text is followed by a space, as stringlisttostring does
+        outputstring = " ".join(texts) + " "
+        msg(ogdebug,"The line to be added: {} ",outputstring)
+        program.outfile.addline(outputstring) 
+    program.infile.step(increment=1)
+    program.updatemsg(instruction.command)
+
+def cmd_holdfields(program,instruction):
+#   held texts are $hold1, $hold2, ... in order
+    program.holdlist = applyfields(program,instruction.params["template"])
+    msg(ogdebug,"Texts to be held from this line: {} ",program.holdlist)
+    program.updatemsg(instruction.command)
+
+def cmd_break(program,instruction):
+#   leave the innermost loop: go on after its endrepeat, closing the ifmatch/ifnomatch
+#   the break is in
+    if program.ifmatchlevel < 0:
+        sys.exit("break command must be executed inside ifmatch or ifnomatch")
+    if not program.loops:
+        sys.exit("break command must be executed inside repeat loop")
+    start = program.loops.pop()[0]
+    end = program.loopend(start)
+    if end is None:
+        sys.exit("stopping: no endrepeat for the repeat near line {} in Program {}".format(start,program.names))
+    program.ifmatchlevel -= 1
+    program.execute = True
+    program.jump(end)
+
+def args_repeat(program,instruction):
+    instruction.params["ntimes"] = int(instruction.arg1)
+
+def cmd_repeat(program,instruction):
+#   loop: repeat sequence of commands from this line to "endrepeat" ntimes times
+    ntimes = instruction.params["ntimes"]
+    program.loops.append([program.current,1,ntimes])
+    msg(ogdebug,"Found repeat. nestlevel = {}, maxiter = {} ",len(program.loops) - 1,ntimes)
+
+def cmd_endrepeat(program,instruction):
+    if not program.execute:
+        return
+    if not program.loops:
+        sys.exit("stopping: endrepeat without repeat near line {} in Program {}".format(program.current,program.names))
+    loop = program.loops[-1]
+    msg(ogdebug,"Reached endrepeat. nestlevel = {}, iter = {}, maxiter = {} ",len(program.loops) - 1,loop[1],loop[2])
+    if loop[1] >= loop[2]:
+#       finished with this loop
+        program.loops.pop()
+    else:
+#       back to the repeat line; processcommands goes on with the line after it
+        loop[1] += 1
+        program.jump(loop[0])
+
+# the built-in commands
+registercommand("include",       cmd_include, style="comargs", conditional=False, backward=True, blocking=True)
+registercommand("match",         cmd_match, compiler=args_match, backward=backward_match, scans=True)
+registercommand("ifmatch",       cmd_ifmatch, conditional=False, aliases=("ifnomatch",))
+registercommand("endifmatch",    cmd_endifmatch, conditional=False, aliases=("endif",))
+registercommand("next",          cmd_next, compiler=args_increment, aliases=("step",), backward=backward_increment)
+registercommand("back",          cmd_back, compiler=args_increment, backward=True)
+registercommand("remember",      cmd_remember)
+registercommand("forget",        cmd_forget)
+registercommand("setverbosity",  cmd_setverbosity, style="comargs", compiler=args_setverbosity)
+registercommand("dumpline",      cmd_dumpline)
+registercommand("dumplines",     cmd_dumplines, compiler=args_dumplines, blocking=True)
+registercommand("dumpsection",   cmd_dumpsection, style="comargs", compiler=args_dumpsection, blocking=True)
+registercommand("dumpuntilmatch",cmd_dumpuntilmatch, compiler=args_dumpuntilmatch, scans=True)
+registercommand("switchinputto", cmd_switchinputto)
+registercommand("switchoutputto",cmd_switchoutputto)
+registercommand("setoutputname", cmd_setoutputname)
+registercommand("setinputname",  cmd_setinputname)
+registercommand("empty",         cmd_empty)
+registercommand("goto",          cmd_goto, backward=backward_goto)
+registercommand("writefile",     cmd_writefile, style="comargs", compiler=args_writefile, readsoutput=True,
+                                 blocking=True)
+registercommand("readinput",     cmd_readinput, blocking=True)
+registercommand("print",         cmd_print, style="comargs")
+registercommand("joinlast",      cmd_joinlast, compiler=args_joinlast, outputtail=2)
+registercommand("switchlast",    cmd_switchlast, outputtail=2)
+registercommand("remove",        cmd_remove, style="comargs", compiler=args_remove, conditional=False, outputtail=1)
+registercommand("replace",       cmd_replace, style="comargs", compiler=args_replace, conditional=False, outputtail=1)
+registercommand("matchnextdump", cmd_matchnextdump, compiler=args_matchnextdump, backward=backward_increment, scans=True)
+registercommand("dumpfields",    cmd_dumpfields, style="comargs", compiler=args_fields)
+registercommand("extractfields", cmd_extractfields, style="comargs", compiler=args_extractfields, scans=True)
+registercommand("holdfields",    cmd_holdfields, style="comargs", compiler=args_fields)
+registercommand("break",         cmd_break)
+registercommand("repeat",        cmd_repeat, compiler=args_repeat)
+registercommand("endrepeat",     cmd_endrepeat, conditional=False)
+
 """
 =======================================================
 Outgrab command language
@@ -1689,6 +4585,9 @@ holdfields    ("text")        (processes an input line like dumpfields,)
                               (but instead of dumping to output, holds the fields, slices, or text)
                               (for output in a subsequent dumpfields command)
                               (used to combine parts of two input lines)
+extractfields (find) ("$fieldn" "m:p" "text" any number of them) (delim () format () )
+                              (write those items of every line from the current one on that matches find)
+                              (one row per line, in one pass; format is tsv (default), csv or space)
 print         ("text")        (write arbitrary text string to output)
                               (print Here is some text... or print "Here is some text" both work)
 